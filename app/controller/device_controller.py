@@ -1,15 +1,23 @@
 import logging
+import math
+import os
+import time
+import uuid
 
 from attrdict import AttrDict
-from flask import request, Blueprint, json, url_for
+from flask import request, Blueprint, json, url_for, send_file, after_this_request
 from flask_jwt_extended import (
     jwt_required, get_jwt_identity
 )
 
 from app.data.database import session_scope
+from app.data.replica import read_session_scope
 from app.data.model.device_model import DeviceModel
+from app.service import batch_jobs
 from app.service.device_service import DeviceService
 from app.service.user_service import UserService
+from app.simulator import batch_simulator
+from app.simulator.control_schedule import ControlSchedule
 from app.util.app_config import params
 
 from api_auth import *
@@ -119,6 +127,110 @@ def create_device():
         return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@device_blueprint.route('/bulk', methods=['POST'])
+@jwt_required
+def create_devices():
+    """
+    create a batch of devices for the given user, which are turned on and start simulating within a few seconds
+    """
+
+    try:
+        username = get_jwt_identity()
+
+        # all devices are validated at once, nothing is created if any of them is invalid
+        req_params = AttrDict(json.loads(request.data))
+        devices_params = req_params.get("devices") or []
+        if len(devices_params) == 0:
+            resp = {
+                "status": "error",
+                "msg": "request body must contain at least one device in 'devices'"
+            }
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        is_valid, resp = device_service.validate_devices_params(devices_params)
+        if not is_valid:
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        with session_scope() as session:
+            user = user_service.get_user(username, session)
+            if user.devices.count() + len(devices_params) > user.max_devices:
+                resp = {
+                    "status": "error",
+                    "msg": "max active device limit of {} would be exceeded for '{}'".format(user.max_devices,
+                                                                                             username)
+                }
+                return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+            devices = device_service.create_devices(username, devices_params, session)
+
+            resp = {
+                "status": "success",
+                "msg": "created {} new devices".format(len(devices)),
+                "data": [device.serialize() for device in devices]
+            }
+            return make_response(jsonify(resp), status.HTTP_201_CREATED)
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@device_blueprint.route('/bulk', methods=['PUT', 'PATCH'])
+@jwt_required
+def update_devices_params():
+    """
+    update the model parameters of a batch of devices of the given user. the parameters are applied to the running
+    simulations without restarting them
+    """
+
+    try:
+        username = get_jwt_identity()
+
+        req_params = AttrDict(json.loads(request.data))
+        devices_params = req_params.get("devices") or []
+        if len(devices_params) == 0 or any(d.get("device_id") is None for d in devices_params):
+            resp = {
+                "status": "error",
+                "msg": "request body must contain at least one device with 'device_id' and 'params' in 'devices'"
+            }
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        with session_scope() as session:
+            user_devices = {device.device_id: device for device in device_service.get_all_devices(username, session)}
+            missing = [d.device_id for d in devices_params if d.device_id not in user_devices
+                       or user_devices[d.device_id].device_model is None]
+            if len(missing) > 0:
+                resp = {
+                    "status": "error",
+                    "msg": "no devices with ids %s found for '%s'" % (missing, username)
+                }
+                return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
+
+            devices = [user_devices[d.device_id] for d in devices_params]
+            is_valid, resp = device_service.validate_devices_params(
+                [{"model_name": device.device_model.model_name, "params": d.get("params")}
+                 for device, d in zip(devices, devices_params)])
+            if not is_valid:
+                return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+            device_service.update_devices_params(devices, [d.get("params") or {} for d in devices_params], session)
+
+            resp = {
+                "status": "success",
+                "msg": "updated parameters of {} devices".format(len(devices)),
+                "data": [device.serialize() for device in devices]
+            }
+            return make_response(jsonify(resp), status.HTTP_200_OK)
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @device_blueprint.route('', methods=['GET', 'POST'])
 @jwt_required
 def get_device():
@@ -207,6 +319,22 @@ def update_device():
             if not is_valid:
                 return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
 
+            if device.device_model is not None and device.device_model.model_name == req_params.model_name:
+                # same model: the parameters are updated in place and applied to the running simulation
+                updated_device = device_service.update_device(username, device_id, req_params.device_name, session)
+                device_service.update_devices_params([updated_device], [req_params.params], session)
+
+                resp = {
+                    "status": "success",
+                    "msg": "updated device",
+                    "data": updated_device.serialize()
+                }
+                return make_response(
+                    jsonify(resp),
+                    status.HTTP_200_OK,
+                    {'location': url_for(".get_device", device_id=device.device_id)}
+                )
+
             # stop simulation if running
             DeviceService.stop_simulation(device)
 
@@ -297,7 +425,7 @@ def get_all_devices_for_all_users():
     :return: a list of all devices
     """
     try:
-        with session_scope() as session:
+        with read_session_scope() as session:
             devices = device_service.get_all_devices_for_all_users(session)
             if len(devices) == 0:
                 resp = {
@@ -341,9 +469,7 @@ def delete_all_devices_for_user():
                 return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
 
             LOGGER.info("Deleting all devices for '%s'" % username)
-            for device in user.devices:
-                device_service.delete_device(user.username, device.device_id, session)
-                LOGGER.info("Deleted " + device.device_name + ", with device id = " + device.device_id + "!")
+            device_count = device_service.delete_all_devices(user.username, session)
             LOGGER.info("Deleted all devices for '%s'" % username)
 
             resp = {
@@ -368,9 +494,9 @@ def get_active_devices_for_user():
     try:
         username = get_jwt_identity()
         with session_scope() as session:
-            user = user_service.get_user(username, session)
+            devices = device_service.get_all_devices(username, session)
 
-            if user.devices.count() == 0:
+            if len(devices) == 0:
                 resp = {
                     "status": "error",
                     "msg": "no devices found for '%s' " % username
@@ -378,7 +504,7 @@ def get_active_devices_for_user():
                 return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
 
             active_devices = []
-            for device in user.devices:
+            for device in devices:
                 if device_service.is_device_active(device) and device_service.is_device_simulating(device):
                     active_devices.append(device.serialize())
             resp = {
@@ -573,6 +699,163 @@ def turn_off_device():
         return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@device_blueprint.route('/schedule', methods=['GET', 'POST', 'DELETE'])
+@jwt_required
+def device_schedule():
+    """
+    get (GET), set (POST) or clear (DELETE) the control schedule of the given device.
+    when setting, 'schedule' is a list of entries {"time": <offset in seconds from 'start'>, "u": 0|1, "v": <optional>}
+    and 'start' is a unix timestamp which defaults to the current time
+    """
+    try:
+        username = get_jwt_identity()
+
+        req_params = AttrDict(json.loads(request.data))
+        device_id = req_params.get("device_id")
+        if device_id is None:
+            resp = {
+                "status": "error",
+                "msg": "request body must contain 'device_id'"
+            }
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        with session_scope() as session:
+            device = device_service.get_device(username, device_id, session)
+            if device is None:
+                resp = {
+                    "status": "error",
+                    "msg": "no device with device_id '%s' found for '%s'" % (device_id, username)
+                }
+                return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
+
+            if not device_service.is_device_simulating(device):
+                resp = {
+                    "status": "error",
+                    "msg": "device with device_id '%s' not simulating. you need to start simulating it first" % device_id
+                }
+                return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+            if request.method == 'GET':
+                resp = {
+                    "status": "success",
+                    "msg": "fetched pending schedule entries for device with device_id '%s'" % device_id,
+                    "data": {
+                        "schedule": device_service.get_device_schedule(device)
+                    }
+                }
+                return make_response(jsonify(resp), status.HTTP_200_OK)
+
+            if request.method == 'DELETE':
+                device_service.clear_device_schedule(device)
+                resp = {
+                    "status": "success",
+                    "msg": "cleared schedule of device with device_id '%s'" % device_id
+                }
+                return make_response(jsonify(resp), status.HTTP_200_OK)
+
+            try:
+                schedule = ControlSchedule.from_entries(req_params.get("schedule"),
+                                                        req_params.get("start", time.time()))
+            except (ValueError, TypeError) as e:
+                resp = {
+                    "status": "error",
+                    "msg": "invalid schedule: %s" % str(e)
+                }
+                return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+            is_set, resp = device_service.set_device_schedule(device, schedule)
+            if not is_set:
+                return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+            return make_response(jsonify(resp), status.HTTP_200_OK)
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@device_blueprint.route('/trace', methods=['GET', 'POST'])
+@jwt_required
+def device_trace():
+    """
+    get the output of the given device recorded at every simulation step between 'start' and 'end' (GET), or turn
+    the recording on or off with 'enabled' (POST)
+    """
+    try:
+        username = get_jwt_identity()
+
+        req_params = AttrDict(json.loads(request.data))
+        device_id = req_params.get("device_id")
+        if device_id is None:
+            resp = {
+                "status": "error",
+                "msg": "request body must contain 'device_id'"
+            }
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        with session_scope() as session:
+            device = device_service.get_device(username, device_id, session)
+            if device is None:
+                resp = {
+                    "status": "error",
+                    "msg": "no device with device_id '%s' found for '%s'" % (device_id, username)
+                }
+                return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
+
+            if request.method == 'POST':
+                if not device_service.is_device_simulating(device):
+                    resp = {
+                        "status": "error",
+                        "msg": "device with device_id '%s' not simulating. you need to start simulating it first"
+                               % device_id
+                    }
+                    return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+                enabled = bool(req_params.get("enabled", True))
+                device_service.set_device_trace(device, enabled)
+                resp = {
+                    "status": "success",
+                    "msg": "turned trace recording {} for device with device_id '{}'".format(
+                        "on" if enabled else "off", device_id)
+                }
+                return make_response(jsonify(resp), status.HTTP_200_OK)
+
+            start = float(req_params.get("start")) if req_params.get("start") is not None else None
+            end = float(req_params.get("end")) if req_params.get("end") is not None else None
+            trace = device_service.get_device_trace(device, start, end)
+            if trace is None:
+                resp = {
+                    "status": "error",
+                    "msg": "no trace recorded for device with device_id '%s'" % device_id
+                }
+                return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
+
+            if len(trace["time"]) > params.trace.max_response_samples:
+                resp = {
+                    "status": "error",
+                    "msg": "range holds {} samples, at most {} can be fetched at once".format(
+                        len(trace["time"]), params.trace.max_response_samples)
+                }
+                return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+            resp = {
+                "status": "success",
+                "msg": "fetched {} trace samples for device with device_id '{}'".format(len(trace["time"]), device_id),
+                # samples for which the device was not simulated are NaN, which is not valid JSON
+                "data": {key: [None if isinstance(value, float) and math.isnan(value) else value
+                               for value in values.tolist()]
+                         for key, values in trace.items()}
+            }
+            return make_response(jsonify(resp), status.HTTP_200_OK)
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @device_blueprint.route('/energy', methods=['GET', 'POST'])
 @jwt_required
 def get_device_energy():
@@ -723,7 +1006,7 @@ def get_device_consumption():
             }
             return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
 
-        with session_scope() as session:
+        with read_session_scope() as session:
             device = device_service.get_device(username, device_id, session)
             if device is None:
                 resp = {
@@ -771,6 +1054,147 @@ def get_device_consumption():
         return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@device_blueprint.route('/export', methods=['POST'])
+@jwt_required
+def export_device_consumption():
+    """
+    export the raw consumption data of the user's devices over a time range as a columnar binary file
+    """
+    try:
+        username = get_jwt_identity()
+        req_params = AttrDict(json.loads(request.data)) if request.data else AttrDict({})
+        file_format = req_params.get("format", "npz")
+        file_path = params.model.output_dir + "export_" + uuid.uuid4().hex + "." + file_format
+
+        with read_session_scope() as session:
+            is_done, result = device_service.export_consumption(req_params, file_path, session, username)
+        if not is_done:
+            return make_response(jsonify(result), status.HTTP_400_BAD_REQUEST)
+
+        @after_this_request
+        def remove_file(response):
+            try:
+                os.remove(file_path)
+            except OSError as e:
+                LOGGER.error(e)
+            return response
+
+        response = send_file(file_path, mimetype="application/octet-stream", as_attachment=True,
+                             attachment_filename="consumption." + file_format)
+        response.headers["X-Row-Count"] = str(result)
+        return response
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@device_blueprint.route('/batch', methods=['POST'])
+@jwt_required
+def run_batch_simulation():
+    """
+    simulate a set of devices over a given horizon as fast as possible and return the resulting traces.
+    with 'store' set, the batch runs in a separate process instead, whose traces are fetched with the returned url
+    """
+    try:
+        username = get_jwt_identity()
+        req_params = AttrDict(json.loads(request.data))
+        store = bool(req_params.get("store", False))
+
+        if not store and float(req_params.get("horizon", 0)) > params.batch.max_response_horizon:
+            resp = {
+                "status": "error",
+                "msg": "horizon longer than {} seconds must be run with 'store' enabled".format(
+                    params.batch.max_response_horizon)
+            }
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        with session_scope() as session:
+            max_devices = user_service.get_user(username, session).max_devices
+        is_valid, resp = device_service.check_batch_limits(req_params, max_devices, params.batch.max_horizon)
+        if not is_valid:
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        if store:
+            is_done, result = device_service.start_batch_job(req_params, username)
+            if not is_done:
+                return make_response(jsonify(result), status.HTTP_400_BAD_REQUEST)
+            resp = {
+                "status": "success",
+                "msg": "started batch simulation of {} devices".format(len(req_params.devices)),
+                "data": {"job_id": result, "url": url_for('.get_batch_simulation', job_id=result)}
+            }
+            return make_response(jsonify(resp), status.HTTP_202_ACCEPTED)
+
+        is_done, result = device_service.run_batch_simulation(req_params)
+        if not is_done:
+            return make_response(jsonify(result), status.HTTP_400_BAD_REQUEST)
+
+        resp = {
+            "status": "success",
+            "msg": "simulated {} devices over {} steps".format(len(result["device_id"]), len(result["time"])),
+            "data": batch_simulator.serialize_traces(result)
+        }
+        return make_response(jsonify(resp), status.HTTP_200_OK)
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@device_blueprint.route('/batch/<job_id>', methods=['GET'])
+@jwt_required
+def get_batch_simulation(job_id):
+    """
+    download the traces of a batch simulation started with 'store' enabled, as a numpy archive. the traces can be
+    downloaded once, after which the job is removed
+    """
+    try:
+        username = get_jwt_identity()
+        job = device_service.get_batch_job(job_id, username)
+        if job is None:
+            resp = {
+                "status": "error",
+                "msg": "batch simulation '{}' not found".format(job_id)
+            }
+            return make_response(jsonify(resp), status.HTTP_404_NOT_FOUND)
+
+        state, result = job
+        if state == batch_jobs.RUNNING:
+            resp = {
+                "status": "success",
+                "msg": "batch simulation '{}' is running".format(job_id),
+                "data": {"state": state}
+            }
+            return make_response(jsonify(resp), status.HTTP_202_ACCEPTED)
+        if state == batch_jobs.FAILED:
+            device_service.remove_batch_job(job_id)
+            resp = {
+                "status": "error",
+                "msg": "batch simulation '{}' failed: {}".format(job_id, result),
+                "data": {"state": state}
+            }
+            return make_response(jsonify(resp), status.HTTP_400_BAD_REQUEST)
+
+        @after_this_request
+        def remove_job(response):
+            device_service.remove_batch_job(job_id)
+            return response
+
+        return send_file(result, mimetype="application/octet-stream", as_attachment=True,
+                         attachment_filename="batch_" + job_id + ".npz")
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @device_blueprint.route('/restore_device_simulations', methods=['POST'])
 @admin_required
 def restore_device_simulations():
@@ -829,6 +1253,30 @@ def find_interrupted_device_simulations():
         return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@device_blueprint.route('/memory', methods=['GET'])
+@admin_required
+def get_memory_usage():
+    """
+
+    :return: memory held by the process and by each running device simulation
+    """
+    try:
+        memory_usage = device_service.get_memory_usage()
+
+        resp = {
+            "status": "success",
+            "msg": "memory usage of {} running simulations".format(memory_usage["running_simulations"]),
+            "data": memory_usage
+        }
+        return make_response(jsonify(resp), status.HTTP_200_OK)
+    except Exception as e:
+        resp = {
+            "status": "error",
+            "msg": "%s" % str(e)
+        }
+        return make_response(jsonify(resp), status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 @device_blueprint.route('/deactivate', methods=['POST'])
 @jwt_required
 def deactivate_device():
@@ -11,6 +11,7 @@ from flask_jwt_extended import (
 
 from api_auth import *
 from app.data.database import session_scope
+from app.data.replica import read_session_scope
 from app.service.device_service import DeviceService
 from app.service.user_service import UserService
 from app.util.app_config import blacklist
@@ -368,10 +369,7 @@ def delete_user():
         username = get_jwt_identity()
 
         with session_scope() as session:
-            devices = user_service.get_devices(username, session)
-
-            for device in devices:
-                device_service.delete_device(username, device.device_id, session)
+            device_service.delete_all_devices(username, session)
 
             is_deleted = user_service.delete_user(username, session)
             if not is_deleted:
@@ -403,7 +401,7 @@ def get_all_users():
 
     try:
 
-        with session_scope() as session:
+        with read_session_scope() as session:
             users = user_service.get_all_users(session)
 
             if not len(users) > 0:
@@ -416,7 +414,7 @@ def get_all_users():
             resp = {
                 "status": "success",
                 "msg": "found {} users".format(len(users)),
-                "data": [user.serialize() for user in users]
+                "data": user_service.serialize_users(users, session)
             }
             return make_response(jsonify(resp), status.HTTP_200_OK)
     except Exception as e:
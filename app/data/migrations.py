@@ -0,0 +1,303 @@
+import logging
+
+from sqlalchemy import inspect
+
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly, DeviceConsumptionDaily
+
+LOGGER = logging.getLogger(__name__)
+
+# table holding the revision of the last applied migration
+VERSION_TABLE = "schema_version"
+
+
+class Migration:
+    """This class describes a single step in the history of the database schema"""
+
+    def __init__(self, revision, down_revision, description, upgrade, downgrade):
+        """
+
+        :param revision: unique id of this migration
+        :param down_revision: id of the migration this one builds upon (None for the first one)
+        :param description:
+        :param upgrade: function taking a session, which applies the migration
+        :param downgrade: function taking a session, which reverts the migration
+        """
+        self.revision = revision
+        self.down_revision = down_revision
+        self.description = description
+        self.upgrade = upgrade
+        self.downgrade = downgrade
+
+    def serialize(self):
+        return {
+            "revision": self.revision,
+            "down_revision": self.down_revision,
+            "description": self.description
+        }
+
+    def __repr__(self):
+        return "<%s(revision='%s', description='%s')>" % (self.__class__.__name__, self.revision, self.description)
+
+
+#
+# helpers for online-safe schema changes. all of them are idempotent, since a fresh database is created from the
+# models and hence already has the schema that the migrations build up
+#
+
+def is_mysql(session):
+    return session.get_bind().dialect.name == "mysql"
+
+
+def online_ddl(session):
+    """
+    :return: clause that makes MySQL alter the table in place without blocking concurrent reads and writes
+    """
+    return ", ALGORITHM=INPLACE, LOCK=NONE" if is_mysql(session) else ""
+
+
+def has_column(session, table, column):
+    return column in [col['name'] for col in inspect(session.get_bind()).get_columns(table)]
+
+
+def has_index(session, table, name):
+    return name in [index['name'] for index in inspect(session.get_bind()).get_indexes(table)]
+
+
+def add_column(session, table, column, definition):
+    if has_column(session, table, column):
+        return
+    LOGGER.info("Adding column '%s' to table '%s'" % (column, table))
+    session.execute("ALTER TABLE {} ADD COLUMN {} {}{}".format(table, column, definition, online_ddl(session)))
+
+
+def drop_column(session, table, column):
+    if not has_column(session, table, column):
+        return
+    LOGGER.info("Dropping column '%s' from table '%s'" % (column, table))
+    session.execute("ALTER TABLE {} DROP COLUMN {}{}".format(table, column, online_ddl(session)))
+
+
+def create_index(session, table, name, columns, unique=False):
+    if has_index(session, table, name):
+        return
+    LOGGER.info("Creating index '%s' on table '%s'" % (name, table))
+    kind = "UNIQUE INDEX" if unique else "INDEX"
+    if is_mysql(session):
+        session.execute("ALTER TABLE {} ADD {} {} ({}){}".format(table, kind, name, ", ".join(columns),
+                                                                  online_ddl(session)))
+    else:
+        session.execute("CREATE {} {} ON {} ({})".format(kind, name, table, ", ".join(columns)))
+
+
+def set_foreign_key_on_delete(session, table, column, referred_table, on_delete):
+    """
+    recreate the foreign key of the given column with another ON DELETE action (MySQL only, as other dialects
+    cannot alter foreign keys in place)
+    """
+    if not is_mysql(session):
+        LOGGER.warn("Cannot change the foreign key of '%s.%s' on this database" % (table, column))
+        return
+    for foreign_key in inspect(session.get_bind()).get_foreign_keys(table):
+        if foreign_key['constrained_columns'] != [column] or foreign_key['referred_table'] != referred_table:
+            continue
+        if (foreign_key['options'].get('ondelete') or "").upper() == (on_delete or ""):
+            return
+        LOGGER.info("Changing the foreign key '%s' of table '%s'" % (foreign_key['name'], table))
+        # foreign keys can only be changed in place with foreign key checks off. existing rows are valid already
+        session.execute("SET foreign_key_checks = 0")
+        try:
+            session.execute("ALTER TABLE {0} DROP FOREIGN KEY {1}, ADD CONSTRAINT {1} FOREIGN KEY ({2}) "
+                            "REFERENCES {3} (id){4}{5}".format(table, foreign_key['name'], column, referred_table,
+                                                              " ON DELETE " + on_delete if on_delete else "",
+                                                              online_ddl(session)))
+        finally:
+            session.execute("SET foreign_key_checks = 1")
+
+
+def drop_index(session, table, name):
+    if not has_index(session, table, name):
+        return
+    LOGGER.info("Dropping index '%s' from table '%s'" % (name, table))
+    if is_mysql(session):
+        session.execute("ALTER TABLE {} DROP INDEX {}{}".format(table, name, online_ddl(session)))
+    else:
+        session.execute("DROP INDEX {}".format(name))
+
+
+#
+# migrations
+#
+
+def upgrade_0001(session):
+    create_index(session, "device", "ix_device_device_id", ["device_id"])
+    create_index(session, "device", "ix_device_user_id_device_id", ["user_id", "device_id"])
+
+
+def downgrade_0001(session):
+    drop_index(session, "device", "ix_device_user_id_device_id")
+    drop_index(session, "device", "ix_device_device_id")
+
+
+def upgrade_0002(session):
+    create_index(session, "device_consumption", "ix_device_consumption_device_id_timestamp",
+                 ["device_id", "timestamp"])
+    create_index(session, "device_consumption", "ix_device_consumption_timestamp", ["timestamp"])
+    for model in (DeviceConsumptionHourly, DeviceConsumptionDaily):
+        model.__table__.create(bind=session.get_bind(), checkfirst=True)
+
+
+def downgrade_0002(session):
+    for model in (DeviceConsumptionDaily, DeviceConsumptionHourly):
+        model.__table__.drop(bind=session.get_bind(), checkfirst=True)
+    drop_index(session, "device_consumption", "ix_device_consumption_timestamp")
+    drop_index(session, "device_consumption", "ix_device_consumption_device_id_timestamp")
+
+
+# tables whose rows are deleted together with their device
+DEVICE_CHILD_TABLES = ["device_consumption", "device_consumption_hourly", "device_consumption_daily", "device_model"]
+
+
+def upgrade_0003(session):
+    for table in DEVICE_CHILD_TABLES:
+        set_foreign_key_on_delete(session, table, "device_id", "device", "CASCADE")
+
+
+def downgrade_0003(session):
+    for table in DEVICE_CHILD_TABLES:
+        set_foreign_key_on_delete(session, table, "device_id", "device", None)
+
+
+def upgrade_0004(session):
+    for table in ("device_consumption_hourly", "device_consumption_daily"):
+        add_column(session, table, "source_max_id", "BIGINT NULL")
+
+
+def downgrade_0004(session):
+    for table in ("device_consumption_hourly", "device_consumption_daily"):
+        drop_column(session, table, "source_max_id")
+
+
+# all migrations, oldest first
+MIGRATIONS = [
+    Migration("0001", None, "indexes for lookups of devices by id and by owner and id", upgrade_0001, downgrade_0001),
+    Migration("0002", "0001", "hourly and daily consumption aggregates", upgrade_0002, downgrade_0002),
+    Migration("0003", "0002", "delete the consumption data and model of a device with it", upgrade_0003,
+              downgrade_0003),
+    Migration("0004", "0003", "highest source row id of consumption aggregates", upgrade_0004, downgrade_0004),
+]
+
+
+#
+# running migrations
+#
+
+def find_migration(revision):
+    """
+    :return: position of the migration with the given revision, -1 for None (i.e., the empty schema)
+    :raise ValueError: if there is no such migration
+    """
+    if revision is None:
+        return -1
+    for i, migration in enumerate(MIGRATIONS):
+        if migration.revision == revision:
+            return i
+    raise ValueError("unknown revision '%s'. valid revisions are: %s"
+                     % (revision, ", ".join(migration.revision for migration in MIGRATIONS)))
+
+
+def current_revision(session):
+    """
+    :return: revision of the last applied migration, or None if no migration is applied yet
+    """
+    session.execute("CREATE TABLE IF NOT EXISTS {} (version_num VARCHAR(32) NOT NULL PRIMARY KEY)"
+                    .format(VERSION_TABLE))
+    row = session.execute("SELECT version_num FROM {}".format(VERSION_TABLE)).first()
+    return row[0] if row is not None else None
+
+
+def set_revision(session, revision):
+    session.execute("DELETE FROM {}".format(VERSION_TABLE))
+    if revision is not None:
+        session.execute("INSERT INTO {} (version_num) VALUES (:revision)".format(VERSION_TABLE),
+                        {"revision": revision})
+    session.commit()
+
+
+def pending_migrations(session):
+    return MIGRATIONS[find_migration(current_revision(session)) + 1:]
+
+
+def upgrade(session, revision=None):
+    """
+
+    apply all migrations up to (and including) the given revision
+
+    :param session:
+    :param revision: target revision, the latest if None
+    :return: list of applied migrations
+    """
+    target = find_migration(revision) if revision is not None else len(MIGRATIONS) - 1
+    applied = []
+    for migration in MIGRATIONS[find_migration(current_revision(session)) + 1:target + 1]:
+        LOGGER.info("Upgrading schema to revision '%s': %s" % (migration.revision, migration.description))
+        migration.upgrade(session)
+        session.commit()
+        set_revision(session, migration.revision)
+        applied.append(migration)
+    return applied
+
+
+def downgrade(session, revision):
+    """
+
+    revert all migrations after the given revision
+
+    :param session:
+    :param revision: target revision, 'base' to revert all migrations
+    :return: list of reverted migrations
+    """
+    target = find_migration(None if revision == "base" else revision)
+    reverted = []
+    for migration in reversed(MIGRATIONS[target + 1:find_migration(current_revision(session)) + 1]):
+        LOGGER.info("Downgrading schema from revision '%s': %s" % (migration.revision, migration.description))
+        migration.downgrade(session)
+        session.commit()
+        set_revision(session, migration.down_revision)
+        reverted.append(migration)
+    return reverted
+
+
+def run_command(session, action, revision=None):
+    """
+
+    run a migration command given on the command line
+
+    :param session:
+    :param action: one of 'upgrade', 'downgrade', 'current', 'history'
+    :param revision: target revision for 'upgrade' and 'downgrade'
+    :return: True if the command succeeded else False
+    """
+    try:
+        if action == "upgrade":
+            applied = upgrade(session, revision)
+            LOGGER.info("Applied %d migrations, schema is at revision '%s'" % (len(applied), current_revision(session)))
+        elif action == "downgrade":
+            if revision is None:
+                LOGGER.error("downgrade requires a target revision (or 'base')")
+                return False
+            reverted = downgrade(session, revision)
+            LOGGER.info("Reverted %d migrations, schema is at revision '%s'"
+                        % (len(reverted), current_revision(session)))
+        elif action == "current":
+            LOGGER.info("Schema is at revision '%s', %d migrations pending"
+                        % (current_revision(session), len(pending_migrations(session))))
+        elif action == "history":
+            for migration in MIGRATIONS:
+                LOGGER.info("%s -> %s: %s" % (migration.down_revision, migration.revision, migration.description))
+        else:
+            LOGGER.error("unknown migration command '%s'" % action)
+            return False
+    except ValueError as e:
+        LOGGER.error(e)
+        return False
+    return True
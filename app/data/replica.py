@@ -0,0 +1,108 @@
+import itertools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.data.database import session_scope
+from app.util.app_config import params
+
+LOGGER = logging.getLogger(__name__)
+
+# engines of the read replicas, set up by configure()
+replicas = []
+# number of picks so far, the replica tried first moves on by one with every pick
+round_robin = None
+lock = threading.Lock()
+
+
+class Replica:
+    """This class holds the engine of a read replica, and how far it was behind the primary when last checked"""
+
+    def __init__(self, url):
+        self.url = url
+        self.engine = create_engine(url, pool_pre_ping=True, pool_recycle=3600)
+        self.Session = sessionmaker(bind=self.engine)
+        self.lag = None
+        self.checked_at = 0
+        self.check_lock = threading.Lock()
+
+    def is_fresh(self, max_lag, check_interval):
+        """
+        :return: whether the replica is reachable and at most max_lag seconds behind the primary. the lag is queried
+                 at most every check_interval seconds, by a single request thread and without holding the lock of
+                 the round robin, while the others use the last known lag
+        """
+        if time.time() - self.checked_at >= check_interval and self.check_lock.acquire(False):
+            try:
+                self.checked_at = time.time()
+                self.lag = self.query_lag()
+            except Exception as e:
+                LOGGER.warn("Replica '%s' is not available: %s" % (self.engine.url.host, e))
+                self.lag = None
+            finally:
+                self.check_lock.release()
+        return self.lag is not None and self.lag <= max_lag
+
+    def query_lag(self):
+        """
+        :return: seconds the replica is behind the primary, or None if replication is not running
+        """
+        if self.engine.dialect.name != "mysql":
+            # the lag cannot be queried, so the replica is assumed to be up to date if it can be reached
+            self.engine.execute("SELECT 1")
+            return 0
+        row = self.engine.execute("SHOW SLAVE STATUS").first()
+        if row is None:
+            return None
+        return row["Seconds_Behind_Master"]
+
+
+def configure(urls):
+    """
+    :param urls: list of urls of the read replicas of the db (empty to read from the primary only)
+    """
+    global replicas, round_robin
+    with lock:
+        replicas = [Replica(url) for url in urls]
+        round_robin = itertools.count() if len(replicas) > 0 else None
+    if len(replicas) > 0:
+        LOGGER.info("Routing read-only queries to %d replicas" % len(replicas))
+
+
+def pick_replica():
+    """
+    :return: the next replica within the staleness budget, or None if there is none
+    """
+    with lock:
+        if len(replicas) == 0:
+            return None
+        start = next(round_robin) % len(replicas)
+        candidates = replicas[start:] + replicas[:start]
+    for replica in candidates:
+        if replica.is_fresh(params.replica.max_lag, params.replica.lag_check_interval):
+            return replica
+    return None
+
+
+@contextmanager
+def read_session_scope():
+    """
+    session for read-only queries, which is bound to a replica within the staleness budget, or to the primary if
+    there is none. the session is never committed, so nothing written through it is kept
+    """
+    replica = pick_replica()
+    if replica is None:
+        with session_scope() as session:
+            yield session
+        return
+
+    session = replica.Session()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
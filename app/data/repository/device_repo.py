@@ -1,11 +1,20 @@
 import logging
 
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
+
 from app.data.model.device import Device
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly, DeviceConsumptionDaily
+from app.data.model.device_model import DeviceModel
 from app.data.model.device_type_enum import DeviceTypeEnum
 from app.data.repository import user_repo
 
 LOGGER = logging.getLogger(__name__)
 
+# rows deleted per statement when tearing down devices
+DELETE_BATCH_SIZE = 5000
+
 
 def add_device(username, device_name, session):
     """
@@ -28,6 +37,33 @@ def add_device(username, device_name, session):
     return new_device
 
 
+def add_devices(username, devices, device_state, session):
+    """
+
+    Creates and saves a batch of new devices together with their models, in a single transaction
+
+    :param username: the user that owns the devices
+    :param devices: list of (device_name, model_name, model_params)
+    :param device_state: state of the new devices
+    :param session:
+    :return: the new devices
+    """
+
+    user = user_repo.find_by_username(username, session)
+
+    new_devices = []
+    for device_name, model_name, model_params in devices:
+        new_device = Device(device_name)
+        new_device.device_state = device_state
+        new_device.device_model = DeviceModel(model_name, model_params)
+        new_device.user_id = user.id
+        new_devices.append(new_device)
+    session.add_all(new_devices)
+    session.commit()
+
+    return new_devices
+
+
 def find_device_by_id(device_id, session):
     """
 
@@ -38,38 +74,96 @@ def find_device_by_id(device_id, session):
     :return:
     """
 
-    devices = session.query(Device).filter(Device.device_id == device_id).all()
+    devices = session.query(Device).options(joinedload(Device.device_model)) \
+        .filter(Device.device_id == device_id).all()
     return devices[0] if len(devices) > 0 else None
 
 
 def find_all(session):
     """
 
-    Fetches all devices for all users
+    Fetches all devices for all users, together with their models
 
     :return: all devices in db
     """
 
-    devices = session.query(Device).all()
+    devices = session.query(Device).options(joinedload(Device.device_model)).all()
     return devices
 
 
 def find_active(session):
     """
 
-    Fetches active devices for all users
+    Fetches active devices for all users, together with their models
 
     :return: all active devices in db
     """
 
-    devices = session.query(Device).filter(Device.device_state != DeviceTypeEnum.INACTIVE).all()
+    devices = session.query(Device).options(joinedload(Device.device_model)) \
+        .filter(Device.device_state != DeviceTypeEnum.INACTIVE).all()
+    return devices
+
+
+def find_active_by_ids(device_ids, session):
+    """
+
+    Fetches the active devices among the given ones, together with their models
+
+    :param device_ids:
+    :param session:
+    :return: active devices in db
+    """
+
+    if len(device_ids) == 0:
+        return []
+
+    devices = session.query(Device).options(joinedload(Device.device_model)) \
+        .filter(Device.device_id.in_(device_ids)) \
+        .filter(Device.device_state != DeviceTypeEnum.INACTIVE).all()
     return devices
 
 
+def count_simulated(session):
+    """
+
+    Counts the devices that are to be simulated, i.e., active devices that have a model
+
+    :param session:
+    :return: number of devices
+    """
+
+    return session.query(func.count(Device.id)).join(Device.device_model) \
+        .filter(Device.device_state != DeviceTypeEnum.INACTIVE).scalar()
+
+
+def find_simulated_ids(session, batch_size=10000):
+    """
+
+    Fetches the ids of the devices that are to be simulated, in batches ordered by primary key (keyset pagination),
+    so that no batch scans the rows of the previous ones
+
+    :param session:
+    :param batch_size:
+    :return: generator of device_ids
+    """
+
+    last_id = 0
+    while True:
+        rows = session.query(Device.id, Device.device_id).join(Device.device_model) \
+            .filter(Device.device_state != DeviceTypeEnum.INACTIVE).filter(Device.id > last_id) \
+            .order_by(Device.id).limit(batch_size).all()
+        for row in rows:
+            yield row[1]
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1][0]
+
+
 def find_device(session, username, device_id=None, serialize=False):
     """
 
-    Fetches a single device if device_id is supplied, else fetches all devices for the given user
+    Fetches a single device if device_id is supplied, else fetches all devices for the given user, together with
+    their models
 
     :param session:
     :param username:
@@ -80,10 +174,12 @@ def find_device(session, username, device_id=None, serialize=False):
 
     user = user_repo.find_by_username(username, session)
 
+    # models are loaded in the same query, since serializing a device touches its model
+    query = session.query(Device).options(joinedload(Device.device_model)).filter(Device.user_id == user.id)
     if device_id is None:
-        devices = session.query(Device).filter(Device.user_id == user.id).order_by(Device.device_name).all()
+        devices = query.order_by(Device.device_name).all()
     else:
-        devices = session.query(Device).filter(Device.user_id == user.id).filter(Device.device_id == device_id).all()
+        devices = query.filter(Device.device_id == device_id).all()
 
     if serialize:
         return [device.serialize() for device in devices]
@@ -136,23 +232,40 @@ def delete_device(username, device_id, session):
     if user is None:
         return False
 
-    device = find_device(session, username, device_id)[0]
+    devices = find_device(session, username, device_id)
+    if len(devices) == 0:
+        return False
 
-    # first approach (first delete related tables (relationships, foreign keys etc)
-    device.roles = None
-    device.consumption = []
-    device.device_model = None
-    session.commit()
-    items_deleted = session.query(Device).filter(Device.user_id == user.id) \
-        .filter(Device.device_id == device_id).delete()
+    return delete_devices([devices[0].id], session) > 0
 
-    # # second approach (neater)
-    # user = session.query(User).filter(User.id == user_id).all()[0]
-    # user.devices.remove(device)
 
-    session.commit()
+def delete_devices(ids, session, batch_size=DELETE_BATCH_SIZE):
+    """
 
-    return items_deleted > 0
+    Delete devices together with their consumption data and models, with bulk deletes in the db instead of loading
+    the rows into the session. rows are deleted in bounded batches, all within a single transaction
+
+    :param ids: primary keys of the devices
+    :param session:
+    :param batch_size: number of rows per delete statement
+    :return: number of deleted devices
+    """
+
+    items_deleted = 0
+    for i in range(0, len(ids), batch_size):
+        device_ids = ids[i:i + batch_size]
+        for child in (DeviceConsumption, DeviceConsumptionHourly, DeviceConsumptionDaily):
+            while True:
+                child_ids = [row[0] for row in session.query(child.id).filter(child.device_id.in_(device_ids))
+                             .limit(batch_size).all()]
+                if len(child_ids) == 0:
+                    break
+                session.query(child).filter(child.id.in_(child_ids)).delete(synchronize_session=False)
+        session.query(DeviceModel).filter(DeviceModel.device_id.in_(device_ids)).delete(synchronize_session=False)
+        items_deleted += session.query(Device).filter(Device.id.in_(device_ids)).delete(synchronize_session=False)
+
+    session.commit()
+    return items_deleted
 
 
 def add_device_model(device, model, session):
@@ -201,6 +314,22 @@ def update_device_model(device, new_model, session):
     return device
 
 
+def update_device_params(devices, model_params, session):
+    """
+
+    Update the parameters of the models of the given devices in place, in a single transaction
+
+    :param devices:
+    :param model_params: list of new parameters, one per device
+    :param session:
+    :return:
+    """
+
+    for device, new_params in zip(devices, model_params):
+        device.device_model.params = dict(new_params)
+    session.commit()
+
+
 def add_device_consumption(device, value, session):
     """
 
@@ -230,9 +359,25 @@ def get_device_consumption(username, device_id, session):
         return False
 
     device = find_device(session, user.username, device_id)[0]
-    consumption = [con.serialize() for con in device.consumption]
 
-    return consumption
+    return get_consumption(device)
+
+
+def get_consumption(device):
+    """
+
+    Fetches the consumption data for the given device from all tiers: daily and hourly aggregates for the periods
+    whose raw rows are rolled up, and the raw rows for the rest. the tiers cover consecutive periods of time
+
+    :param device:
+    :return: list of consumption records as dictionaries, oldest first
+    """
+
+    daily = device.consumption_daily.order_by(DeviceConsumptionDaily.period_start).all()
+    hourly = device.consumption_hourly.order_by(DeviceConsumptionHourly.period_start).all()
+    raw = device.consumption.order_by(DeviceConsumption.timestamp).all()
+
+    return [row.serialize() for row in daily] + [row.serialize() for row in hourly] + [row.serialize() for row in raw]
 
 
 def set_device_state(device, new_state, session):
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Enum
+from sqlalchemy import Column, String, Integer, ForeignKey, Enum, Index
 from sqlalchemy.orm import relationship
 import uuid
 
@@ -8,6 +8,10 @@ from app.data.model.device_type_enum import DeviceTypeEnum
 
 class Device(Base):
     __tablename__ = "device"
+    __table_args__ = (
+        Index('ix_device_device_id', 'device_id'),
+        Index('ix_device_user_id_device_id', 'user_id', 'device_id'),
+    )
 
     id = Column('id', Integer, primary_key=True, autoincrement=True)
     device_name = Column('device_name', String(200))
@@ -18,15 +22,26 @@ class Device(Base):
     user_id = Column(Integer, ForeignKey("user.id"), nullable=False)
 
     consumption = relationship('DeviceConsumption', cascade="all, delete, delete-orphan", backref="device",
-                               primaryjoin="Device.id==DeviceConsumption.device_id", lazy="dynamic")
+                               primaryjoin="Device.id==DeviceConsumption.device_id", lazy="dynamic",
+                               passive_deletes=True)
 
-    device_model = relationship('DeviceModel', uselist=False, back_populates="device")
+    # consumption older than the retention period of the raw rows, aggregated per hour and per day
+    consumption_hourly = relationship('DeviceConsumptionHourly', cascade="all, delete, delete-orphan",
+                                      primaryjoin="Device.id==DeviceConsumptionHourly.device_id", lazy="dynamic",
+                                      passive_deletes=True)
+    consumption_daily = relationship('DeviceConsumptionDaily', cascade="all, delete, delete-orphan",
+                                     primaryjoin="Device.id==DeviceConsumptionDaily.device_id", lazy="dynamic",
+                                     passive_deletes=True)
+
+    device_model = relationship('DeviceModel', uselist=False, back_populates="device", passive_deletes=True)
 
     def __init__(self, device_name):
         self.device_id = uuid.uuid4().hex
         self.device_name = device_name
         self.device_state = DeviceTypeEnum.INACTIVE
         self.consumption = []
+        self.consumption_hourly = []
+        self.consumption_daily = []
 
     def serialize(self):
         return {
@@ -1,17 +1,21 @@
-from sqlalchemy import Column, Integer, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, Float, Boolean, DateTime, ForeignKey, Index
 
 from app.data.database import Base
 
 
 class DeviceConsumption(Base):
     __tablename__ = "device_consumption"
+    __table_args__ = (
+        Index('ix_device_consumption_device_id_timestamp', 'device_id', 'timestamp'),
+        Index('ix_device_consumption_timestamp', 'timestamp'),
+    )
 
     id = Column('id', Integer, primary_key=True, autoincrement=True)
     power = Column('power', Float)
     energy = Column('energy', Float)
     status = Column('state', Boolean)
     timestamp = Column('timestamp', DateTime)
-    device_id = Column('device_id', Integer, ForeignKey("device.id"), nullable=False)
+    device_id = Column('device_id', Integer, ForeignKey("device.id", ondelete="CASCADE"), nullable=False)
 
     def __init__(self, power, energy, status, timestamp):
         self.power = power
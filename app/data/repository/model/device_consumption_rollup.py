@@ -0,0 +1,66 @@
+from sqlalchemy import Column, Integer, BigInteger, Float, DateTime, ForeignKey, Index
+
+from app.data.database import Base
+
+
+class DeviceConsumptionHourly(Base):
+    __tablename__ = "device_consumption_hourly"
+    __table_args__ = (
+        Index('uq_device_consumption_hourly_device_id_period', 'device_id', 'period_start', unique=True),
+    )
+
+    id = Column('id', Integer, primary_key=True, autoincrement=True)
+    period_start = Column('period_start', DateTime, nullable=False)
+    samples = Column('samples', Integer, nullable=False)
+    on_samples = Column('on_samples', Integer, nullable=False)
+    power_avg = Column('power_avg', Float)
+    power_max = Column('power_max', Float)
+    energy = Column('energy', Float)  # last energy reading within the period
+    source_max_id = Column('source_max_id', BigInteger)  # highest id of the rows the aggregate includes
+    device_id = Column('device_id', Integer, ForeignKey("device.id", ondelete="CASCADE"), nullable=False)
+
+    def serialize(self):
+        return serialize_rollup(self, "hour")
+
+    def __repr__(self):
+        return "<%s(device_id='%s', period_start='%s', samples='%s', power_avg='%s', energy='%s')>" % (
+            self.__class__.__name__, self.device_id, self.period_start, self.samples, self.power_avg, self.energy)
+
+
+class DeviceConsumptionDaily(Base):
+    __tablename__ = "device_consumption_daily"
+    __table_args__ = (
+        Index('uq_device_consumption_daily_device_id_period', 'device_id', 'period_start', unique=True),
+    )
+
+    id = Column('id', Integer, primary_key=True, autoincrement=True)
+    period_start = Column('period_start', DateTime, nullable=False)
+    samples = Column('samples', Integer, nullable=False)
+    on_samples = Column('on_samples', Integer, nullable=False)
+    power_avg = Column('power_avg', Float)
+    power_max = Column('power_max', Float)
+    energy = Column('energy', Float)  # last energy reading within the period
+    source_max_id = Column('source_max_id', BigInteger)  # highest id of the rows the aggregate includes
+    device_id = Column('device_id', Integer, ForeignKey("device.id", ondelete="CASCADE"), nullable=False)
+
+    def serialize(self):
+        return serialize_rollup(self, "day")
+
+    def __repr__(self):
+        return "<%s(device_id='%s', period_start='%s', samples='%s', power_avg='%s', energy='%s')>" % (
+            self.__class__.__name__, self.device_id, self.period_start, self.samples, self.power_avg, self.energy)
+
+
+def serialize_rollup(rollup, resolution):
+    """
+    serialize an aggregate with the keys of a raw consumption row, plus the details of the aggregate
+    """
+    return {
+        "power": rollup.power_avg,
+        "energy": rollup.energy,
+        "status": rollup.on_samples > 0,
+        "timestamp": rollup.period_start,
+        "power_max": rollup.power_max,
+        "samples": rollup.samples,
+        "resolution": resolution
+    }
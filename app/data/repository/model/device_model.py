@@ -12,7 +12,7 @@ class DeviceModel(Base):
     params = Column('params', JSON)
 
     # one-to-one relationship with Device
-    device_id = Column(Integer, ForeignKey('device.id'))
+    device_id = Column(Integer, ForeignKey('device.id', ondelete='CASCADE'))
     device = relationship("Device", back_populates='device_model')
 
     def __init__(self, model_name, params):
@@ -1,5 +1,5 @@
 from sqlalchemy import Column, String, Integer, ForeignKey
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, joinedload
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_security import UserMixin
 
@@ -49,7 +49,18 @@ class User(Base, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.pwd_hash, password)
 
-    def serialize(self):
+    def serialize(self, no_of_devices=None, devices=None):
+        """
+
+        :param no_of_devices: number of devices of the user if already known, e.g., from an aggregate query
+        :param devices: devices of the user (with their models) if already loaded
+        :return:
+        """
+        if no_of_devices is None:
+            no_of_devices = self.devices.count()
+        if devices is None and 0 < no_of_devices < 5:
+            devices = self.devices.options(joinedload('device_model')).all()
+
         return {
             "id": self.id,
             "username": self.username,
@@ -57,10 +68,10 @@ class User(Base, UserMixin):
             "last_name": self.last_name,
             "email": self.email,
             "roles": [role.serialize() for role in self.roles],
-            "no_of_devices": self.devices.count(),
+            "no_of_devices": no_of_devices,
             "max_devices": self.max_devices,
-            "devices": [device.serialize() for device in self.devices]
-            if 0 < self.devices.count() < 5 else ["total {} devices".format(self.devices.count())]
+            "devices": [device.serialize() for device in devices]
+            if 0 < no_of_devices < 5 else ["total {} devices".format(no_of_devices)]
         }
 
     def __repr__(self):
@@ -1,5 +1,9 @@
 import logging
 
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+
+from app.data.model.device import Device
 from app.data.model.role_type_enum import RoleTypeEnum
 from app.data.model.user import User
 from app.data.model.user_role import Role
@@ -39,17 +43,62 @@ def find_user(session, user_id=None, serialize=False):
     :return: single user if id specified else all users
     """
 
+    query = session.query(User).options(selectinload(User.roles))
     if user_id is None:
-        users = session.query(User).order_by(User.first_name).all()
+        users = query.order_by(User.first_name).all()
     else:
-        users = session.query(User).filter(User.id == user_id).all()
+        users = query.filter(User.id == user_id).all()
 
     if serialize:
-        return [user.serialize() for user in users]
+        return serialize_users(users, session)
     else:
         return users
 
 
+def count_devices(session, user_ids=None):
+    """
+
+    Counts the devices of many users in a single aggregate query
+
+    :param session:
+    :param user_ids: the users whose devices to count, all users if None
+    :return: dictionary of user id -> number of devices (users without devices are left out)
+    """
+
+    query = session.query(Device.user_id, func.count(Device.id)).group_by(Device.user_id)
+    if user_ids is not None:
+        query = query.filter(Device.user_id.in_(user_ids))
+
+    return dict(query.all())
+
+
+def serialize_users(users, session):
+    """
+
+    Serializes a list of users with a fixed number of queries, independent of the number of users and devices
+
+    :param users:
+    :param session:
+    :return: list of users as dictionaries
+    """
+
+    if len(users) == 0:
+        return []
+
+    device_counts = count_devices(session, [user.id for user in users])
+
+    # only users with few devices have their devices listed
+    listed_user_ids = [user.id for user in users if 0 < device_counts.get(user.id, 0) < 5]
+    listed_devices = {user_id: [] for user_id in listed_user_ids}
+    if len(listed_user_ids) > 0:
+        devices = session.query(Device).options(joinedload(Device.device_model)) \
+            .filter(Device.user_id.in_(listed_user_ids)).order_by(Device.device_name).all()
+        for device in devices:
+            listed_devices[device.user_id].append(device)
+
+    return [user.serialize(device_counts.get(user.id, 0), listed_devices.get(user.id)) for user in users]
+
+
 def find_by_username(username, session):
     """
 
@@ -159,14 +208,14 @@ def get_user_devices(session, username, serialize=False):
 
     user = find_by_username(username, session)
 
-    LOGGER.debug("user name: %s, no of devices: %d" % (username, user.devices.count()))
-    # user.devices[0]
-    # user.devices.filter_by(load_id='some-id').count()
+    devices = session.query(Device).options(joinedload(Device.device_model)) \
+        .filter(Device.user_id == user.id).order_by(Device.device_name).all()
+    LOGGER.debug("user name: %s, no of devices: %d" % (username, len(devices)))
 
     if serialize:
-        return [device.serialize() for device in user.devices] if user.devices.count() > 0 else []
+        return [device.serialize() for device in devices]
     else:
-        return user.devices
+        return devices
 
 
 def add_role(username, role_name, session):
@@ -0,0 +1,142 @@
+import errno
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+# directory of main.py, whose batch command line runs the jobs
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# suffixes of the files of a job: the batch specification, the owner, the process id, the traces and the error
+SUFFIXES = [".json", ".owner", ".pid", ".npz", ".npz.part", ".npz.error", ".log"]
+
+
+class BatchJobs:
+    """
+    This class runs batch simulations in separate processes, so that they neither block a request nor compete with
+    the running simulations for the interpreter lock. the state of a job is kept in files named after it, as the
+    requests about it may be served by any worker process
+    """
+
+    def __init__(self, job_dir, python="python", max_age=86400):
+        """
+
+        :param job_dir: directory of the files of the jobs
+        :param python: command that runs main.py
+        :param max_age: seconds after which the files of a job are removed, whether the traces were downloaded or not
+        """
+        self.job_dir = job_dir
+        self.python = python
+        self.max_age = max_age
+
+    def path(self, job_id, suffix):
+        return os.path.join(self.job_dir, job_id + suffix)
+
+    def start(self, batch_params, owner):
+        """
+
+        :param batch_params: batch specification, see DeviceService.run_batch_simulation
+        :param owner: username of the user that may fetch the traces
+        :return: job id
+        """
+        try:
+            os.makedirs(self.job_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.prune()
+
+        job_id = uuid.uuid4().hex
+        with open(self.path(job_id, ".json"), 'w') as spec:
+            json.dump(batch_params, spec)
+        with open(self.path(job_id, ".owner"), 'w') as f:
+            f.write(owner)
+
+        with open(self.path(job_id, ".log"), 'w') as log:
+            process = subprocess.Popen([self.python, "main.py", "--batch", self.path(job_id, ".json"),
+                                        "--batch-output", self.path(job_id, ".npz")],
+                                       cwd=ROOT_DIR, stdout=log, stderr=subprocess.STDOUT, close_fds=True)
+        with open(self.path(job_id, ".pid"), 'w') as f:
+            f.write(str(process.pid))
+
+        # reap the process once it exits
+        waiter = threading.Thread(target=process.wait, name="batch-" + job_id)
+        waiter.setDaemon(True)
+        waiter.start()
+
+        LOGGER.info("Started batch simulation job '%s' in process %d" % (job_id, process.pid))
+        return job_id
+
+    def status(self, job_id, owner):
+        """
+
+        :param job_id:
+        :param owner:
+        :return: (RUNNING, None), (DONE, path of the traces) or (FAILED, error message), or None if the job does
+                 not exist or belongs to another user
+        """
+        try:
+            with open(self.path(job_id, ".owner")) as f:
+                if f.read() != owner:
+                    return None
+        except IOError:
+            return None
+
+        if os.path.exists(self.path(job_id, ".npz")):
+            return DONE, self.path(job_id, ".npz")
+        if os.path.exists(self.path(job_id, ".npz.error")):
+            with open(self.path(job_id, ".npz.error")) as f:
+                return FAILED, f.read()
+        if not self.is_alive(job_id):
+            # check again, as the process may have finished in the meantime
+            if os.path.exists(self.path(job_id, ".npz")):
+                return DONE, self.path(job_id, ".npz")
+            return FAILED, "batch simulation process exited unexpectedly"
+        return RUNNING, None
+
+    def is_alive(self, job_id):
+        try:
+            with open(self.path(job_id, ".pid")) as f:
+                os.kill(int(f.read()), 0)
+            return True
+        except (IOError, ValueError):
+            return False
+        except OSError as e:
+            return e.errno == errno.EPERM
+
+    def count_running(self):
+        if not os.path.exists(self.job_dir):
+            return 0
+        return len([file_name for file_name in os.listdir(self.job_dir)
+                    if file_name.endswith(".pid") and self.is_alive(file_name[:-len(".pid")])])
+
+    def remove(self, job_id):
+        for suffix in SUFFIXES:
+            try:
+                os.remove(self.path(job_id, suffix))
+            except OSError:
+                pass
+
+    def prune(self):
+        """
+        remove the files of jobs older than max_age
+        """
+        cutoff = time.time() - self.max_age
+        for file_name in os.listdir(self.job_dir):
+            if not file_name.endswith(".owner"):
+                continue
+            file_path = os.path.join(self.job_dir, file_name)
+            try:
+                if os.path.getmtime(file_path) < cutoff:
+                    self.remove(file_name[:-len(".owner")])
+            except OSError:
+                pass
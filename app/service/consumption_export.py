@@ -0,0 +1,169 @@
+import logging
+
+import numpy as np
+
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly, DeviceConsumptionDaily
+from app.service.consumption_retention import to_seconds, to_datetime, HOUR, DAY
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+LOGGER = logging.getLogger(__name__)
+
+# rows fetched from the db per round trip
+CHUNK_SIZE = 50000
+
+# resolution in seconds of the rows of each tier (0 for raw rows), in the order they are exported. the tiers cover
+# consecutive periods of time, as raw rows are rolled into hourly and those into daily aggregates
+RAW = 0
+TIERS = [DAY, HOUR, RAW]
+
+
+def available_formats():
+    return ["npz", "parquet"] if pyarrow is not None else ["npz"]
+
+
+def read_chunks(session, devices, start=None, end=None, chunk_size=CHUNK_SIZE):
+    """
+
+    read the consumption data of the given devices from all tiers through server-side cursors, and convert it to
+    columns. the daily and hourly aggregates of the periods whose raw rows are rolled up come first, with the average
+    power of the period and whether the device was on in it
+
+    :param session:
+    :param devices: list of Device instances
+    :param start: unix time in seconds of the first row to read (None for no limit). aggregates of periods that
+                  contain it are included
+    :param end: unix time in seconds up to which rows are read, exclusive (None for no limit)
+    :param chunk_size: number of rows per chunk
+    :return: generator of dicts of numpy arrays, with 'device' holding the position of the device in devices and
+             'resolution' the seconds covered by each row (0 for raw rows)
+    """
+    positions = {device.id: i for i, device in enumerate(devices)}
+    if len(positions) == 0:
+        return
+
+    for resolution in TIERS:
+        query = query_tier(session, resolution, positions.keys(), start, end) \
+            .execution_options(stream_results=True).yield_per(chunk_size)
+
+        rows = []
+        for row in query:
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield to_columns(rows, positions, resolution)
+                rows = []
+        if len(rows) > 0:
+            yield to_columns(rows, positions, resolution)
+
+
+def query_tier(session, resolution, device_ids, start, end):
+    """
+    :return: query of (device_id, time, power, energy, state) of the rows of the given tier, ordered by device and time
+    """
+    if resolution == RAW:
+        model, timestamp = DeviceConsumption, DeviceConsumption.timestamp
+        query = session.query(DeviceConsumption.device_id, timestamp, DeviceConsumption.power,
+                              DeviceConsumption.energy, DeviceConsumption.status)
+    else:
+        model = DeviceConsumptionHourly if resolution == HOUR else DeviceConsumptionDaily
+        timestamp = model.period_start
+        query = session.query(model.device_id, timestamp, model.power_avg, model.energy, model.on_samples > 0)
+        if start is not None:
+            start = np.floor(start / resolution) * resolution
+
+    query = query.filter(model.device_id.in_(device_ids))
+    if start is not None:
+        query = query.filter(timestamp >= to_datetime(start))
+    if end is not None:
+        query = query.filter(timestamp < to_datetime(end))
+    return query.order_by(model.device_id, timestamp)
+
+
+def to_columns(rows, positions, resolution=RAW):
+    return {
+        "device": np.array([positions[row[0]] for row in rows], dtype=np.int32),
+        "timestamp": np.array([to_seconds(row[1]) for row in rows], dtype=np.float64),
+        "power": np.array([row[2] for row in rows], dtype=np.float64),
+        "energy": np.array([row[3] for row in rows], dtype=np.float64),
+        "state": np.array([bool(row[4]) for row in rows], dtype=np.uint8),
+        "resolution": np.full(len(rows), resolution, dtype=np.int32)
+    }
+
+
+def write_npz(chunks, device_ids, file_path):
+    """
+    the columns of all chunks are concatenated, devices are stored once in 'device_id' and referenced by position
+    """
+    chunks = list(chunks)
+    columns = {
+        key: np.concatenate([chunk[key] for chunk in chunks]) if len(chunks) > 0 else np.empty(0, dtype=dtype)
+        for key, dtype in [("device", np.int32), ("timestamp", np.float64), ("power", np.float64),
+                           ("energy", np.float64), ("state", np.uint8), ("resolution", np.int32)]
+    }
+    np.savez_compressed(file_path, device_id=np.array(device_ids, dtype='S32'), **columns)
+    return len(columns["timestamp"])
+
+
+def write_parquet(chunks, device_ids, file_path):
+    """
+    each chunk is written as a row group as soon as it is read, so that the export is never held in memory
+    """
+    device_ids = pyarrow.array(device_ids, type=pyarrow.string())
+    schema = pyarrow.schema([
+        ("device_id", pyarrow.dictionary(pyarrow.int32(), pyarrow.string())),
+        ("timestamp", pyarrow.float64()),
+        ("power", pyarrow.float64()),
+        ("energy", pyarrow.float64()),
+        ("state", pyarrow.uint8()),
+        ("resolution", pyarrow.int32())
+    ])
+
+    count = 0
+    writer = pyarrow.parquet.ParquetWriter(file_path, schema, compression='snappy')
+    try:
+        for chunk in chunks:
+            writer.write_table(pyarrow.Table.from_arrays([
+                pyarrow.DictionaryArray.from_arrays(pyarrow.array(chunk["device"]), device_ids),
+                pyarrow.array(chunk["timestamp"]),
+                pyarrow.array(chunk["power"]),
+                pyarrow.array(chunk["energy"]),
+                pyarrow.array(chunk["state"]),
+                pyarrow.array(chunk["resolution"])
+            ], schema=schema))
+            count += len(chunk["timestamp"])
+    finally:
+        writer.close()
+    return count
+
+
+def export(session, devices, file_path, file_format="npz", start=None, end=None):
+    """
+
+    export the consumption data of a set of devices over a time range to a columnar file, with the rows of the
+    periods that are rolled up taken from the aggregates (marked by their 'resolution')
+
+    :param session:
+    :param devices: list of Device instances
+    :param file_path:
+    :param file_format: one of available_formats()
+    :param start: unix time in seconds (None for no limit)
+    :param end: unix time in seconds, exclusive (None for no limit)
+    :return: number of exported rows
+    :raise ValueError: if the format is not available
+    """
+    if file_format not in available_formats():
+        raise ValueError("format '%s' is not available. available formats are: %s"
+                         % (file_format, ", ".join(available_formats())))
+
+    chunks = read_chunks(session, devices, start, end)
+    device_ids = [device.device_id for device in devices]
+    count = write_parquet(chunks, device_ids, file_path) if file_format == "parquet" \
+        else write_npz(chunks, device_ids, file_path)
+
+    LOGGER.info("Exported %d consumption rows of %d devices to '%s'" % (count, len(devices), file_path))
+    return count
@@ -0,0 +1,346 @@
+import datetime
+import logging
+import os
+
+import numpy as np
+
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly, DeviceConsumptionDaily
+from app.util import compression
+
+LOGGER = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1)
+HOUR = 3600
+DAY = 86400
+
+
+def to_seconds(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+def to_datetime(seconds):
+    return EPOCH + datetime.timedelta(seconds=float(seconds))
+
+
+def aggregate(ids, device_ids, seconds, samples, power_sum, power_max, energy, on_samples, period):
+    """
+
+    group consumption records by device and period
+
+    :param ids: id of each record
+    :param device_ids: device of each record
+    :param seconds: time of each record in seconds since the epoch
+    :param samples: number of raw samples each record stands for
+    :param power_sum: sum of the power of the samples of each record
+    :param power_max: maximum power of the samples of each record
+    :param energy: energy reading of each record
+    :param on_samples: number of samples each record was switched on
+    :param period: length of the aggregation period in seconds
+    :return: dict of arrays with one entry per device and period
+    """
+    period_start = np.floor(seconds / period) * period
+    order = np.lexsort((seconds, period_start, device_ids))
+    device_ids, period_start = device_ids[order], period_start[order]
+
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (np.diff(device_ids) != 0) | (np.diff(period_start) != 0)
+    starts = np.flatnonzero(is_first)
+    ends = np.append(starts[1:], len(order))
+
+    total_samples = np.add.reduceat(samples[order], starts)
+    return {
+        "device_id": device_ids[starts],
+        "period_start": period_start[starts],
+        "samples": total_samples,
+        "on_samples": np.add.reduceat(on_samples[order], starts),
+        "power_avg": np.add.reduceat(power_sum[order], starts) / total_samples,
+        "power_max": np.fmax.reduceat(power_max[order], starts),
+        "energy": energy[order][ends - 1],
+        "source_max_id": np.maximum.reduceat(ids[order], starts)
+    }
+
+
+def weigh(device_ids, seconds, power, state, period, storage=None):
+    """
+
+    find the number of samples each raw row stands for, and the sum of their power. rows stored with compression
+    hold until the next row of the device (or the end of their period, at most storage_max_silence seconds), and
+    stand for the samples that were left out in between. their power is a step function (deadband) or linear
+    towards the next row while the device stays on (swinging door), as when the rows are reconstructed. as the rows
+    of earlier periods are rolled up (and deleted) before, samples before the first row of a device in the period
+    are not counted
+
+    :param device_ids: device of each row
+    :param seconds: time of each row in seconds since the epoch
+    :param power: power of each row (NaN if missing)
+    :param state: on/off state of each row
+    :param period: length of the aggregation period in seconds
+    :param storage: the 'device' section of app.yaml, with the compression the rows were stored with (None for
+                    uncompressed rows)
+    :return: (number of samples, sum of power) of each row
+    """
+    power = np.nan_to_num(power)
+    method = storage.storage_compression if storage is not None else compression.NONE
+    if method not in (compression.DEADBAND, compression.SWINGING_DOOR):
+        return np.ones(len(device_ids), dtype=np.int64), power
+
+    order = np.lexsort((seconds, device_ids))
+    device_ids, seconds, power, state = device_ids[order], seconds[order], power[order], state[order] != 0
+    period_end = np.floor(seconds / period) * period + period
+    has_next = np.append((device_ids[1:] == device_ids[:-1]) & (seconds[1:] < period_end[:-1]), False)
+    next_seconds, next_power = np.append(seconds[1:], 0.0), np.append(power[1:], 0.0)
+
+    until = np.minimum(np.where(has_next, next_seconds, period_end), seconds + storage.storage_max_silence)
+    samples = np.maximum(1, np.round((until - seconds) / storage.storage_interval)).astype(np.int64)
+    power_sum = samples * power
+    if method == compression.SWINGING_DOOR:
+        # the k-th of n samples is at k/n of the way to the next row
+        linear = has_next & state & np.append(state[1:], False) \
+            & (next_seconds - seconds <= storage.storage_max_silence)
+        power_sum[linear] += (samples[linear] - 1) / 2.0 * (next_power[linear] - power[linear])
+
+    weighed_samples, weighed_power = np.empty_like(samples), np.empty_like(power_sum)
+    weighed_samples[order], weighed_power[order] = samples, power_sum
+    return weighed_samples, weighed_power
+
+
+def find_aggregates(session, target, window_start, window_end):
+    """
+    :return: dict of (device_id, period_start) -> aggregate of the target table within the window (exclusive end)
+    """
+    rows = session.query(target).filter(target.period_start >= to_datetime(window_start),
+                                        target.period_start < to_datetime(window_end)).all()
+    return dict(((row.device_id, row.period_start), row) for row in rows)
+
+
+def is_new(existing, ids, device_ids, seconds, period):
+    """
+
+    find the records that are not included in the existing aggregates yet. an aggregate includes the records up to
+    its highest source id: those were either rolled up by an earlier run that was interrupted before it deleted them,
+    or arrived late (e.g., replayed by the consumption writer) after their period was rolled up
+
+    :param existing: dict of (device_id, period_start) -> aggregate, as returned by find_aggregates
+    :return: boolean mask of the records to add to the aggregates
+    """
+    period_start = np.floor(seconds / period) * period
+    mask = np.ones(len(ids), dtype=bool)
+    for i in range(len(ids)):
+        row = existing.get((int(device_ids[i]), to_datetime(period_start[i])))
+        if row is not None and row.source_max_id is not None:
+            mask[i] = ids[i] > row.source_max_id
+    return mask
+
+
+def merge(row, aggregates, i):
+    """
+    add the i-th of the aggregates to an existing aggregate of the same device and period
+    """
+    samples = row.samples + int(aggregates["samples"][i])
+    power_sum = (row.power_avg or 0.0) * row.samples + float(aggregates["power_avg"][i]) * aggregates["samples"][i]
+    row.power_avg = power_sum / samples
+    row.power_max = to_float(np.fmax(np.nan if row.power_max is None else row.power_max, aggregates["power_max"][i]))
+    # the energy reading grows over the period, so the last reading is the largest one
+    row.energy = to_float(np.fmax(np.nan if row.energy is None else row.energy, aggregates["energy"][i]))
+    row.samples = samples
+    row.on_samples += int(aggregates["on_samples"][i])
+    row.source_max_id = max(row.source_max_id or 0, int(aggregates["source_max_id"][i]))
+
+
+def to_float(value):
+    return None if np.isnan(value) else float(value)
+
+
+def store_aggregates(session, target, aggregates, existing):
+    """
+
+    insert the aggregates that are not in the target table yet, and merge the others into the existing ones
+
+    :param existing: dict of (device_id, period_start) -> aggregate, as returned by find_aggregates
+    :return: number of inserted and merged aggregates
+    """
+    rows = []
+    for i in range(len(aggregates["device_id"])):
+        key = (int(aggregates["device_id"][i]), to_datetime(aggregates["period_start"][i]))
+        if key in existing:
+            merge(existing[key], aggregates, i)
+            continue
+        rows.append({
+            "device_id": key[0],
+            "period_start": key[1],
+            "samples": int(aggregates["samples"][i]),
+            "on_samples": int(aggregates["on_samples"][i]),
+            "power_avg": float(aggregates["power_avg"][i]),
+            "power_max": to_float(aggregates["power_max"][i]),
+            "energy": to_float(aggregates["energy"][i]),
+            "source_max_id": int(aggregates["source_max_id"][i])
+        })
+    session.bulk_insert_mappings(target, rows)
+    session.commit()
+    return len(aggregates["device_id"])
+
+
+def delete_rows(session, source, ids, batch_size):
+    """
+    delete the given rows in bounded batches, committing after each batch to keep locks and undo logs small
+    """
+    for i in range(0, len(ids), batch_size):
+        session.query(source).filter(source.id.in_(ids[i:i + batch_size])).delete(synchronize_session=False)
+        session.commit()
+
+
+def archive_rows(archive_dir, window_start, ids, device_ids, seconds, power, energy, state):
+    """
+    export raw rows to a compressed file, one file per rolled up period
+    """
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+
+    name = "consumption_" + to_datetime(window_start).strftime("%Y%m%d%H")
+    file_path = os.path.join(archive_dir, name + ".npz")
+    suffix = 1
+    while os.path.exists(file_path):  # a rerun after an interrupted rollup must not overwrite the earlier export
+        file_path = os.path.join(archive_dir, "{}_{}.npz".format(name, suffix))
+        suffix += 1
+
+    np.savez_compressed(file_path, id=ids, device_id=device_ids, timestamp=seconds, power=power, energy=energy,
+                        state=state)
+    LOGGER.debug("Archived %d raw consumption rows to '%s'" % (len(ids), file_path))
+
+
+def rollup_raw(session, cutoff, batch_size, archive_dir=None, storage=None):
+    """
+
+    roll raw consumption rows older than the cutoff into hourly aggregates, one hour at a time
+
+    :param session:
+    :param cutoff: start of the hour from which on raw rows are kept
+    :param batch_size: number of rows deleted per transaction
+    :param archive_dir: directory to export the raw rows to before deleting them (None to not export)
+    :param storage: the 'device' section of app.yaml, with the compression the rows were stored with (see weigh)
+    :return: number of rolled up raw rows
+    """
+    rolled_up = 0
+    while True:
+        oldest = session.query(DeviceConsumption.timestamp).filter(DeviceConsumption.timestamp < cutoff) \
+            .order_by(DeviceConsumption.timestamp).first()
+        if oldest is None:
+            break
+
+        window_start = np.floor(to_seconds(oldest[0]) / HOUR) * HOUR
+        rows = session.query(DeviceConsumption.id, DeviceConsumption.device_id, DeviceConsumption.timestamp,
+                             DeviceConsumption.power, DeviceConsumption.energy, DeviceConsumption.status) \
+            .filter(DeviceConsumption.timestamp >= to_datetime(window_start),
+                    DeviceConsumption.timestamp < to_datetime(window_start + HOUR)).all()
+
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        device_ids = np.array([row[1] for row in rows], dtype=np.int64)
+        seconds = np.array([to_seconds(row[2]) for row in rows], dtype=np.float64)
+        power = np.array([row[3] for row in rows], dtype=np.float64)
+        energy = np.array([row[4] for row in rows], dtype=np.float64)
+        state = np.array([bool(row[5]) for row in rows], dtype=np.int64)
+
+        # rows that an earlier run included in the aggregates already are only deleted
+        existing = find_aggregates(session, DeviceConsumptionHourly, window_start, window_start + HOUR)
+        new = is_new(existing, ids, device_ids, seconds, HOUR)
+        if new.any():
+            # the rows are weighed together with those aggregated already, which they may follow or precede
+            samples, power_sum = weigh(device_ids, seconds, power, state, HOUR, storage)
+            aggregates = aggregate(ids[new], device_ids[new], seconds[new], samples[new], power_sum[new], power[new],
+                                   energy[new], samples[new] * state[new], HOUR)
+            store_aggregates(session, DeviceConsumptionHourly, aggregates, existing)
+
+        if archive_dir:
+            archive_rows(archive_dir, window_start, ids, device_ids, seconds, power, energy, state.astype(np.bool_))
+        delete_rows(session, DeviceConsumption, ids.tolist(), batch_size)
+        rolled_up += len(rows)
+
+    return rolled_up
+
+
+def rollup_hourly(session, cutoff, batch_size):
+    """
+
+    roll hourly aggregates older than the cutoff into daily aggregates, one day at a time
+
+    :param session:
+    :param cutoff: start of the day from which on hourly aggregates are kept
+    :param batch_size: number of rows deleted per transaction
+    :return: number of rolled up hourly aggregates
+    """
+    rolled_up = 0
+    while True:
+        oldest = session.query(DeviceConsumptionHourly.period_start) \
+            .filter(DeviceConsumptionHourly.period_start < cutoff) \
+            .order_by(DeviceConsumptionHourly.period_start).first()
+        if oldest is None:
+            break
+
+        window_start = np.floor(to_seconds(oldest[0]) / DAY) * DAY
+        rows = session.query(DeviceConsumptionHourly) \
+            .filter(DeviceConsumptionHourly.period_start >= to_datetime(window_start),
+                    DeviceConsumptionHourly.period_start < to_datetime(window_start + DAY)).all()
+
+        ids = np.array([row.id for row in rows], dtype=np.int64)
+        device_ids = np.array([row.device_id for row in rows], dtype=np.int64)
+        seconds = np.array([to_seconds(row.period_start) for row in rows], dtype=np.float64)
+        existing = find_aggregates(session, DeviceConsumptionDaily, window_start, window_start + DAY)
+        new = is_new(existing, ids, device_ids, seconds, DAY)
+        if new.any():
+            samples = np.array([row.samples for row in rows], dtype=np.int64)[new]
+            aggregates = aggregate(ids[new], device_ids[new], seconds[new], samples,
+                                   np.nan_to_num(np.array([row.power_avg for row in rows],
+                                                          dtype=np.float64))[new] * samples,
+                                   np.array([row.power_max for row in rows], dtype=np.float64)[new],
+                                   np.array([row.energy for row in rows], dtype=np.float64)[new],
+                                   np.array([row.on_samples for row in rows], dtype=np.int64)[new],
+                                   DAY)
+            store_aggregates(session, DeviceConsumptionDaily, aggregates, existing)
+
+        delete_rows(session, DeviceConsumptionHourly, [row.id for row in rows], batch_size)
+        rolled_up += len(rows)
+
+    return rolled_up
+
+
+def cutoffs(now, retention):
+    """
+
+    the raw rows are kept for the last raw_days, rounded down to the start of the hour, and the hourly aggregates
+    for the last hourly_days (at least raw_days), rounded down to the start of the day
+
+    :param now: current time
+    :param retention: retention parameters (see 'retention' in app.yaml)
+    :return: (start of the raw rows to keep, start of the hourly aggregates to keep or None to keep all of them)
+    """
+    now = to_seconds(now)
+    raw_cutoff = to_datetime(np.floor((now - retention.raw_days * DAY) / HOUR) * HOUR)
+    hourly_cutoff = None
+    if retention.hourly_days > 0:
+        hourly_cutoff = to_datetime(np.floor((now - max(retention.hourly_days, retention.raw_days) * DAY) / DAY) * DAY)
+    return raw_cutoff, hourly_cutoff
+
+
+def run(session, retention, now=None, storage=None):
+    """
+
+    apply the retention policy to the consumption data of all devices
+
+    :param session:
+    :param retention: retention parameters (see 'retention' in app.yaml)
+    :param now: current time (defaults to now)
+    :param storage: the 'device' section of app.yaml, with the compression the raw rows were stored with
+    :return: number of rolled up raw rows and hourly aggregates
+    """
+    if not retention.raw_days > 0:
+        return {"raw": 0, "hourly": 0}
+    raw_cutoff, hourly_cutoff = cutoffs(now if now is not None else datetime.datetime.now(), retention)
+
+    raw = rollup_raw(session, raw_cutoff, retention.delete_batch_size, retention.archive_dir or None, storage)
+
+    hourly = 0
+    if hourly_cutoff is not None:
+        hourly = rollup_hourly(session, hourly_cutoff, retention.delete_batch_size)
+
+    return {"raw": raw, "hourly": hourly}
@@ -0,0 +1,192 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+from app.data.database import session_scope
+from app.data.model.device import Device
+from app.data.model.device_consumption import DeviceConsumption
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ConsumptionWriter(threading.Thread):
+    """
+    This class writes consumption samples to the db in the background, so that sampling does not wait for the db.
+    samples that cannot be written (e.g., while the db is down) are appended to a local spill file, which is
+    replayed once the db is back
+    """
+
+    def __init__(self, stop_event, spill_file, queue_size=100000, batch_size=1000, max_backoff=60.0):
+        """
+
+        :param stop_event: event that is set to stop the writer, which then writes or spills the queued samples
+        :param spill_file: file to append samples to that could not be written (one JSON list per line)
+        :param queue_size: number of samples held in memory, beyond which samples are spilled right away
+        :param batch_size: number of samples written per transaction
+        :param max_backoff: longest wait in seconds between two attempts to write to the db
+        """
+        threading.Thread.__init__(self, name="consumption-writer")
+        self.setDaemon(True)
+
+        self.stop_event = stop_event
+        self.spill_file = spill_file
+        self.replay_file = spill_file + ".replay"
+        self.queue = Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.spill_lock = threading.Lock()
+        if os.path.dirname(spill_file) and not os.path.exists(os.path.dirname(spill_file)):
+            os.makedirs(os.path.dirname(spill_file))
+
+        self.backoff = 0
+        self.written = 0
+        self.spilled = 0
+
+    def put(self, samples):
+        """
+        :param samples: list of (device_id, unix time, power, energy, state)
+        """
+        overflow = []
+        for sample in samples:
+            try:
+                self.queue.put_nowait(sample)
+            except Full:
+                overflow.append(sample)
+        if len(overflow) > 0:
+            LOGGER.warn("Consumption writer queue is full, spilling %d samples" % len(overflow))
+            self.spill(overflow)
+
+    def take_batch(self, timeout):
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        LOGGER.info('Starting thread for writing device consumption data')
+        while not self.stop_event.is_set():
+            batch = self.take_batch(timeout=1.0)
+            try:
+                if len(batch) > 0:
+                    self.write(batch)
+            except Exception as e:
+                LOGGER.error("Failed to write consumption data: %s" % e)
+                self.spill(batch)
+                self.wait_backoff()
+                continue
+
+            # only a failed write is spilled, as the batch is in the db once it is written
+            try:
+                self.replay()
+                self.backoff = 0
+            except Exception as e:
+                LOGGER.error("Failed to replay spilled consumption data: %s" % e)
+                self.wait_backoff()
+
+        # write what is left, or keep it for the next start
+        batch = self.take_batch(timeout=0)
+        while len(batch) > 0:
+            try:
+                self.write(batch)
+            except Exception as e:
+                LOGGER.error("Failed to write consumption data: %s" % e)
+                self.spill(batch)
+            batch = self.take_batch(timeout=0)
+        LOGGER.info("Consumption writer stopped")
+
+    def wait_backoff(self):
+        self.backoff = min(self.max_backoff, max(1.0, 2 * self.backoff))
+        self.stop_event.wait(self.backoff)
+
+    def write(self, batch):
+        """
+        write a batch of samples in a single transaction. samples of devices that no longer exist are dropped
+        """
+        with session_scope() as session:
+            device_ids = set(sample[0] for sample in batch)
+            ids = dict((device_id, db_id) for db_id, device_id in
+                       session.query(Device.id, Device.device_id).filter(Device.device_id.in_(device_ids)).all())
+
+            rows = []
+            for device_id, t, power, energy, state in batch:
+                device_db_id = ids.get(device_id)
+                if device_db_id is None:
+                    continue
+                rows.append({
+                    "device_id": device_db_id,
+                    "timestamp": datetime.datetime.fromtimestamp(t),
+                    "power": power,
+                    "energy": energy,
+                    "status": bool(state)
+                })
+            session.bulk_insert_mappings(DeviceConsumption, rows)
+            session.commit()
+        self.written += len(batch)
+
+    def spill(self, samples):
+        if len(samples) == 0:
+            return
+        with self.spill_lock:
+            with open(self.spill_file, 'a') as spill_file:
+                for sample in samples:
+                    spill_file.write(json.dumps(list(sample)) + "\n")
+                spill_file.flush()
+                os.fsync(spill_file.fileno())
+        self.spilled += len(samples)
+
+    def replay(self):
+        """
+        write the spilled samples to the db, batch by batch. the position up to which samples are written is kept
+        next to the file, so that an interrupted replay continues where it stopped
+        """
+        with self.spill_lock:
+            if not os.path.exists(self.replay_file):
+                if not os.path.exists(self.spill_file):
+                    return
+                os.rename(self.spill_file, self.replay_file)
+
+        offset_file = self.replay_file + ".offset"
+        offset = 0
+        if os.path.exists(offset_file):
+            with open(offset_file) as f:
+                offset = int(f.read().strip() or 0)
+
+        start_time = time.time()
+        replayed = 0
+        with open(self.replay_file) as replay_file:
+            replay_file.seek(offset)
+            while not self.stop_event.is_set():
+                lines = [replay_file.readline() for _ in range(self.batch_size)]
+                batch = [tuple(json.loads(line)) for line in lines if line.strip()]
+                if len(batch) == 0:
+                    break
+                self.write(batch)
+                replayed += len(batch)
+                with open(offset_file, 'w') as f:
+                    f.write(str(replay_file.tell()))
+            else:
+                return
+
+        os.remove(self.replay_file)
+        if os.path.exists(offset_file):
+            os.remove(offset_file)
+        LOGGER.info("Replayed %d spilled consumption samples in %.1f seconds" % (replayed, time.time() - start_time))
+
+    def serialize(self):
+        return {
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "spilled": self.spilled,
+            "backoff": self.backoff,
+            "spill_pending": os.path.exists(self.spill_file) or os.path.exists(self.replay_file)
+        }
@@ -1,23 +1,60 @@
-import datetime
 import logging
+import os
+from multiprocessing.pool import ThreadPool
+import resource
 import threading
 import time
+import uuid
 import gc
 
+from attrdict import AttrDict
+
 from app.data.database import session_scope
-from app.data.model.device_consumption import DeviceConsumption
 from app.data.model.device_type_enum import DeviceTypeEnum
 from app.data.repository import device_repo
+from app.service import batch_jobs
+from app.service import consumption_export
+from app.service import consumption_retention
+from app.service.consumption_writer import ConsumptionWriter
+from app.service.simulation_reconciler import SimulationReconciler
+from app.service.simulation_watchdog import SimulationWatchdog
 from app.service.user_service import UserService
+from app.simulator import batch_simulator
+from app.simulator import checkpoint
+from app.simulator import command_queue
+from app.simulator import equivalence
+from app.simulator import model_registry
+from app.simulator.control_schedule import ControlSchedule
 from app.simulator.device_simulator import DeviceSimulator
+from app.simulator.tick_scheduler import TickScheduler
+from app.simulator.trace_buffer import TraceBuffer
+from app.util import compression
 from app.util.app_config import params
 # from app.simulator.DeviceSimulator.running_simulations_dict import DeviceSimulator.running_simulations
 
 LOGGER = logging.getLogger(__name__)
 
+# models that can be simulated, with their parameter bounds and FMU metadata
+model_registry.build(params.model)
+
 # t1 = None
 t2 = None
+t3 = None
+# due times of the next steps of the running simulations, used by the simulation loop only
+scheduler = TickScheduler()
+# device_id -> compressor of the consumption data of the device, used by the storage thread only
+compressors = dict()
 stop_event = threading.Event()
+watchdog = None
+# starts and stops simulations to match the devices that should be simulating
+reconciler = SimulationReconciler(lambda device_ids: DeviceService().restore_device_simulations(device_ids),
+                                  stop_event, interval=params.device.reconcile_interval,
+                                  full_check_interval=params.device.reconcile_full_check_interval,
+                                  max_attempts=params.device.reconcile_max_attempts)
+# persists the sampled consumption data, see store_device_consumption_data
+consumption_writer = None
+# batch simulations run outside of the server processes, see start_batch_job
+jobs = batch_jobs.BatchJobs(params.batch.job_dir, python=params.batch.python, max_age=params.batch.job_max_age)
 
 
 class DeviceService:
@@ -36,6 +73,24 @@ class DeviceService:
         new_device = self.device_repo.add_device(username, device_name, session)
         return new_device
 
+    def create_devices(self, username, devices_params, session):
+        """
+
+        create a batch of devices that are turned on. their simulations are started in the background by the
+        reconciler
+
+        :param username:
+        :param devices_params: list of dicts with 'model_name', 'params' and optionally 'device_name'
+        :param session:
+        :return: the new devices
+        """
+        devices = self.device_repo.add_devices(
+            username, [(d.get('device_name', d['model_name']), d['model_name'], d.get('params') or {})
+                       for d in devices_params], DeviceTypeEnum.ON, session)
+        for device in devices:
+            reconciler.want(device.device_id)
+        return devices
+
     def get_device(self, username, device_id, session):
         """
 
@@ -82,12 +137,28 @@ class DeviceService:
 
         # first check if device simulation is running
         # if yes, first stop simulation
-        if self.is_device_active(device):
-            DeviceService.stop_simulation(device)
+        if self.is_device_active(device) and self.is_device_simulating(device):
+            DeviceSimulator.commands.stop(device.device_id, command_queue.DELETE)
+        reconciler.unwant(device.device_id)
 
         # then delete the device
         return self.device_repo.delete_device(username, device_id, session)
 
+    def delete_all_devices(self, username, session):
+        """
+
+        :param session:
+        :param username:
+        :return: number of deleted devices
+        """
+        devices = self.device_repo.find_device(session, username)
+        for device in devices:
+            if self.is_device_active(device) and self.is_device_simulating(device):
+                DeviceSimulator.commands.stop(device.device_id, command_queue.DELETE)
+            reconciler.unwant(device.device_id)
+
+        return self.device_repo.delete_devices([device.id for device in devices], session)
+
     def add_device_model(self, device, model, session):
         """
 
@@ -120,6 +191,22 @@ class DeviceService:
         self.device_repo.update_device_model(device, new_model, session)
         return device
 
+    def update_devices_params(self, devices, model_params, session):
+        """
+
+        update the model parameters of devices in place, and apply them to the running simulations at the next tick
+        boundary without loading their FMUs again
+
+        :param devices: list of devices
+        :param model_params: list of new parameters, one per device
+        :param session:
+        :return:
+        """
+        self.device_repo.update_device_params(devices, model_params, session)
+        for device, new_params in zip(devices, model_params):
+            if self.is_device_simulating(device):
+                DeviceSimulator.commands.put(command_queue.PARAMS, device.device_id, dict(new_params))
+
     def start_simulation(self, device, session):
         """
 
@@ -130,7 +217,7 @@ class DeviceService:
         :return:
         """
         try:
-            if device.device_id in DeviceSimulator.running_simulations:
+            if self.is_device_simulating(device):
                 resp = {
                     "status": "info",
                     "msg": "simulation of device with id: '%s' already running" % device.device_id
@@ -138,16 +225,12 @@ class DeviceService:
                 LOGGER.debug(resp)
                 return True, resp
 
-            simulation = DeviceSimulator(
-                fmu_name=params.model.package_name + "_" + device.device_model.model_name,
-                fmu_dir=params.model.fmu_dir,
-                device_name=device.device_name,
-                device_id=device.device_id,
-                model_params=device.device_model.params,
-                output_dir=params.model.output_dir
-            )
+            simulation = self.create_simulation(device.device_id, device.device_name,
+                                                device.device_model.model_name, device.device_model.params)
             # simulation.start() # commented as we moved away from thread based approach
-            DeviceSimulator.running_simulations[device.device_id] = simulation
+            # the simulation loop adds the simulation to the running simulations at the next tick boundary
+            reconciler.want(device.device_id)
+            DeviceSimulator.commands.start(simulation)
 
             if not self.is_device_active(device):
                 self.device_repo.set_device_state(device, DeviceTypeEnum.ACTIVE, session)
@@ -164,6 +247,38 @@ class DeviceService:
             LOGGER.error(e)
             return False, e
 
+    @staticmethod
+    def create_simulation(device_id, device_name, model_name, model_params):
+        """
+        create the simulator of a device. it is added to the running simulations through the command queue
+
+        :param device_id:
+        :param device_name:
+        :param model_name:
+        :param model_params:
+        :return: instance of DeviceSimulator
+        """
+        model = model_registry.get(model_name)
+        simulation = DeviceSimulator(
+            fmu_name=model.fmu_name,
+            fmu_dir=params.model.fmu_dir,
+            device_name=device_name,
+            device_id=device_id,
+            model_params=model_params,
+            output_dir=params.model.output_dir,
+            horizon=params.device.simulation_horizon,
+            dormant_when_off=model.zero_when_off,
+            dt=DeviceService.get_tick_interval(model_name),
+            register=False,
+            variables=model.get_variables()
+        )
+
+        # resume the recording of traces that was left on when the device was simulated last time
+        trace_dir = DeviceService.get_trace_directory(device_id)
+        if params.trace.enabled_by_default or TraceBuffer.is_recording(trace_dir):
+            simulation.enable_trace(trace_dir, params.trace.capacity)
+        return simulation
+
     @staticmethod
     def stop_simulation(device):
         """
@@ -172,7 +287,7 @@ class DeviceService:
         :return:
         """
         try:
-            if device.device_id not in DeviceSimulator.running_simulations:
+            if not DeviceService.is_device_simulating(device):
                 resp = {
                     "status": "info",
                     "msg": "simulation of device with id: '%s' already stopped" % device.device_id
@@ -182,7 +297,8 @@ class DeviceService:
 
             # DeviceSimulator.running_simulations[device.device_id].stop.set()
             # DeviceSimulator.running_simulations[device.device_id].join()
-            del DeviceSimulator.running_simulations[device.device_id]
+            DeviceSimulator.commands.stop(device.device_id)
+            reconciler.hold(device.device_id)
             # self.device_repo.set_device_state(device, DeviceTypeEnum.INACTIVE, session)
 
             resp = {
@@ -212,8 +328,8 @@ class DeviceService:
                 LOGGER.debug(resp)
                 return True, resp
 
-            if device.device_id in DeviceSimulator.running_simulations:
-                del DeviceSimulator.running_simulations[device.device_id]
+            DeviceSimulator.commands.stop(device.device_id)
+            reconciler.unwant(device.device_id)
 
             self.device_repo.set_device_state(device, DeviceTypeEnum.INACTIVE, session)
 
@@ -236,7 +352,7 @@ class DeviceService:
         :return:
         """
         try:
-            if self.is_device_active(device) and device.device_id in DeviceSimulator.running_simulations:
+            if self.is_device_active(device) and self.is_device_simulating(device):
                 resp = {
                     "status": "info",
                     "msg": "Device with id: '%s' already activated" % device.device_id
@@ -258,18 +374,95 @@ class DeviceService:
             return False, e
 
     def turn_on_device(self, device, session):
-        DeviceSimulator.running_simulations[device.device_id].set_control({'u': 1.0})
+        DeviceSimulator.commands.put(command_queue.CONTROL, device.device_id, {'u': 1.0})
         self.device_repo.set_device_state(device, DeviceTypeEnum.ON, session)
 
     def turn_off_device(self, device, session):
-        DeviceSimulator.running_simulations[device.device_id].set_control({'u': 0.0})
+        DeviceSimulator.commands.put(command_queue.CONTROL, device.device_id, {'u': 0.0})
         self.device_repo.set_device_state(device, DeviceTypeEnum.OFF, session)
 
+    @staticmethod
+    def set_device_schedule(device, schedule):
+        """
+        attach a control schedule to a simulated device, replacing any previous schedule
+
+        :param device:
+        :param schedule: instance of ControlSchedule
+        :return:
+        """
+        simulation = DeviceService.get_simulation(device)
+        if schedule.has_setpoint() and 'v' not in simulation.vars_in:
+            resp = {
+                "status": "error",
+                "msg": "model of device with id: '%s' has no set point input 'v'" % device.device_id
+            }
+            return False, resp
+
+        DeviceSimulator.commands.put(command_queue.SCHEDULE, device.device_id, schedule)
+
+        resp = {
+            "status": "success",
+            "msg": "schedule with {} entries set for device with id: '{}'".format(len(schedule.times),
+                                                                                  device.device_id)
+        }
+        LOGGER.debug(resp)
+        return True, resp
+
+    @staticmethod
+    def clear_device_schedule(device):
+        DeviceSimulator.commands.put(command_queue.SCHEDULE, device.device_id, None)
+
+    @staticmethod
+    def get_device_schedule(device):
+        schedule = DeviceService.get_simulation(device).schedule
+        return schedule.serialize() if schedule is not None else []
+
+    @staticmethod
+    def get_trace_directory(device_id):
+        return os.path.join(params.trace.dir, device_id)
+
+    @staticmethod
+    def set_device_trace(device, enabled):
+        """
+        turn the recording of the output of a simulated device at every step on or off
+
+        :param device:
+        :param enabled:
+        :return:
+        """
+        DeviceSimulator.commands.put(command_queue.TRACE, device.device_id, {'enabled': enabled})
+
+    @staticmethod
+    def get_device_trace(device, start=None, end=None):
+        """
+        :param device:
+        :param start: unix time in seconds of the first sample (None for the oldest one kept)
+        :param end: unix time in seconds up to which samples are read, exclusive (None for up to the latest one)
+        :return: dict of arrays 'time', 'power', 'energy' and 'state', or None if no trace was recorded
+        """
+        trace_dir = DeviceService.get_trace_directory(device.device_id)
+        if not TraceBuffer.exists(trace_dir):
+            return None
+        return TraceBuffer(trace_dir, readonly=True).read(start, end)
+
+    @staticmethod
+    def store_scheduled_state_changes(session):
+        """
+        write the power states that were changed by control schedules to the db
+        :return:
+        """
+        while DeviceSimulator.pending_state_changes:
+            device_id, power_state = DeviceSimulator.pending_state_changes.popitem()
+            device = device_repo.find_device_by_id(device_id, session)
+            if device is None or not DeviceService.is_device_active(device):
+                continue
+            device_repo.set_device_state(device, DeviceTypeEnum.ON if power_state else DeviceTypeEnum.OFF, session)
+
     def get_all_devices_for_all_users(self, session):
         return self.device_repo.find_all(session)
 
     def find_interrupted_device_simulations(self, session):
-        return len(self.device_repo.find_active(session)) - len(DeviceSimulator.running_simulations)
+        return self.device_repo.count_simulated(session) - len(DeviceSimulator.running_simulations)
 
     @staticmethod
     def stop_all_active_devices(session):
@@ -298,33 +491,21 @@ class DeviceService:
         :return:
         """
         try:
-            model_name = device_params.model_name
-            model_params = device_params.params
-
-            available_models = [m.name for m in params.model.available_models]
-            if model_name not in available_models:
+            model = model_registry.get(device_params.model_name)
+            if model is None:
                 resp = {
                     "status": "error",
-                    "msg": "invalid model_type. valid models are: %s" % available_models
+                    "msg": "invalid model_type. valid models are: %s" % model_registry.names()
                 }
                 return False, resp
 
-            model = [m for m in params.model.available_models if m.name == model_name][0]
-            for key in model_params:
-                if key not in model.params.keys():
-                    resp = {
-                        "status": "error",
-                        "msg": "invalid model parameters. valid parameters are: %s" % model.params.keys()
-                    }
-                    return False, resp
-            for key, val in model_params.items():
-                if val > model.params(key).max or val < model.params(key).min:
-                    resp = {
-                        "status": "error",
-                        "msg": "parameter value out of range. parameter: %s, valid range: [min:%.1f, max:%.1f]" \
-                               % (key, model.params(key).min, model.params(key).max)
-                    }
-                    return False, resp
+            error = model.validate(device_params.params)
+            if error is not None:
+                resp = {
+                    "status": "error",
+                    "msg": error
+                }
+                return False, resp
 
             resp = {
                 "status": "error",
@@ -339,6 +520,230 @@ class DeviceService:
 
             return False, resp
 
+    @staticmethod
+    def validate_devices_params(devices_params):
+        """
+        validate the parameters of a batch of devices at once
+        :param devices_params: list of dicts with 'model_name' and 'params'
+        :return:
+        """
+        errors = model_registry.validate_batch(devices_params)
+        if len(errors) > 0:
+            resp = {
+                "status": "error",
+                "msg": "{} of {} devices are invalid".format(len(errors), len(devices_params)),
+                "data": [{"index": i, "msg": error} for i, error in errors]
+            }
+            return False, resp
+
+        resp = {
+            "status": "success",
+            "msg": "device parameters are valid"
+        }
+        return True, resp
+
+    @staticmethod
+    def check_batch_limits(batch_params, max_devices, max_horizon):
+        """
+
+        :param batch_params: see run_batch_simulation
+        :param max_devices: largest number of devices of the batch
+        :param max_horizon: longest horizon of the batch in seconds
+        :return: (True, None) if the batch is within the limits else (False, resp)
+        """
+        if len(batch_params.get("devices") or []) > max_devices:
+            resp = {
+                "status": "error",
+                "msg": "batch must not contain more than {} devices".format(max_devices)
+            }
+            return False, resp
+        if float(batch_params.get("horizon", 0)) > max_horizon:
+            resp = {
+                "status": "error",
+                "msg": "batch horizon must not be longer than {} seconds".format(max_horizon)
+            }
+            return False, resp
+        return True, None
+
+    @staticmethod
+    def run_batch_simulation(batch_params, output_file=None):
+        """
+        simulate a set of devices over a given horizon as fast as possible, i.e., decoupled from the wall clock.
+        the devices are neither stored in the db nor added to the running simulations
+
+        :param batch_params: dict with 'start' (unix time, defaults to now), 'horizon' (seconds) and 'devices'
+                             (list of {device_name, model_name, params, schedule})
+        :param output_file: if given, the traces are written to this file chunk by chunk as a numpy archive (see
+                            batch_simulator.load_traces) instead of being returned, and a failure is described in
+                            output_file + '.error'
+        :return: (True, traces), or (True, number of simulated steps) with output_file, on success else (False, resp)
+        """
+        try:
+            start = float(batch_params.get("start", time.time()))
+            horizon = float(batch_params.get("horizon", 0))
+            devices = batch_params.get("devices") or []
+            if horizon <= 0 or len(devices) == 0:
+                resp = {
+                    "status": "error",
+                    "msg": "batch must contain a positive 'horizon' and at least one device in 'devices'"
+                }
+                return DeviceService.batch_failed(resp, output_file)
+
+            is_valid, resp = DeviceService.validate_devices_params(devices)
+            if not is_valid:
+                return DeviceService.batch_failed(resp, output_file)
+
+            simulations = []
+            for device_params in devices:
+                device_params = AttrDict(device_params)
+                model = model_registry.get(device_params.model_name)
+                simulation = DeviceSimulator(
+                    fmu_name=model.fmu_name,
+                    fmu_dir=params.model.fmu_dir,
+                    device_name=device_params.get("device_name", device_params.model_name),
+                    device_id=uuid.uuid4().hex,
+                    model_params=device_params.params,
+                    output_dir=params.model.output_dir,
+                    start_time=start,
+                    register=False,
+                    horizon=params.device.simulation_horizon,
+                    dormant_when_off=model.zero_when_off,
+                    variables=model.get_variables()
+                )
+                if device_params.get("schedule"):
+                    simulation.set_schedule(ControlSchedule.from_entries(device_params.schedule, start))
+                simulations.append(simulation)
+
+            writer = batch_simulator.TraceFileWriter(output_file) if output_file is not None else None
+            try:
+                result = batch_simulator.run_batch(simulations, horizon, writer, chunk_steps=params.batch.chunk_steps)
+            finally:
+                for simulation in simulations:
+                    simulation.terminate()
+            if output_file is not None:
+                LOGGER.info("Stored batch simulation traces in '%s'" % output_file)
+            return True, result
+        except Exception as e:
+            LOGGER.error(e)
+            resp = {
+                "status": "error",
+                "msg": "{}".format(e)
+            }
+            return DeviceService.batch_failed(resp, output_file)
+
+    @staticmethod
+    def batch_failed(resp, output_file):
+        if output_file is not None:
+            with open(output_file + ".error", 'w') as f:
+                f.write(resp["msg"])
+        return False, resp
+
+    @staticmethod
+    def start_batch_job(batch_params, username):
+        """
+        run a batch simulation in a separate process, whose traces are written to a file that the user can fetch
+        with get_batch_job once it is done
+
+        :param batch_params: see run_batch_simulation
+        :param username:
+        :return: (True, job id) on success else (False, resp)
+        """
+        if float(batch_params.get("horizon", 0)) <= 0 or len(batch_params.get("devices") or []) == 0:
+            resp = {
+                "status": "error",
+                "msg": "batch must contain a positive 'horizon' and at least one device in 'devices'"
+            }
+            return False, resp
+        is_valid, resp = DeviceService.validate_devices_params(batch_params.devices)
+        if not is_valid:
+            return False, resp
+        if jobs.count_running() >= params.batch.max_jobs:
+            resp = {
+                "status": "error",
+                "msg": "{} batch simulations are running already, try again later".format(params.batch.max_jobs)
+            }
+            return False, resp
+
+        return True, jobs.start(batch_params, username)
+
+    @staticmethod
+    def get_batch_job(job_id, username):
+        """
+
+        :param job_id:
+        :param username:
+        :return: (batch_jobs.RUNNING, None), (batch_jobs.DONE, path of the traces) or (batch_jobs.FAILED, error
+                 message), or None if the user has no such job
+        """
+        return jobs.status(job_id, username)
+
+    @staticmethod
+    def remove_batch_job(job_id):
+        jobs.remove(job_id)
+
+    @staticmethod
+    def export_consumption(export_params, file_path, session, username=None):
+        """
+        export the consumption data of a set of devices over a time range to a columnar file
+
+        :param export_params: dict with optional 'device_ids' (defaults to all devices), 'start' and 'end' (unix
+                              times) and 'format' (one of consumption_export.available_formats(), defaults to 'npz')
+        :param file_path:
+        :param session:
+        :param username: the user whose devices to export, devices of all users if None
+        :return: (True, number of exported rows) on success else (False, resp)
+        """
+        file_format = export_params.get("format", "npz")
+        if file_format not in consumption_export.available_formats():
+            resp = {
+                "status": "error",
+                "msg": "invalid format '{}'. available formats are: {}".format(
+                    file_format, ", ".join(consumption_export.available_formats()))
+            }
+            return False, resp
+
+        devices = device_repo.find_device(session, username) if username is not None else device_repo.find_all(session)
+        if export_params.get("device_ids") is not None:
+            device_ids = set(export_params.get("device_ids"))
+            devices = [device for device in devices if device.device_id in device_ids]
+            missing = device_ids - set(device.device_id for device in devices)
+            if len(missing) > 0:
+                resp = {
+                    "status": "error",
+                    "msg": "no devices with ids {} found".format(", ".join("'%s'" % i for i in sorted(missing)))
+                }
+                return False, resp
+        if len(devices) == 0:
+            resp = {
+                "status": "error",
+                "msg": "no devices to export"
+            }
+            return False, resp
+
+        start = float(export_params.get("start")) if export_params.get("start") is not None else None
+        end = float(export_params.get("end")) if export_params.get("end") is not None else None
+        return True, consumption_export.export(session, devices, file_path, file_format, start, end)
+
+    @staticmethod
+    def is_zero_when_off(model_name):
+        """
+        :param model_name:
+        :return True if the model's output is exactly zero while switched off:
+        """
+        model = model_registry.get(model_name)
+        return model is not None and model.zero_when_off
+
+    @staticmethod
+    def get_tick_interval(model_name):
+        """
+        :param model_name:
+        :return: seconds between two simulation steps of devices of the given model
+        """
+        model = model_registry.get(model_name)
+        if model is not None and model.tick_interval is not None:
+            return model.tick_interval
+        return params.device.tick_interval
+
     @staticmethod
     def is_device_active(device):
         """
@@ -353,7 +758,18 @@ class DeviceService:
 
     @staticmethod
     def is_device_simulating(device):
-        return device.device_id in DeviceSimulator.running_simulations
+        return DeviceSimulator.commands.is_simulating(device.device_id, DeviceSimulator.running_simulations)
+
+    @staticmethod
+    def get_simulation(device):
+        """
+        :param device:
+        :return: the simulator of the device, including simulators not yet picked up by the simulation loop
+        """
+        simulation = DeviceSimulator.running_simulations.get(device.device_id)
+        if simulation is None:
+            simulation = DeviceSimulator.commands.pending_starts.get(device.device_id)
+        return simulation
 
     @staticmethod
     def is_device_turned_off(device):
@@ -362,7 +778,7 @@ class DeviceService:
     @staticmethod
     def get_consumption_from_simulation(device):
         try:
-            return DeviceSimulator.running_simulations[device.device_id].get_measurements()
+            return DeviceService.get_simulation(device).get_measurements()
         except Exception as e:
             LOGGER.error(e)
             return None
@@ -372,90 +788,317 @@ class DeviceService:
         """
         Stop simulation of all devices
         """
-        lock = threading.Lock()
-        lock.acquire()
         for device_id in DeviceSimulator.running_simulations.keys():
-            del DeviceSimulator.running_simulations[device_id]
-        lock.release()
+            DeviceSimulator.commands.stop(device_id)
+            reconciler.hold(device_id)
         LOGGER.info("Stopped all simulations")
 
+    @staticmethod
+    def get_health():
+        """
+        :return: heartbeat and tick statistics of the simulation thread
+        """
+        health = watchdog.serialize() if watchdog is not None else {"healthy": False, "engine_alive": False}
+        health["running_simulations"] = len(DeviceSimulator.running_simulations)
+        health["queued_commands"] = len(DeviceSimulator.commands)
+        return health
+
+    @staticmethod
+    def get_memory_usage():
+        """
+        :return: resident memory of the process and the memory held by each running simulation
+        """
+        rss = None
+        if os.path.exists('/proc/self/status'):
+            with open('/proc/self/status') as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) * 1024
+        else:
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        devices = [dict(device_id=device_id, **simulation.memory_usage())
+                   for device_id, simulation in DeviceSimulator.running_simulations.items()]
+        return {
+            "rss": rss,
+            "running_simulations": len(devices),
+            "retired_simulations": len(DeviceSimulator.retired_simulations),
+            "gc_counts": gc.get_count(),
+            "reconciler": reconciler.serialize(),
+            "consumption_writer": consumption_writer.serialize() if consumption_writer is not None else None,
+            "buffers": sum(d["trajectory"] + d["schedule"] for d in devices),
+            "devices": devices
+        }
+
     @staticmethod
     def get_device_consumption(device):
         """
         :param device:
         :return:
         """
-        return [row.serialize() for row in device.consumption]
+        # fill in the rows that were left out by the compression of the stored consumption data
+        return compression.reconstruct(device_repo.get_consumption(device), params.device.storage_interval,
+                                       params.device.storage_max_silence, params.device.storage_compression)
 
-    def restore_device_simulations(self):
+    def restore_device_simulations(self, device_ids=None):
         """
         fetch all devices from the database, and start the device simulation if device state is 'active'
         but simulation is not running
+        :param device_ids: devices to restore (None for all devices, which are resumed from the checkpoint)
         :return:
         """
         LOGGER.info('Restoring device simulations')
-        lock = threading.Lock()
-        lock.acquire()
+        start_time = time.time()
+        checkpoints = checkpoint.load(params.device.checkpoint_file) if device_ids is None else dict()
+
+        # a single query for all non-inactive devices with their models loaded eagerly. the rows are copied to
+        # plain tuples, so that the simulators can be built outside of the session
         with session_scope() as session:
-            all_devices = self.get_all_devices_for_all_users(session)
-            for device in all_devices:
-                if device.device_state != DeviceTypeEnum.INACTIVE \
-                        and device.device_id not in DeviceSimulator.running_simulations:
-                    LOGGER.debug("device_id={}, device_state={},  is_device__simulation_running={}".format(
-                        device.device_id, device.device_state, device.device_id in DeviceSimulator.running_simulations))
-                    self.start_simulation(device, session)
-                    if device.device_state == DeviceTypeEnum.ON:
-                        self.turn_on_device(device, session)
-        lock.release()
+            devices = [(device.device_id, device.device_name, device.device_model.model_name,
+                        device.device_model.params, device.device_state, checkpoints.get(device.device_id))
+                       for device in (self.device_repo.find_active(session) if device_ids is None
+                                      else self.device_repo.find_active_by_ids(device_ids, session))
+                       if device.device_model is not None and not self.is_device_simulating(device)]
+        if len(devices) == 0:
+            return
+
+        # loading and initializing FMUs dominates, so the simulators are built in parallel
+        pool = ThreadPool(params.device.restore_workers)
+        try:
+            simulations = pool.map(DeviceService.restore_simulation, devices)
+        finally:
+            pool.close()
+            pool.join()
+
+        # the device states in the db are already correct, so only the simulators need to be started. the db state
+        # takes precedence over the power state of a checkpoint
+        for (device_id, _, _, _, device_state, _), simulation in zip(devices, simulations):
+            if simulation is None:
+                continue
+            DeviceSimulator.commands.start(simulation)
+            if device_state == DeviceTypeEnum.ON:
+                DeviceSimulator.commands.put(command_queue.CONTROL, device_id, {'u': 1.0})
+            elif simulation.get_power_state():
+                DeviceSimulator.commands.put(command_queue.CONTROL, device_id, {'u': 0.0})
+
+        LOGGER.info("Restored {} of {} device simulations in {:.2f} seconds".format(
+            len([s for s in simulations if s is not None]), len(devices), time.time() - start_time))
+
+    @staticmethod
+    def restore_simulation(device):
+        """
+        :param device: tuple of (device_id, device_name, model_name, model_params, device_state, checkpoint)
+        :return: instance of DeviceSimulator, or None if the simulator could not be created
+        """
+        device_id, device_name, model_name, model_params, _, device_checkpoint = device
+        try:
+            simulation = DeviceService.create_simulation(device_id, device_name, model_name, model_params)
+            if device_checkpoint is not None:
+                simulation.restore_checkpoint(device_checkpoint)
+                LOGGER.debug("Resumed simulation of device_id '%s' from checkpoint taken %.0f seconds ago"
+                             % (device_id, simulation.t - device_checkpoint["t"]))
+            return simulation
+        except Exception as e:
+            LOGGER.error("Failed to restore simulation of device_id '%s': %s" % (device_id, e))
+            return None
 
     @staticmethod
     def store_device_consumption_data():
         """
-        stores power consumption for each active device
+        samples power consumption for each active device, and hands the samples to the consumption writer, so that
+        sampling does not wait for the db
         :return:
         """
         global t2
+        start_time = time.time()
         if len(DeviceSimulator.running_simulations) > 0:
-            with session_scope() as session:
-                try:
-                    LOGGER.info("Storing device consumption data")
-                    for device_id in DeviceSimulator.running_simulations:
-
-                        device = device_repo.find_device_by_id(device_id, session)
-                        if device.device_state != DeviceTypeEnum.ON:
-                            continue
-
-                        measurement = DeviceSimulator.running_simulations[device_id].get_measurements()
-                        power = measurement["power"]
-                        energy = measurement["energy"]
-                        state = DeviceSimulator.running_simulations[device_id].get_power_state()
-
-                        device_consumption = DeviceConsumption(power, energy, state, datetime.datetime.now())
-                        if device is not None:
-                            device_repo.add_device_consumption(device, device_consumption, session)
-
-                    LOGGER.debug("completed storing device consumption data")
-                except Exception as e:
-                    LOGGER.error(e)
-        t2 = threading.Timer(params.device.storage_interval, DeviceService.store_device_consumption_data)
+            try:
+                with session_scope() as session:
+                    DeviceService.store_scheduled_state_changes(session)
+            except Exception as e:
+                LOGGER.error(e)
+
+            try:
+                LOGGER.info("Storing device consumption data")
+                stored_devices = set()
+                samples = []
+                for device_id, simulation in DeviceSimulator.running_simulations.items():
+                    if not simulation.get_power_state():
+                        continue
+                    stored_devices.add(device_id)
+
+                    measurement = simulation.get_measurements()
+                    sample = (time.time(), measurement["power"], measurement["energy"], simulation.get_power_state())
+
+                    if device_id not in compressors:
+                        compressors[device_id] = compression.create_compressor(
+                            params.device.storage_compression, params.device.storage_deadband,
+                            params.device.storage_max_silence)
+                    samples.extend((device_id,) + s for s in (
+                        compressors[device_id].offer(sample) if compressors[device_id] is not None else [sample]))
+
+                # the series of devices that are no longer on end here, with their pending samples and a row of the
+                # device being off
+                for device_id in [i for i in compressors.keys() if i not in stored_devices]:
+                    compressor = compressors.pop(device_id)
+                    if compressor is None:
+                        continue
+                    simulation = DeviceSimulator.running_simulations.get(device_id)
+                    energy = simulation.get_measurements()["energy"] if simulation is not None else None
+                    samples.extend((device_id,) + s for s in compressor.end(time.time(), energy))
+
+                consumption_writer.put(samples)
+                LOGGER.debug("completed sampling device consumption data")
+            except Exception as e:
+                LOGGER.error(e)
+        # the interval is kept from start to start
+        t2 = threading.Timer(max(0, params.device.storage_interval - (time.time() - start_time)),
+                             DeviceService.store_device_consumption_data)
         t2.start()
 
+    @staticmethod
+    def apply_consumption_retention():
+        """
+        roll up and delete old consumption data according to the retention policy
+        :return:
+        """
+        global t3
+        with session_scope() as session:
+            try:
+                start_time = time.time()
+                rolled_up = consumption_retention.run(session, params.retention, storage=params.device)
+                LOGGER.info("Rolled up %d raw consumption rows and %d hourly aggregates in %.1f seconds"
+                            % (rolled_up["raw"], rolled_up["hourly"], time.time() - start_time))
+            except Exception as e:
+                LOGGER.error("Failed to apply consumption retention: %s" % e)
+        t3 = threading.Timer(params.retention.interval, DeviceService.apply_consumption_retention)
+        t3.setDaemon(True)
+        t3.start()
+
+    @staticmethod
+    def apply_commands():
+        """
+        apply all commands queued by the request handlers. called by the simulation loop at each tick boundary,
+        which makes the loop the only writer of simulator state
+        """
+        for command, device_id, payload in DeviceSimulator.commands.drain():
+            # the commands are already taken from the queue, so a failing one must not keep the others from applying
+            try:
+                DeviceService.apply_command(command, device_id, payload)
+            except Exception as e:
+                LOGGER.error("Failed to apply '%s' command for device_id '%s': %s" % (command, device_id, e))
+
+        # free the FMU instances of stopped simulations
+        DeviceSimulator.release_retired()
+
+    @staticmethod
+    def apply_command(command, device_id, payload):
+        """
+        :param command: one of the commands of command_queue
+        :param device_id:
+        :param payload: the simulator for START, else the argument of the command (if any)
+        """
+        if command == command_queue.START:
+            DeviceSimulator.commands.started(payload)
+            if device_id in DeviceSimulator.running_simulations:
+                payload.terminate()  # started twice, keep the running one
+            else:
+                DeviceSimulator.running_simulations[device_id] = payload
+                scheduler.schedule(device_id, payload.t)
+        elif command in (command_queue.STOP, command_queue.DELETE):
+            DeviceSimulator.commands.pending_stops.discard(device_id)
+            DeviceSimulator.retire(device_id)
+            scheduler.remove(device_id)
+            if command == command_queue.DELETE:
+                DeviceSimulator.pending_state_changes.pop(device_id, None)
+                TraceBuffer.remove(DeviceService.get_trace_directory(device_id))
+        elif device_id not in DeviceSimulator.running_simulations:
+            LOGGER.warn("Dropped '%s' command for device_id '%s' which is not simulating" % (command, device_id))
+        elif command == command_queue.CONTROL:
+            DeviceSimulator.running_simulations[device_id].apply_control(payload)
+        elif command == command_queue.SCHEDULE:
+            DeviceSimulator.running_simulations[device_id].set_schedule(payload)
+        elif command == command_queue.PARAMS:
+            DeviceSimulator.running_simulations[device_id].set_params(payload)
+        elif command == command_queue.TRACE:
+            if payload['enabled']:
+                DeviceSimulator.running_simulations[device_id].enable_trace(
+                    DeviceService.get_trace_directory(device_id), params.trace.capacity)
+            else:
+                DeviceSimulator.running_simulations[device_id].disable_trace()
+
+    @staticmethod
+    def store_checkpoint(in_background=False):
+        """
+        checkpoint the state of all running simulations. the snapshot is taken right away, writing it to disk
+        can be done in a background thread to not delay the simulation loop
+
+        :param in_background:
+        :return:
+        """
+        try:
+            snapshot = checkpoint.snapshot(DeviceSimulator.running_simulations.values())
+        except Exception as e:
+            LOGGER.error("Failed to checkpoint simulations: %s" % e)
+            return
+
+        if in_background:
+            t = threading.Thread(target=checkpoint.save, args=(snapshot, params.device.checkpoint_file))
+            t.setDaemon(True)
+            t.start()
+        else:
+            checkpoint.save(snapshot, params.device.checkpoint_file)
+
     @staticmethod
     def run_simulation():
         # global t1
+        tick = 0
+        # the loop may be restarted by the watchdog, so the schedule is rebuilt from the running simulations
+        scheduler.reset(DeviceSimulator.running_simulations)
         while not stop_event.is_set():
-            LOGGER.debug("Executing simulation step for all active loads!")
+            LOGGER.debug("Executing simulation step for all due loads!")
             start_time = time.time()
-            lock = threading.Lock()
-            lock.acquire()
-            for device_id in DeviceSimulator.running_simulations.keys():
-                LOGGER.debug("Running simulation of device with id: %s" % device_id)
-                DeviceSimulator.running_simulations[device_id].run_step()  # run simulation
-                DeviceSimulator.running_simulations[device_id].print_info(print_extra=False)  # print debug info
-            lock.release()
-            time.sleep(1.0)
-            gc.collect()
-            LOGGER.info("Simulation step completed. Time taken: {:.2f} seconds. Number of devices: {}".format(time.time()-start_time, len(DeviceSimulator.running_simulations)))
+            DeviceService.apply_commands()
+
+            # each simulation is stepped once its clock is due, so devices with a tick interval of n seconds are
+            # stepped every n seconds
+            due = scheduler.pop_due(start_time)
+            simulations = [DeviceSimulator.running_simulations[device_id] for device_id in due
+                           if device_id in DeviceSimulator.running_simulations]
+            # identical devices are stepped once per class, the other members take over the output of that step
+            classes = equivalence.group(simulations) if params.device.deduplicate else [(s, []) for s in simulations]
+            num_dormant = 0
+            num_followed = 0
+            for simulation, followers in classes:
+                if simulation.is_dormant() and simulation.schedule is None:
+                    # switched off devices only need their clock advanced
+                    simulation.idle_step()
+                    num_dormant += 1
+                else:
+                    LOGGER.debug("Running simulation of device with id: %s" % simulation.device_id)
+                    simulation.run_step()  # run simulation
+                    simulation.print_info(print_extra=False)  # print debug info
+                scheduler.schedule(simulation.device_id, simulation.t)
+                for follower in followers:
+                    follower.follow(simulation)
+                    scheduler.schedule(follower.device_id, follower.t)
+                num_followed += len(followers)
+            if watchdog is not None:
+                watchdog.beat(time.time() - start_time)
+
+            # sleep until the next step is due, but wake up at least every second to apply commands
+            next_due = scheduler.next_due()
+            time.sleep(1.0 if next_due is None else min(1.0, max(0.0, next_due - time.time())))
+            # stopped simulations are released explicitly, so a full collection is only needed once in a while
+            tick += 1
+            if params.device.gc_interval > 0 and tick % params.device.gc_interval == 0:
+                gc.collect()
+            if params.device.checkpoint_interval > 0 and tick % params.device.checkpoint_interval == 0:
+                DeviceService.store_checkpoint(in_background=True)
+            LOGGER.info("Simulation step completed. Time taken: {:.2f} seconds. Number of devices: {} ({} stepped, {} "
+                        "dormant, {} followed)".format(time.time() - start_time,
+                                                       len(DeviceSimulator.running_simulations), len(due), num_dormant,
+                                                       num_followed))
             # t1 = threading.Timer(15, DeviceService.run_simulation)
             # t1.start()
         LOGGER.warn("Simulation thread stopped")
@@ -467,26 +1110,53 @@ class DeviceService:
         second param is the target function
         :return:
         """
+        # the reconciler restores the simulations that were interrupted due to system crash/restart, and then keeps
+        # the running simulations in line with the db
         LOGGER.info('Starting thread to restore simulations that were interrupted due to system crash/restart')
-        t = threading.Thread(target=DeviceService().restore_device_simulations)
-        t.setDaemon(True)
-        t.start()
-
-        LOGGER.info('Starting thread for periodic running of device simulations')
-        tt = threading.Thread(target=DeviceService.run_simulation)
-        tt.setDaemon(True)
-        tt.start()
+        reconciler.start()
+
+        # the watchdog starts the simulation thread and restarts it whenever it dies
+        global watchdog
+        watchdog = SimulationWatchdog(DeviceService.run_simulation, stop_event,
+                                      stall_timeout=params.device.watchdog_timeout)
+        watchdog.start()
         # DeviceService.run_simulation()
 
+        global consumption_writer
+        consumption_writer = ConsumptionWriter(stop_event, params.device.spill_file,
+                                               queue_size=params.device.writer_queue_size,
+                                               batch_size=params.device.writer_batch_size,
+                                               max_backoff=params.device.writer_max_backoff)
+        consumption_writer.start()
+
         LOGGER.info('Starting thread for periodic storage of device consumption data')
         DeviceService.store_device_consumption_data()
 
+        if params.retention.raw_days > 0:
+            LOGGER.info('Starting thread for periodic retention of device consumption data')
+            global t3
+            t3 = threading.Timer(params.retention.interval, DeviceService.apply_consumption_retention)
+            t3.setDaemon(True)
+            t3.start()
+
     @staticmethod
     def stop_threads():
         # global t1
         global t2
+        global t3
         # t1.cancel()
         t2.cancel()
+        if t3 is not None:
+            t3.cancel()
         stop_event.set()
+        # the final checkpoint is taken once the simulation loop is out of its tick, as it reads the FMU instances
+        if watchdog is None or watchdog.join_engine(params.device.watchdog_timeout):
+            DeviceService.store_checkpoint()
+        else:
+            LOGGER.warn("Simulation thread did not stop within %s seconds, skipping the final checkpoint"
+                        % params.device.watchdog_timeout)
+        if consumption_writer is not None:
+            # queued samples are written, or spilled if the db cannot be reached
+            consumption_writer.join(params.device.writer_max_backoff)
         LOGGER.info('Stopped all threads')
 
@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+
+from app.data.database import session_scope
+from app.data.repository import device_repo
+from app.simulator.device_simulator import DeviceSimulator
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SimulationReconciler(threading.Thread):
+    """
+    This class keeps the set of devices that should be simulating, and periodically starts the simulations that are
+    missing (e.g., because they failed to start or were lost) and stops the ones that are not wanted. the set is
+    maintained from the events of the device service, and checked against the ids in the db once in a while
+    """
+
+    def __init__(self, restore, stop_event, interval=5.0, full_check_interval=60.0, max_attempts=5):
+        """
+
+        :param restore: function taking a list of device_ids (or None for all devices), which starts the simulations
+                        of the given devices
+        :param stop_event: event that is set to stop the reconciler
+        :param interval: seconds between two comparisons of the wanted with the running simulations
+        :param full_check_interval: seconds between two checks of the wanted simulations against the db
+        :param max_attempts: number of attempts to start a simulation, after which the device is given up on until
+                             it is started or activated again
+        """
+        threading.Thread.__init__(self, name="simulation-reconciler")
+        self.setDaemon(True)
+
+        self.restore = restore
+        self.stop_event = stop_event
+        self.interval = interval
+        self.full_check_interval = full_check_interval
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+        # device_ids that should be simulating
+        self.desired = set()
+        # device_ids that are active in the db, but whose simulation was stopped on request
+        self.held = set()
+        # incremented on every event, to detect events that happened while the db was read
+        self.version = 0
+        # device_id -> (time of the next attempt to start the simulation, seconds to wait after that attempt,
+        # number of attempts so far)
+        self.retries = dict()
+        # device_ids whose simulation could not be started within max_attempts (e.g., the model cannot be loaded)
+        self.failed = set()
+
+        self.last_full_check = None
+        self.restored = 0
+        self.stopped = 0
+        self.resyncs = 0
+
+    def want(self, device_id):
+        """
+        the device was started or activated
+        """
+        with self.lock:
+            self.desired.add(device_id)
+            self.held.discard(device_id)
+            self.failed.discard(device_id)
+            self.retries.pop(device_id, None)
+            self.version += 1
+
+    def hold(self, device_id):
+        """
+        the simulation of the device was stopped, but the device stays active
+        """
+        with self.lock:
+            self.desired.discard(device_id)
+            self.held.add(device_id)
+            self.version += 1
+
+    def unwant(self, device_id):
+        """
+        the device was deactivated or deleted
+        """
+        with self.lock:
+            self.desired.discard(device_id)
+            self.held.discard(device_id)
+            self.failed.discard(device_id)
+            self.retries.pop(device_id, None)
+            self.version += 1
+
+    def run(self):
+        LOGGER.info('Starting thread for reconciling device simulations with the db')
+        try:
+            self.full_check(force=True)
+            # on start up all simulations are restored at once, from the checkpoint if there is one
+            self.restore(None)
+        except Exception as e:
+            LOGGER.error("Failed to restore device simulations: %s" % e)
+
+        while not self.stop_event.wait(self.interval):
+            try:
+                if time.time() - self.last_full_check >= self.full_check_interval:
+                    self.full_check()
+                self.reconcile()
+            except Exception as e:
+                LOGGER.error("Failed to reconcile device simulations: %s" % e)
+        LOGGER.info("Simulation reconciler stopped")
+
+    def full_check(self, force=False):
+        """
+        compare the ids of the devices to simulate in the db with the wanted ones. ids are compared rather than
+        counted, as a device that stopped and another one that started in between leave the count unchanged
+        """
+        self.last_full_check = time.time()
+        with self.lock:
+            version = self.version
+        with session_scope() as session:
+            device_ids = set(device_repo.find_simulated_ids(session))
+
+        with self.lock:
+            if self.version != version:
+                # an event changed the sets while reading, so the check is repeated at the next round
+                self.last_full_check = 0
+                return
+            self.held &= device_ids
+            self.failed &= device_ids
+            desired = device_ids - self.held
+            if not force and desired != self.desired:
+                LOGGER.warn("Wanted simulations differ from the db: %d added, %d removed" % (
+                    len(desired - self.desired), len(self.desired - desired)))
+                self.resyncs += 1
+            self.desired = desired
+
+    def reconcile(self):
+        """
+        start the missing simulations and stop the unwanted ones
+        """
+        running = set(DeviceSimulator.running_simulations.keys())
+        starting = set(DeviceSimulator.commands.pending_starts.keys())
+        stopping = set(DeviceSimulator.commands.pending_stops)
+        now = time.time()
+
+        with self.lock:
+            missing = [device_id for device_id in self.desired - running - starting - self.failed
+                       if self.retries.get(device_id, (0, 0, 0))[0] <= now]
+            unwanted = running - self.desired - stopping
+            for device_id in running:
+                self.retries.pop(device_id, None)
+            # attempts to start a simulation are spaced out exponentially, in case it fails to start every time, and
+            # given up after max_attempts
+            for device_id in list(missing):
+                _, delay, attempts = self.retries.get(device_id, (0, self.interval / 2, 0))
+                if attempts >= self.max_attempts:
+                    LOGGER.error("Giving up on starting the simulation of device_id '%s' after %d attempts"
+                                 % (device_id, attempts))
+                    self.retries.pop(device_id)
+                    self.failed.add(device_id)
+                    missing.remove(device_id)
+                    continue
+                self.retries[device_id] = (now + delay, min(2 * delay, self.full_check_interval), attempts + 1)
+
+        if len(missing) > 0:
+            LOGGER.warn("Starting %d missing device simulations" % len(missing))
+            self.restore(missing)
+            self.restored += len(missing)
+        for device_id in unwanted:
+            LOGGER.warn("Stopping unwanted simulation of device_id '%s'" % device_id)
+            DeviceSimulator.commands.stop(device_id)
+            self.stopped += 1
+
+    def serialize(self):
+        return {
+            "desired": len(self.desired),
+            "held": len(self.held),
+            "failed": len(self.failed),
+            "restored": self.restored,
+            "stopped": self.stopped,
+            "resyncs": self.resyncs,
+            "last_full_check": self.last_full_check
+        }
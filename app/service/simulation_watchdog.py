@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+import traceback
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SimulationWatchdog(threading.Thread):
+    """This class supervises the simulation thread and restarts it if it dies"""
+
+    def __init__(self, target, stop_event, check_interval=1.0, stall_timeout=10.0):
+        """
+
+        :param target: the simulation loop, which must call beat() after every tick
+        :param stop_event: event that is set to stop both the simulation loop and the watchdog
+        :param check_interval: seconds between two checks of the simulation thread
+        :param stall_timeout: seconds without a heartbeat after which the simulation is reported as stalled
+        """
+        threading.Thread.__init__(self, name="simulation-watchdog")
+        self.setDaemon(True)
+
+        self.target = target
+        self.stop_event = stop_event
+        self.check_interval = check_interval
+        self.stall_timeout = stall_timeout
+
+        self.engine = None
+        self.started_at = None
+        self.last_tick_time = None
+        self.last_tick_duration = None
+        self.ticks = 0
+        self.restarts = 0
+        self.last_error = None
+
+    def beat(self, tick_duration):
+        """
+        record a completed tick of the simulation loop
+        """
+        self.last_tick_time = time.time()
+        self.last_tick_duration = tick_duration
+        self.ticks += 1
+
+    def run_engine(self):
+        try:
+            self.target()
+        except Exception as e:
+            self.last_error = "{}: {}".format(e.__class__.__name__, e)
+            LOGGER.error("Simulation thread died: %s\n%s" % (self.last_error, traceback.format_exc()))
+
+    def start_engine(self):
+        self.engine = threading.Thread(target=self.run_engine, name="simulation")
+        self.engine.setDaemon(True)
+        self.engine.start()
+        self.started_at = time.time()
+
+    def run(self):
+        LOGGER.info('Starting thread for periodic running of device simulations')
+        self.start_engine()
+        while not self.stop_event.wait(self.check_interval):
+            if not self.engine.is_alive():
+                self.restarts += 1
+                LOGGER.warn("Restarting simulation thread (restart #%d)" % self.restarts)
+                self.start_engine()
+        LOGGER.info("Simulation watchdog stopped")
+
+    def join_engine(self, timeout):
+        """
+        wait for the watchdog and the simulation thread to exit, once the stop event is set
+
+        :param timeout: seconds to wait for each of them
+        :return: whether the simulation thread has exited
+        """
+        self.join(timeout)
+        if self.engine is not None:
+            self.engine.join(timeout)
+        return self.engine is None or not self.engine.is_alive()
+
+    def heartbeat_age(self):
+        since = self.last_tick_time if self.last_tick_time is not None else self.started_at
+        return time.time() - since if since is not None else None
+
+    def is_healthy(self):
+        age = self.heartbeat_age()
+        return self.engine is not None and self.engine.is_alive() and age is not None and age < self.stall_timeout
+
+    def serialize(self):
+        return {
+            "healthy": self.is_healthy(),
+            "engine_alive": self.engine is not None and self.engine.is_alive(),
+            "heartbeat_age": self.heartbeat_age(),
+            "last_tick_time": self.last_tick_time,
+            "last_tick_duration": self.last_tick_duration,
+            "ticks": self.ticks,
+            "restarts": self.restarts,
+            "last_error": self.last_error
+        }
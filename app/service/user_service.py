@@ -112,6 +112,16 @@ class UserService:
         """
         return user_repo.find_user(session)
 
+    @staticmethod
+    def serialize_users(users, session):
+        """
+
+        :param users:
+        :param session:
+        :return a list of the given users as dictionaries:
+        """
+        return user_repo.serialize_users(users, session)
+
     def get_devices(self, username, session):
         """
 
@@ -0,0 +1,159 @@
+import io
+import logging
+import math
+import os
+import time
+import zipfile
+
+import numpy as np
+
+from app.simulator.device_simulator import Ws2kWh
+
+LOGGER = logging.getLogger(__name__)
+
+# number of steps simulated for all devices before the traces are handed to the writer
+CHUNK_STEPS = 3600
+
+
+def run_batch(simulations, horizon, writer=None, chunk_steps=CHUNK_STEPS):
+    """
+
+    simulate the given devices over the horizon as fast as possible, i.e., without waiting for the wall clock.
+    all simulations must share the same start time and step size.
+
+    :param simulations: list of DeviceSimulator instances created with register=False
+    :param horizon: length of the simulated period in seconds
+    :param writer: receives the traces chunk by chunk (e.g., a TraceFileWriter, so that the traces of long horizons
+                   are never held in memory). the traces are collected and returned if None
+    :param chunk_steps: number of steps per chunk
+    :return: what writer.close() returns, i.e., for the default writer a dict with the shared time grid and per
+             device power (W), energy (kWh) and on/off state traces
+    """
+    dt = simulations[0].dt
+    steps = int(math.ceil(float(horizon) / dt))
+    writer = writer if writer is not None else TraceCollector()
+    writer.open([simulation.device_id for simulation in simulations],
+                [simulation.device_name for simulation in simulations])
+
+    start_time = time.time()
+    for chunk_start in range(0, steps, chunk_steps):
+        chunk_length = min(chunk_steps, steps - chunk_start)
+        chunk = {
+            "time": simulations[0].t + dt * np.arange(1, chunk_length + 1, dtype=np.float64),
+            "power": np.zeros((len(simulations), chunk_length), dtype=np.float32),
+            "energy": np.zeros((len(simulations), chunk_length), dtype=np.float64),
+            "state": np.zeros((len(simulations), chunk_length), dtype=np.uint8)
+        }
+        for step in range(chunk_length):
+            for i, simulation in enumerate(simulations):
+                simulation.run_step()
+                chunk["power"][i, step] = simulation.live_power_reading
+                chunk["energy"][i, step] = simulation.total_power_reading * Ws2kWh
+                chunk["state"][i, step] = simulation.get_power_state()
+        writer.write(chunk)
+
+    LOGGER.info("Batch simulation of {} devices over {} steps completed in {:.2f} seconds".format(
+        len(simulations), steps, time.time() - start_time))
+    return writer.close()
+
+
+class TraceCollector:
+    """This class keeps the chunks of traces of a batch simulation in memory, and joins them at the end"""
+
+    def __init__(self):
+        self.device_id = None
+        self.device_name = None
+        self.chunks = []
+
+    def open(self, device_id, device_name):
+        self.device_id = device_id
+        self.device_name = device_name
+
+    def write(self, chunk):
+        self.chunks.append(chunk)
+
+    def close(self):
+        return join_chunks(self.device_id, self.device_name, self.chunks)
+
+
+class TraceFileWriter:
+    """
+    This class writes the chunks of traces of a batch simulation to a numpy archive as soon as they are simulated.
+    each chunk is stored as separate arrays ('time_00000', 'power_00000', ...), which load_traces() joins again. the
+    archive is written under a temporary name, and only appears under its own name once it is complete
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.archive = None
+        self.chunks = 0
+        self.steps = 0
+
+    def open(self, device_id, device_name):
+        self.archive = zipfile.ZipFile(self.file_path + ".part", 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.add("device_id", np.array(device_id))
+        self.add("device_name", np.array(device_name))
+
+    def add(self, name, array):
+        buf = io.BytesIO()
+        np.lib.format.write_array(buf, np.asanyarray(array))
+        self.archive.writestr(name + ".npy", buf.getvalue())
+
+    def write(self, chunk):
+        for key in ("time", "power", "energy", "state"):
+            self.add("%s_%05d" % (key, self.chunks), chunk[key])
+        self.chunks += 1
+        self.steps += len(chunk["time"])
+
+    def close(self):
+        """
+        :return: number of simulated steps
+        """
+        self.add("chunks", np.array(self.chunks))
+        self.archive.close()
+        os.rename(self.file_path + ".part", self.file_path)
+        return self.steps
+
+
+def join_chunks(device_id, device_name, chunks):
+    return {
+        "time": np.concatenate([chunk["time"] for chunk in chunks]),
+        "device_id": list(device_id),
+        "device_name": list(device_name),
+        "power": np.concatenate([chunk["power"] for chunk in chunks], axis=1),
+        "energy": np.concatenate([chunk["energy"] for chunk in chunks], axis=1),
+        "state": np.concatenate([chunk["state"] for chunk in chunks], axis=1)
+    }
+
+
+def load_traces(file_path):
+    """
+
+    read the traces written by a TraceFileWriter
+
+    :param file_path:
+    :return: traces in the format returned by run_batch()
+    """
+    data = np.load(file_path)
+    try:
+        chunks = [{key: data["%s_%05d" % (key, k)] for key in ("time", "power", "energy", "state")}
+                  for k in range(int(data["chunks"]))]
+        return join_chunks(data["device_id"].tolist(), data["device_name"].tolist(), chunks)
+    finally:
+        data.close()
+
+
+def serialize_traces(traces):
+    return {
+        "time": traces["time"].tolist(),
+        "devices": [
+            {
+                "device_id": device_id,
+                "device_name": traces["device_name"][i],
+                "power": traces["power"][i].tolist(),
+                "energy": traces["energy"][i].tolist(),
+                "state": traces["state"][i].tolist()
+            }
+            for i, device_id in enumerate(traces["device_id"])
+        ]
+    }
@@ -0,0 +1,78 @@
+import logging
+import os
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+
+def snapshot(simulations):
+    """
+
+    take a compact snapshot of the state of the given simulations
+
+    :param simulations: list of DeviceSimulator instances
+    :return: dict of numpy arrays, continuous states of all devices are concatenated into 'x_values'
+    """
+    states = [simulation.get_checkpoint() for simulation in simulations]
+    x_lengths = [len(state["x"]) for state in states]
+
+    return {
+        "device_id": np.array([state["device_id"] for state in states], dtype='S32'),
+        "t": np.array([state["t"] for state in states], dtype=np.float64),
+        "energy": np.array([state["energy"] for state in states], dtype=np.float64),
+        "power": np.array([state["power"] for state in states], dtype=np.float64),
+        "power_state": np.array([state["power_state"] for state in states], dtype=np.uint8),
+        "u": np.array([state["u"] for state in states], dtype=np.float64),
+        "v": np.array([state["v"] for state in states], dtype=np.float64),
+        "x_offsets": np.concatenate(([0], np.cumsum(x_lengths))).astype(np.int64),
+        "x_values": np.concatenate([state["x"] for state in states] + [np.empty(0)]).astype(np.float64)
+    }
+
+
+def save(checkpoint, file_path):
+    """
+
+    write the checkpoint to a single binary file. the file is replaced atomically, so a crash while writing
+    leaves the previous checkpoint intact
+
+    :param checkpoint: as returned by snapshot()
+    :param file_path:
+    :return:
+    """
+    tmp_file_path = file_path + ".tmp"
+    with open(tmp_file_path, 'wb') as checkpoint_file:
+        np.savez(checkpoint_file, **checkpoint)
+    os.rename(tmp_file_path, file_path)
+    LOGGER.debug("Stored checkpoint of {} simulations in '{}'".format(len(checkpoint["device_id"]), file_path))
+
+
+def load(file_path):
+    """
+
+    :param file_path:
+    :return: dict of device_id -> state as taken by DeviceSimulator.get_checkpoint(), empty if there is no checkpoint
+    """
+    if not os.path.exists(file_path):
+        return dict()
+
+    try:
+        data = np.load(file_path)
+        x_offsets = data["x_offsets"]
+        x_values = data["x_values"]
+        return {
+            device_id.decode(): {
+                "device_id": device_id.decode(),
+                "t": float(data["t"][i]),
+                "energy": float(data["energy"][i]),
+                "power": float(data["power"][i]),
+                "power_state": int(data["power_state"][i]),
+                "u": float(data["u"][i]),
+                "v": float(data["v"][i]),
+                "x": x_values[x_offsets[i]:x_offsets[i + 1]]
+            }
+            for i, device_id in enumerate(data["device_id"])
+        }
+    except Exception as e:
+        LOGGER.error("Failed to load checkpoint '%s': %s" % (file_path, e))
+        return dict()
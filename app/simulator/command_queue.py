@@ -0,0 +1,62 @@
+from collections import deque
+
+# commands understood by the simulation loop
+START = "start"
+STOP = "stop"
+DELETE = "delete"
+CONTROL = "control"
+SCHEDULE = "schedule"
+TRACE = "trace"
+PARAMS = "params"
+
+
+class CommandQueue:
+    """
+    This class provides a multi-producer, single-consumer channel of commands from the request handlers to the
+    simulation loop, which is the only writer of simulator state. Appending to and popping from a deque are atomic,
+    so no locks are needed.
+    """
+
+    def __init__(self):
+        self.commands = deque()
+        # simulators that are created but not yet picked up by the simulation loop
+        self.pending_starts = dict()
+        # ids of devices whose simulation is to be stopped at the next tick boundary
+        self.pending_stops = set()
+
+    def put(self, command, device_id, payload=None):
+        self.commands.append((command, device_id, payload))
+
+    def start(self, simulation):
+        self.pending_stops.discard(simulation.device_id)
+        self.pending_starts[simulation.device_id] = simulation
+        self.put(START, simulation.device_id, simulation)
+
+    def started(self, simulation):
+        """
+        the simulation loop picked up the simulator, which is no longer pending unless it was replaced in the meantime
+        """
+        pending = self.pending_starts.pop(simulation.device_id, None)
+        if pending is not None and pending is not simulation:
+            self.pending_starts.setdefault(simulation.device_id, pending)
+
+    def stop(self, device_id, command=STOP):
+        self.pending_starts.pop(device_id, None)
+        self.pending_stops.add(device_id)
+        self.put(command, device_id)
+
+    def is_simulating(self, device_id, running_simulations):
+        """
+        :return: whether the device is simulating once all queued commands are applied
+        """
+        return device_id in self.pending_starts \
+            or (device_id in running_simulations and device_id not in self.pending_stops)
+
+    def drain(self):
+        """
+        :return: all commands that were queued before the call, in order of arrival
+        """
+        return [self.commands.popleft() for _ in range(len(self.commands))]
+
+    def __len__(self):
+        return len(self.commands)
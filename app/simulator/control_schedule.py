@@ -0,0 +1,99 @@
+import numpy as np
+
+
+class ControlSchedule:
+    """This class holds a time-indexed trajectory of control signals for a single device"""
+
+    def __init__(self, times, u, v=None):
+        """
+
+        :param times: absolute (unix) times in seconds at which the control signals become effective
+        :param u: on/off control signal for each time
+        :param v: optional set point for each time (NaN where not specified)
+        """
+        times = np.asarray(times, dtype=np.float64)
+        order = np.argsort(times, kind='mergesort')  # stable, so later entries win for equal times
+
+        self.times = times[order]
+        self.u = np.asarray(u, dtype=np.int8)[order]
+        self.v = np.asarray(v, dtype=np.float32)[order] if v is not None else None
+        self.cursor = 0
+
+    @classmethod
+    def from_entries(cls, entries, start=None):
+        """
+
+        build a schedule from a list of entries such as [{"time": 0, "u": 1}, {"time": 3600, "u": 0}]
+
+        :param entries: list of dicts with keys 'time' (offset in seconds from start), 'u' and optionally 'v'
+        :param start: unix time in seconds that the offsets are relative to (defaults to 0, i.e., absolute times)
+        :return: a new ControlSchedule
+        :raise ValueError: if an entry is malformed
+        """
+        if not entries:
+            raise ValueError("schedule must contain at least one entry")
+
+        start = float(start) if start is not None else 0.0
+        times = np.empty(len(entries), dtype=np.float64)
+        u = np.empty(len(entries), dtype=np.int8)
+        v = np.full(len(entries), np.nan, dtype=np.float32)
+        has_v = False
+
+        for i, entry in enumerate(entries):
+            if 'time' not in entry or 'u' not in entry:
+                raise ValueError("schedule entry %d must contain 'time' and 'u'" % i)
+            if float(entry['time']) < 0:
+                raise ValueError("schedule entry %d has a negative time offset" % i)
+            if float(entry['u']) not in (0.0, 1.0):
+                raise ValueError("schedule entry %d has invalid 'u'. valid values are: 0, 1" % i)
+            times[i] = start + float(entry['time'])
+            u[i] = int(float(entry['u']))
+            if entry.get('v') is not None:
+                v[i] = float(entry['v'])
+                has_v = True
+
+        return cls(times, u, v if has_v else None)
+
+    def has_setpoint(self):
+        return self.v is not None
+
+    def pop_due(self, t):
+        """
+
+        consume all entries that became effective at or before time t
+
+        :param t: current simulation time
+        :return: the latest control signal that is due, or None if nothing new is due
+        """
+        end = int(np.searchsorted(self.times, t, side='right'))
+        if end <= self.cursor:
+            return None
+        self.cursor = end
+
+        control = {'u': float(self.u[end - 1])}
+        if self.v is not None:
+            # carry forward the most recent specified set point
+            specified = np.flatnonzero(~np.isnan(self.v[:end]))
+            if len(specified) > 0:
+                control['v'] = float(self.v[specified[-1]])
+        return control
+
+    def next_time(self):
+        """
+        :return: time of the next entry that is not yet due, or None if all entries are consumed
+        """
+        return float(self.times[self.cursor]) if self.cursor < len(self.times) else None
+
+    def is_finished(self):
+        return self.cursor >= len(self.times)
+
+    def serialize(self):
+        return [
+            dict([("time", float(self.times[i])), ("u", int(self.u[i]))] +
+                 ([("v", float(self.v[i]))] if self.v is not None and not np.isnan(self.v[i]) else []))
+            for i in range(self.cursor, len(self.times))
+        ]
+
+    def __repr__(self):
+        return "<%s(entries='%d', pending='%d')>" \
+               % (self.__class__.__name__, len(self.times), len(self.times) - self.cursor)
@@ -1,10 +1,21 @@
+import hashlib
 import logging
+import math
+import os
 import threading
 import time
+from collections import deque
+
 import numpy as np
 
 from pyfmi.fmi import load_fmu
 
+from app.simulator import equivalence
+from app.simulator import fmu_cache
+from app.simulator.command_queue import CommandQueue
+from app.simulator.model_io import ModelIO, read_variables
+from app.simulator.trace_buffer import TraceBuffer
+
 LOGGER = logging.getLogger(__name__)
 Ws2kWh = 0.0000002777778  # 1 watt-second  =  2.777778e-7 kilowatt-hour
 
@@ -12,23 +23,39 @@ Ws2kWh = 0.0000002777778  # 1 watt-second  =  2.777778e-7 kilowatt-hour
 class DeviceSimulator:
     """This class provides a simulation of a physical electric device"""
 
+    # written by the simulation loop only; other threads send commands through the command queue instead
     running_simulations = dict()
+    commands = CommandQueue()
 
-    def __init__(self, fmu_name, fmu_dir, device_name, device_id, model_params, output_dir):
+    # power states changed by control schedules inside the simulation loop, waiting to be written to the db
+    pending_state_changes = dict()
 
-        # load_fmu returns a class instance from a FMU
+    # simulators removed from running_simulations, to be terminated by the simulation loop at the next tick boundary
+    retired_simulations = deque()
+
+    # names of the models that were found unable to step over a horizon, so that this is logged once per model
+    models_without_horizon = set()
+
+    def __init__(self, fmu_name, fmu_dir, device_name, device_id, model_params, output_dir,
+                 start_time=None, register=True, horizon=1, dormant_when_off=False, dt=1, variables=None):
+
+        # load returns a class instance from a FMU
         # the class instance can be used for simulations
-        self.model = load_fmu(
-            fmu_name + ".fmu",
-            path=fmu_dir,
-            log_file_name=output_dir + device_name + '_' + device_id + '.log',
+        self.log_file_name = output_dir + device_name + '_' + device_id + '.log'
+        self.model = fmu_cache.load(
+            fmu_name,
+            fmu_dir,
+            log_file_name=self.log_file_name,
             log_level=2
         )
 
+        self.fmu_name = fmu_name
         self.model_params = model_params
         self.device_id = device_id
         self.device_name = device_name
-        self.t = time.time()
+        # simulation clock follows the wall clock unless an explicit start time is given (e.g., in batch mode). it
+        # starts on the grid of the tick interval, so that devices created within the same tick step together
+        self.t = start_time if start_time is not None else math.floor(time.time() / dt) * dt
 
         # set model parameters
         self.setup()
@@ -39,28 +66,67 @@ class DeviceSimulator:
         opts['result_file_name'] = output_dir + device_name + '_' + device_id + '.mat'
         opts['initialize'] = False
         opts['CVode_options'] = {'verbosity': 50}
+        # only the output is needed from the result, which is kept in memory instead of being written to a file
+        opts['result_handling'] = 'memory'
+        opts['filter'] = 'y'
         self.opts = opts
 
-        self.vars = self.model.get_model_variables().keys()
-
-        # version == "1.0" in compile_fmu():
-        # self.vars_in = self.model.get_model_variables(causality=0).keys()
-        # self.vars_out = self.model.get_model_variables(causality=1).keys()
-        # self.vars_state = self.model.get_model_variables(causality=2, variability=3).keys()
-
-        # version == "2.0" in compile_fmu():
-        self.vars_in = self.model.get_model_variables(causality=2).keys()
-        self.vars_out = self.model.get_model_variables(causality=3).keys()
-        self.vars_state = self.model.get_model_variables(causality=4, variability=4).keys()
-
-        self.dt = 1
+        # variables of the model as read once by the model registry, or from the FMU if it is not registered
+        if variables is None:
+            variables = read_variables(self.model)
+        self.vars = variables["all"]
+        self.vars_in = variables["inputs"]
+        self.vars_out = variables["outputs"]
+        self.vars_state = variables["states"]
+        # parameters that can be changed while the model is running
+        self.vars_tunable = variables.get("tunable", [])
+        # inputs are set and the output is read by value reference
+        self.io = ModelIO(variables)
+
+        # seconds between two simulation steps
+        self.dt = dt
         self.control_signal = {v: 0 for v in self.vars_in}
         self.res = None
 
+        # adaptive stepping: while inputs stay unchanged, the model is integrated up to 'horizon' seconds ahead in one
+        # solver call and the outputs of the following steps are served from the precomputed trajectory
+        try:
+            can_rewind = self.model.get_capability_flags().get('canGetAndSetFMUstate', False)
+        except Exception:
+            can_rewind = False
+        self.horizon = max(1, int(horizon // self.dt)) if can_rewind else 1
+        if not can_rewind and horizon >= 2 * self.dt and fmu_name not in DeviceSimulator.models_without_horizon:
+            DeviceSimulator.models_without_horizon.add(fmu_name)
+            LOGGER.warn("Model '%s' cannot get and set its state, so it is integrated one step at a time instead of "
+                        "over a horizon of %d seconds" % (fmu_name, horizon))
+        self.horizon_start = None
+        self.horizon_state = None
+        self.trajectory = None
+        self.trajectory_pos = 0
+        self.trajectory_control = None
+        # holds the trajectory of horizons of a single step, which is read from the model directly
+        self.step_output = np.zeros(1, dtype=np.float64)
+
+        # whether the output of the model is known to be exactly zero while switched off (u=0), in which case the
+        # device is not integrated at all until it is turned on again
+        self.dormant_when_off = dormant_when_off
+
         self.power_state = 0
         self.just_turned_on = False
         self.total_power_reading = 0
         self.live_power_reading = 0
+        self.schedule = None
+        # optional recording of the output at every step
+        self.trace = None
+
+        # digest of everything that determines the state of the model (set up and controls since), see
+        # equivalence.key
+        self.history = None
+        self.reset_history()
+        # simulator of an identical device whose output is taken instead of integrating the model, together with the
+        # controls (time, control) applied since, with which the model catches up once it is stepped on its own
+        self.leader = None
+        self.follow_controls = None
 
         ## Control period (not implemented yet)
         # self.control_period_start = time.time()
@@ -68,7 +134,8 @@ class DeviceSimulator:
         # self.period_reading = None
         # self.period_target = None
 
-        DeviceSimulator.running_simulations[self.device_id] = self
+        if register:
+            DeviceSimulator.running_simulations[self.device_id] = self
 
     def setup(self):
         self.model.reset()
@@ -78,11 +145,91 @@ class DeviceSimulator:
         self.model.time = self.t
         self.model.initialize()
 
+    def reset_history(self):
+        """
+        start the history over after the model was set up
+        """
+        self.history = ""
+        self.extend_history(self.fmu_name, sorted(self.model_params.items()), self.t,
+                            sorted(self.control_signal.items()))
+
+    def extend_history(self, *event):
+        """
+        add an event to the history. the history is a SHA-256 digest chained over the exact representation of all
+        events, so that devices whose histories differ are not taken for identical
+        """
+        if self.history is not None:
+            self.history = hashlib.sha256((self.history + repr(event)).encode('utf-8')).hexdigest()
+
     def set_control(self, new_control):
         new_state = bool(float(new_control['u']))
         self.just_turned_on = True if (not self.power_state and new_state) else False
         self.power_state = new_state
         self.control_signal = new_control
+        self.extend_history("control", self.t, sorted(new_control.items()))
+        if self.leader is not None:
+            self.follow_controls.append((self.t, dict(new_control)))
+
+    def apply_control(self, new_control):
+        """
+        apply a control received between two steps. the next step stays due at the simulation clock, which is where
+        the control takes effect, so that the clock and the energy total are not advanced by an extra step. only the
+        live power of a device that is now dormant is known without a step, and drops right away
+        """
+        self.set_control(new_control)
+        if self.is_dormant():
+            self.live_power_reading = 0.0
+
+    def set_params(self, model_params):
+        """
+        apply new model parameters without loading the FMU again. if all of them are tunable they are set on the
+        running model, else the model is set up again (with the energy total and controls kept). dormant models pick
+        them up when they are turned on
+
+        :param model_params: dict of parameter name -> value, replacing the current parameters
+        """
+        not_tunable = sorted(param for param in model_params if param not in self.vars_tunable)
+        left_out = sorted(param for param in self.model_params if param not in model_params)
+        if not not_tunable and not left_out:
+            self.catch_up()
+            # the model is brought back from the end of the precomputed horizon to the simulation clock, where the
+            # new parameters take effect
+            if self.is_trajectory_pending():
+                self.rewind()
+            self.discard_trajectory()
+            self.model_params = model_params
+            for param, value in model_params.items():
+                self.model.set(param, value)
+            self.extend_history("params", self.t, sorted(model_params.items()))
+        else:
+            LOGGER.info("Setting up the model of device_id '%s' again to apply its parameters (not tunable: %s, left "
+                        "out: %s)" % (self.device_id, not_tunable, left_out))
+            self.stop_following()
+            self.discard_trajectory()
+            self.model_params = model_params
+            if not self.is_dormant():
+                self.setup()
+                self.reset_history()
+
+    def set_schedule(self, schedule):
+        self.schedule = schedule
+
+    def apply_schedule(self):
+        """
+        apply the control signal of the schedule entry that is due at the current simulation time (if any)
+        """
+        if self.schedule is None:
+            return
+
+        control = self.schedule.pop_due(self.t)
+        if control is not None:
+            previous_state = self.power_state
+            self.set_control(control)
+            if self.power_state != previous_state:
+                DeviceSimulator.pending_state_changes[self.device_id] = self.power_state
+
+        if self.schedule.is_finished():
+            self.schedule = None
 
     def get_measurements(self):
         data = dict()
@@ -105,37 +252,302 @@ class DeviceSimulator:
 
         LOGGER.debug("Running simulation step for device_id: '%s'" % self.device_id)
         try:
-            ctrl = self.control_signal.items()
-            ctrl_sig = ([k for k, v in ctrl], np.vstack([(self.t, v) for k, v in ctrl]))
+            self.apply_schedule()
+
+            if self.is_dormant():
+                self.idle_step()
+                return
 
             # reset model's internal clock every time device is turned on
             if self.just_turned_on:
+                self.stop_following()
+                self.discard_trajectory()
                 self.setup()
                 self.just_turned_on = False
-
-            self.res = self.model.simulate(self.t, self.t + self.dt, input=ctrl_sig, options=self.opts)
-            output_values = {v: self.res.final(v) for v in self.vars_out}
-            self.live_power_reading = output_values['y']
-            self.total_power_reading += self.live_power_reading
+                self.reset_history()
+            elif self.leader is not None:
+                self.catch_up()
+            elif self.is_trajectory_pending() and self.trajectory_control != self.control_signal:
+                self.rewind()
+
+            if not self.is_trajectory_pending():
+                self.simulate_horizon()
+
+            self.live_power_reading = float(self.trajectory[self.trajectory_pos])
+            self.trajectory_pos += 1
+            self.total_power_reading += self.live_power_reading * self.dt
         except Exception as e:
             LOGGER.error(e.message)
             LOGGER.error(self.model.get_log())
 
         self.t = self.t + self.dt
+        self.record_trace()
+
+    def is_dormant(self):
+        return self.dormant_when_off and not self.power_state and not self.just_turned_on
+
+    def idle_step(self):
+        """
+        advance the clock of a dormant device without integrating its model. the model is set up again
+        (i.e., rehydrated) when the device is turned on
+        """
+        if self.trajectory is not None:
+            self.discard_trajectory()
+        self.stop_following()
+        self.live_power_reading = 0.0
+        self.t = self.t + self.dt
+        self.record_trace()
+
+    def follow(self, leader):
+        """
+        take the output of the step of a simulator in the same equivalence class instead of integrating the model,
+        which stays at the current time until the simulator is stepped on its own again
+
+        :param leader: the simulator that was stepped, which was in the same state as this one before the step
+        """
+        if self.leader is None:
+            try:
+                if self.is_trajectory_pending():
+                    self.rewind()
+            except Exception as e:
+                LOGGER.error(e.message)
+                self.run_step()
+                return
+            self.discard_trajectory()
+            self.follow_controls = [(self.t, dict(self.control_signal))]
+        self.leader = leader
+
+        self.live_power_reading = leader.live_power_reading
+        self.total_power_reading += self.live_power_reading * self.dt
+        self.t = self.t + self.dt
+        self.record_trace()
+
+    def catch_up(self):
+        """
+        integrate the model over the steps whose output was taken from another simulator, with the controls that were
+        applied in the meantime
+        """
+        if self.leader is None:
+            return
+        segments = self.follow_controls
+        self.stop_following()
+        for i, (start, control) in enumerate(segments):
+            end = segments[i + 1][0] if i + 1 < len(segments) else self.t
+            if end > start:
+                self.io.set_inputs(self.model, control)
+                # only the state at the end is needed, however long the device was following
+                self.opts['ncp'] = 1
+                self.model.simulate(start, end, options=self.opts)
+
+    def stop_following(self):
+        self.leader = None
+        self.follow_controls = None
+
+    def horizon_steps(self):
+        """
+        number of steps to integrate ahead, limited such that the horizon does not run past the next schedule entry
+        """
+        steps = self.horizon
+        next_time = self.schedule.next_time() if self.schedule is not None else None
+        if next_time is not None:
+            steps = min(steps, max(1, int(math.ceil((next_time - self.t) / self.dt))))
+        return steps
+
+    def is_trajectory_pending(self):
+        return self.trajectory is not None and self.trajectory_pos < len(self.trajectory)
+
+    def simulate_horizon(self):
+        """
+        integrate the model over the horizon with the current (constant) inputs in a single solver call
+        """
+        steps = self.horizon_steps()
+
+        self.discard_trajectory()
+        if steps > 1:
+            # keep the state at the start of the horizon to be able to go back if the inputs change
+            self.horizon_state = self.model.get_fmu_state()
+        self.horizon_start = self.t
+
+        # the inputs are constant over the horizon, so they are set once instead of passed as an input trajectory
+        self.io.set_inputs(self.model, self.control_signal)
+        self.opts['ncp'] = steps
+        self.res = self.model.simulate(self.t, self.t + steps * self.dt, options=self.opts)
+
+        if steps == 1:
+            self.step_output[0] = self.io.get_output(self.model)
+            self.trajectory = self.step_output
+        else:
+            grid = self.t + self.dt * np.arange(1, steps + 1)
+            self.trajectory = np.interp(grid, self.res['time'], self.res['y'])
+        self.trajectory_pos = 0
+        self.trajectory_control = dict(self.control_signal)
+        self.res = None  # outputs are read, release the result object
+
+    def rewind(self):
+        """
+        bring the model back from the end of the precomputed horizon to the current simulation time
+        """
+        LOGGER.debug("Inputs of device_id: '%s' changed within horizon, rewinding to t=%.1f" % (self.device_id, self.t))
+        self.model.set_fmu_state(self.horizon_state)
+        if self.t > self.horizon_start:
+            self.io.set_inputs(self.model, self.trajectory_control)
+            self.opts['ncp'] = int(round((self.t - self.horizon_start) / self.dt))
+            self.model.simulate(self.horizon_start, self.t, options=self.opts)
+        self.discard_trajectory()
+
+    def discard_trajectory(self):
+        if self.horizon_state is not None:
+            self.model.free_fmu_state(self.horizon_state)
+            self.horizon_state = None
+        self.trajectory = None
+        self.trajectory_pos = 0
+        self.trajectory_control = None
 
     def print_info(self, print_extra=False):
         LOGGER.debug("Power: {:.2f}\t Energy : {:.5f}"
                     .format(self.live_power_reading, self.total_power_reading * Ws2kWh))
 
-        if print_extra:
-            input_vals = {v: self.res.final(v) for v in self.vars_in}
-            state_vals = {v: self.res.final(v) for v in self.vars_state}
-            output_vals = {v: self.res.final(v) for v in self.vars_out}
+        if print_extra and self.model is not None:
+            # values at the end of the current horizon, read directly from the model
+            input_vals = {v: self.model.get(v)[0] for v in self.vars_in}
+            state_vals = {v: self.model.get(v)[0] for v in self.vars_state}
+            output_vals = {v: self.model.get(v)[0] for v in self.vars_out}
             LOGGER.debug("Inputs: %s; States: %s; Outputs: %s",
                          ", ".join("{}={}".format(key, val) for key, val in input_vals.items()),
                          ", ".join("{}={}".format(key, val) for key, val in state_vals.items()),
                          ", ".join("{}={}".format(key, val) for key, val in output_vals.items()))
 
+    def get_checkpoint(self):
+        """
+        :return: the state needed to resume this simulation after a restart. the continuous states are those of the
+                 model, i.e., at the end of the current horizon
+        """
+        model = self.model
+        if self.leader is not None:
+            # the model of a following simulator lags behind, unlike the one of its leader if that is still identical
+            if self.leader.model is not None and equivalence.key(self.leader) == equivalence.key(self):
+                model = self.leader.model
+            else:
+                self.catch_up()
+        return {
+            "device_id": self.device_id,
+            "t": self.t,
+            "energy": self.total_power_reading,
+            "power": self.live_power_reading,
+            "power_state": int(self.power_state),
+            "u": float(self.control_signal.get('u', 0)),
+            "v": float(self.control_signal['v']) if 'v' in self.control_signal else float('nan'),
+            "x": np.array(model.continuous_states, dtype=np.float64)
+            if model is not None and not self.is_dormant() else np.empty(0)
+        }
+
+    def restore_checkpoint(self, checkpoint):
+        """
+        resume from a checkpoint. the simulation clock stays at the current time, the energy total, controls and
+        continuous states are taken over from the checkpoint
+
+        :param checkpoint: as returned by get_checkpoint()
+        """
+        control = {'u': checkpoint["u"]}
+        if not math.isnan(checkpoint["v"]) and 'v' in self.vars_in:
+            control['v'] = checkpoint["v"]
+
+        self.control_signal = control
+        self.power_state = bool(checkpoint["power_state"])
+        self.just_turned_on = False
+        self.total_power_reading = checkpoint["energy"]
+        self.live_power_reading = checkpoint["power"] if self.power_state else 0.0
+        # the controls that led to the state of the checkpoint are unknown, so the device is not considered identical
+        # to any other until it is set up again
+        self.history = None
+
+        if len(checkpoint["x"]) > 0 and len(checkpoint["x"]) == len(self.model.continuous_states):
+            self.model.continuous_states = np.array(checkpoint["x"], dtype=np.float64)
+
+    def enable_trace(self, directory, capacity):
+        """
+        record the output at every step into ring buffers of the given capacity. recording continues where an earlier
+        recording of this device in the same directory stopped
+        """
+        if self.trace is None:
+            self.trace = TraceBuffer(directory, capacity, self.dt)
+
+    def disable_trace(self, remove=False):
+        """
+        stop recording the output. the recorded traces are kept on disk unless remove is set
+        """
+        if self.trace is None:
+            return
+        directory = self.trace.directory
+        self.trace.stop_recording()
+        self.trace.close()
+        self.trace = None
+        if remove:
+            TraceBuffer.remove(directory)
+
+    def record_trace(self):
+        if self.trace is not None:
+            self.trace.append(self.t, self.live_power_reading, self.total_power_reading * Ws2kWh, self.power_state)
+
+    def memory_usage(self):
+        """
+        :return: bytes held by the buffers of this simulator (the FMU instance itself is not accounted)
+        """
+        return {
+            "trajectory": self.trajectory.nbytes if self.trajectory is not None else 0,
+            "schedule": self.schedule.times.nbytes + self.schedule.u.nbytes +
+                        (self.schedule.v.nbytes if self.schedule.v is not None else 0)
+            if self.schedule is not None else 0,
+            "horizon_state": self.horizon_state is not None,
+            "trace": self.trace.nbytes() if self.trace is not None else 0,
+            "log_file": os.path.getsize(self.log_file_name) if os.path.exists(self.log_file_name) else 0
+        }
+
+    def terminate(self):
+        """
+        terminate the simulation and free the FMU instance together with all buffers of this simulator
+        """
+        if self.model is None:
+            return
+
+        self.stop_following()
+        try:
+            self.discard_trajectory()
+            self.model.terminate()
+        except Exception as e:
+            LOGGER.warn("Failed to terminate model of device_id '%s': %s" % (self.device_id, e))
+        try:
+            self.model.free_instance()
+        except Exception as e:
+            LOGGER.warn("Failed to free model instance of device_id '%s': %s" % (self.device_id, e))
+
+        if self.trace is not None:
+            self.trace.close()  # recording is resumed when the device is simulated again
+            self.trace = None
+        self.model = None
+        self.res = None
+        self.schedule = None
+        LOGGER.debug("Terminated simulation of device_id '%s'" % self.device_id)
+
+    @staticmethod
+    def retire(device_id):
+        """
+        remove a simulation from the running simulations. its resources are released by release_retired()
+
+        :param device_id:
+        :return: True if the simulation was running
+        """
+        simulation = DeviceSimulator.running_simulations.pop(device_id, None)
+        if simulation is None:
+            return False
+        DeviceSimulator.retired_simulations.append(simulation)
+        return True
+
+    @staticmethod
+    def release_retired():
+        while DeviceSimulator.retired_simulations:
+            DeviceSimulator.retired_simulations.popleft().terminate()
+
     def serialize(self):
         return {
             "device_name": self.device_name,
@@ -144,7 +556,11 @@ class DeviceSimulator:
             "input_variables": self.vars_in,
             "output_variables": self.vars_out,
             "control_signal": self.control_signal,
+            "schedule": self.schedule.serialize() if self.schedule is not None else None,
             "power_state": self.power_state,
+            "dormant": self.is_dormant(),
+            "following": self.leader.device_id if self.leader is not None else None,
+            "trace": self.trace is not None,
             "live_power": self.live_power_reading,
             "total_energy": self.total_power_reading * Ws2kWh
         }
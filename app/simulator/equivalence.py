@@ -0,0 +1,42 @@
+from collections import OrderedDict
+
+
+def key(simulation):
+    """
+
+    devices whose simulators have the same key are in the same state: they run the same FMU with the same parameters,
+    were set up at the same time and have received the same controls at the same times since, so their next step
+    yields the same output
+
+    :param simulation: instance of DeviceSimulator
+    :return: hashable key, or None if the simulator has to be stepped on its own (e.g., its history is unknown after
+             a restore from a checkpoint, or it follows a schedule)
+    """
+    if simulation.history is None or simulation.model is None or simulation.schedule is not None \
+            or simulation.just_turned_on or simulation.is_dormant():
+        return None
+    return simulation.fmu_name, simulation.dt, simulation.horizon, simulation.t, simulation.history
+
+
+def group(simulations):
+    """
+
+    group simulators into equivalence classes, of which only one representative has to be stepped
+
+    :param simulations: list of DeviceSimulator instances
+    :return: list of (representative, list of the other members of its class)
+    """
+    classes = OrderedDict()
+    groups = []
+    for simulation in simulations:
+        simulation_key = key(simulation)
+        if simulation_key is None:
+            groups.append((simulation, []))
+        else:
+            classes.setdefault(simulation_key, []).append(simulation)
+
+    for members in classes.values():
+        # a member whose model is up to date is preferred, as a following member has to catch up first
+        members.sort(key=lambda member: member.leader is not None)
+        groups.append((members[0], members[1:]))
+    return groups
@@ -0,0 +1,63 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import zipfile
+
+from pyfmi.fmi import load_fmu, FMUModelME2
+
+LOGGER = logging.getLogger(__name__)
+
+# FMU path -> directory holding the unzipped FMU (binaries and model description)
+unzipped_fmus = dict()
+lock = threading.Lock()
+
+
+def unzip(fmu_path):
+    """
+
+    unzip each FMU only once per process and reuse the directory for all devices using the same model
+
+    :param fmu_path:
+    :return: directory holding the unzipped FMU
+    """
+    with lock:
+        unzipped_dir = unzipped_fmus.get(fmu_path)
+        if unzipped_dir is None or not os.path.isdir(unzipped_dir):
+            unzipped_dir = tempfile.mkdtemp(prefix=os.path.basename(fmu_path) + '_')
+            archive = zipfile.ZipFile(fmu_path)
+            try:
+                archive.extractall(unzipped_dir)
+            finally:
+                archive.close()
+            unzipped_fmus[fmu_path] = unzipped_dir
+            LOGGER.debug("Unzipped '%s' to '%s'" % (fmu_path, unzipped_dir))
+        return unzipped_dir
+
+
+def load(fmu_name, fmu_dir, log_file_name, log_level):
+    """
+
+    load a new instance of the FMU, sharing the unzipped FMU with other instances of the same model
+
+    :param fmu_name: name of the FMU without extension
+    :param fmu_dir:
+    :param log_file_name:
+    :param log_level:
+    :return: a model instance that can be used for simulations
+    """
+    fmu_path = os.path.join(fmu_dir, fmu_name + ".fmu")
+    try:
+        return FMUModelME2(fmu_path, log_file_name=log_file_name, log_level=log_level,
+                           _unzipped_dir=unzip(fmu_path))
+    except TypeError:
+        # pyfmi without support for pre-unzipped FMUs
+        return load_fmu(fmu_name + ".fmu", path=fmu_dir, log_file_name=log_file_name, log_level=log_level)
+
+
+def clear():
+    with lock:
+        for unzipped_dir in unzipped_fmus.values():
+            shutil.rmtree(unzipped_dir, ignore_errors=True)
+        unzipped_fmus.clear()
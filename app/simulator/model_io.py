@@ -0,0 +1,73 @@
+import numpy as np
+
+# FMI 2.0 data types as returned by pyfmi
+REAL = 0
+INTEGER = 1
+BOOLEAN = 2
+
+TYPES = {"Real": REAL, "Integer": INTEGER, "Boolean": BOOLEAN}
+
+
+def read_variables(model):
+    """
+    read the variables of a loaded FMU in the layout of model_registry.read_model_description, for FMUs that are not
+    in the registry
+    """
+    variables = {"all": [], "inputs": [], "outputs": [], "states": [], "tunable": [], "value_references": dict(),
+                 "types": dict()}
+    for name, variable in model.get_model_variables().items():
+        variables["all"].append(name)
+        variables["value_references"][name] = variable.value_reference
+        variables["types"][name] = variable.type
+        # causality and variability constants of FMI 2.0 in pyfmi (parameter: 0, input: 2, output: 3, local: 4,
+        # tunable: 2, continuous: 4)
+        if variable.causality == 0 and variable.variability == 2:
+            variables["tunable"].append(name)
+        elif variable.causality == 2:
+            variables["inputs"].append(name)
+        elif variable.causality == 3:
+            variables["outputs"].append(name)
+        elif variable.causality == 4 and variable.variability == 4:
+            variables["states"].append(name)
+    return variables
+
+
+class ModelIO:
+    """
+    This class sets the inputs 'u' (on/off) and 'v' (set point) and reads the output 'y' of a model by value
+    reference, through buffers that are allocated once, so that no variable names are looked up at every step
+    """
+
+    def __init__(self, variables):
+        """
+        :param variables: variables of the model, as returned by model_registry.read_model_description or
+                          read_variables
+        """
+        refs, types = variables["value_references"], variables["types"]
+
+        self.u_ref = np.array([refs['u']], dtype=np.uint32) if 'u' in refs else None
+        self.u_is_real = types.get('u') == REAL
+        self.u = np.zeros(1, dtype=np.float64 if self.u_is_real else np.int32)
+
+        self.v_ref = np.array([refs['v']], dtype=np.uint32) if 'v' in refs else None
+        self.v = np.zeros(1, dtype=np.float64)
+
+        self.y_ref = np.array([refs['y']], dtype=np.uint32)
+
+    def set_inputs(self, model, control):
+        """
+        :param model: FMU instance
+        :param control: dict with 'u' and optionally 'v'
+        """
+        if self.u_ref is not None:
+            self.u[0] = float(control.get('u', 0))
+            if self.u_is_real:
+                model.set_real(self.u_ref, self.u)
+            else:
+                model.set_integer(self.u_ref, self.u)
+        if self.v_ref is not None and 'v' in control:
+            self.v[0] = float(control['v'])
+            model.set_real(self.v_ref, self.v)
+
+    def get_output(self, model):
+        return float(model.get_real(self.y_ref)[0])
@@ -0,0 +1,208 @@
+import logging
+import numbers
+import os
+import threading
+import zipfile
+from collections import OrderedDict
+from xml.etree import ElementTree
+
+import numpy as np
+
+from app.simulator.model_io import TYPES
+from app.util import parser
+
+LOGGER = logging.getLogger(__name__)
+
+# model name -> ModelSpec, built once from the configuration
+models = OrderedDict()
+lock = threading.Lock()
+
+
+class ModelSpec:
+    """
+    This class holds what is needed to validate the parameters of a model and to create simulators of it, so that
+    neither the configuration nor the FMU has to be queried per device
+    """
+
+    def __init__(self, name, fmu_name, fmu_path, params, zero_when_off=False, tick_interval=None):
+        """
+
+        :param name:
+        :param fmu_name: name of the FMU without extension
+        :param fmu_path:
+        :param params: dict of parameter name -> dict with 'min', 'max' and 'default'
+        :param zero_when_off: whether the output of the model is exactly zero while switched off
+        :param tick_interval: seconds between two simulation steps (None for the default)
+        """
+        self.name = name
+        self.fmu_name = fmu_name
+        self.fmu_path = fmu_path
+        self.zero_when_off = zero_when_off
+        self.tick_interval = tick_interval
+
+        self.param_names = sorted(params.keys())
+        self.param_index = {param: i for i, param in enumerate(self.param_names)}
+        self.minimum = np.array([params[param]['min'] for param in self.param_names], dtype=np.float64)
+        self.maximum = np.array([params[param]['max'] for param in self.param_names], dtype=np.float64)
+        self.default = np.array([params[param]['default'] for param in self.param_names], dtype=np.float64)
+
+        # read from the model description of the FMU on first use, since the FMU may not exist yet
+        self.variables = None
+
+    def validate(self, model_params):
+        """
+        :param model_params: dict of parameter name -> value
+        :return: None if the parameters are valid, else the error message
+        """
+        return self.validate_batch([model_params])[0]
+
+    def validate_batch(self, params_list):
+        """
+
+        validate the parameters of many devices of this model at once, with the range check done as a single array
+        comparison
+
+        :param params_list: list of dicts of parameter name -> value
+        :return: list with None for each valid entry, else the error message
+        """
+        errors = [None] * len(params_list)
+        values = np.tile(self.default, (len(params_list), 1))
+        for i, model_params in enumerate(params_list):
+            for key, val in (model_params or {}).items():
+                j = self.param_index.get(key)
+                if j is None:
+                    errors[i] = "invalid model parameters. valid parameters are: %s" % self.param_names
+                    break
+                # numpy would convert numeric strings and booleans, which the simulators do not accept
+                if not isinstance(val, numbers.Real) or isinstance(val, bool):
+                    errors[i] = "parameter value is not a number. parameter: %s" % key
+                    break
+                values[i, j] = val
+
+        out_of_range = (values < self.minimum) | (values > self.maximum) | np.isnan(values)
+        for i in np.flatnonzero(out_of_range.any(axis=1)):
+            if errors[i] is None:
+                j = np.flatnonzero(out_of_range[i])[0]
+                errors[i] = "parameter value out of range. parameter: %s, valid range: [min:%.1f, max:%.1f]" \
+                            % (self.param_names[j], self.minimum[j], self.maximum[j])
+        return errors
+
+    def get_variables(self):
+        """
+        :return: dict with the lists of 'all', 'inputs', 'outputs', 'states' and 'tunable' variable names and the
+                 'value_references' and 'types' of all variables, or None if the FMU cannot be read
+        """
+        if self.variables is None:
+            try:
+                self.variables = read_model_description(self.fmu_path)
+            except (IOError, KeyError, zipfile.BadZipfile, ElementTree.ParseError) as e:
+                LOGGER.warn("Cannot read the model description of '%s': %s" % (self.fmu_path, e))
+                return None
+        return self.variables
+
+    def serialize(self):
+        return {
+            "name": self.name,
+            "params": {
+                param: {"min": self.minimum[i], "max": self.maximum[i], "default": self.default[i]}
+                for i, param in enumerate(self.param_names)
+            },
+            "zero_when_off": self.zero_when_off,
+            "tick_interval": self.tick_interval
+        }
+
+    def __repr__(self):
+        return "<%s(name='%s', fmu_path='%s')>" % (self.__class__.__name__, self.name, self.fmu_path)
+
+
+def read_model_description(fmu_path):
+    """
+    read the variables of an FMI 2.0 FMU from its modelDescription.xml, with the causalities and variabilities
+    that the simulator queries through pyfmi
+    """
+    archive = zipfile.ZipFile(fmu_path)
+    try:
+        root = ElementTree.fromstring(archive.read("modelDescription.xml"))
+    finally:
+        archive.close()
+
+    variables = {"all": [], "inputs": [], "outputs": [], "states": [], "tunable": [], "value_references": dict(),
+                 "types": dict()}
+    for variable in root.iter("ScalarVariable"):
+        name = variable.get("name")
+        causality = variable.get("causality", "local")
+        variability = variable.get("variability", "continuous")
+        variables["all"].append(name)
+        variables["value_references"][name] = int(variable.get("valueReference"))
+        variables["types"][name] = TYPES.get(variable[0].tag) if len(variable) > 0 else None
+        if causality == "parameter" and variability == "tunable":
+            variables["tunable"].append(name)
+        elif causality == "input":
+            variables["inputs"].append(name)
+        elif causality == "output":
+            variables["outputs"].append(name)
+        elif causality == "local" and variability == "continuous":
+            variables["states"].append(name)
+    return variables
+
+
+def build(model_params):
+    """
+
+    build the registry from the 'model' section of the configuration, checked against the package of the Modelica
+    file
+
+    :param model_params: the 'model' section of app.yaml
+    """
+    if os.path.exists(model_params.file_path):
+        package_name, _ = parser.parse_modelica_file(model_params.file_path)
+        if package_name != model_params.package_name:
+            LOGGER.warn("Package '%s' in '%s' does not match the configured package '%s'"
+                        % (package_name, model_params.file_path, model_params.package_name))
+
+    with lock:
+        models.clear()
+        for model in model_params.available_models:
+            fmu_name = model_params.package_name + "_" + model.name
+            models[model.name] = ModelSpec(
+                name=model.name,
+                fmu_name=fmu_name,
+                fmu_path=os.path.join(model_params.fmu_dir, fmu_name + ".fmu"),
+                params={param: dict(values) for param, values in model.params.items()},
+                zero_when_off=bool(model.get('zero_when_off', False)),
+                tick_interval=model.get('tick_interval')
+            )
+    LOGGER.info("Registered %d models" % len(models))
+
+
+def get(name):
+    """
+    :return: the ModelSpec of the given model, or None if there is no such model
+    """
+    return models.get(name)
+
+
+def names():
+    return list(models.keys())
+
+
+def validate_batch(devices):
+    """
+
+    validate a batch of devices, with one array comparison per model
+
+    :param devices: list of dicts with 'model_name' and 'params'
+    :return: list of (position in devices, error message) of the invalid devices
+    """
+    positions = OrderedDict()
+    errors = []
+    for i, device in enumerate(devices):
+        if get(device.get('model_name')) is None:
+            errors.append((i, "invalid model_type. valid models are: %s" % names()))
+        else:
+            positions.setdefault(device.get('model_name'), []).append(i)
+
+    for model_name, indices in positions.items():
+        model_errors = get(model_name).validate_batch([devices[i].get('params') for i in indices])
+        errors.extend((i, error) for i, error in zip(indices, model_errors) if error is not None)
+    return sorted(errors)
@@ -0,0 +1,55 @@
+import heapq
+
+
+class TickScheduler:
+    """
+    This class keeps the running simulations in a priority queue keyed by the time their next step is due, so that
+    the simulation loop only steps the devices that are due instead of all of them at every tick
+    """
+
+    def __init__(self):
+        self.heap = []
+        # device_id -> due time of the valid entry of the device. entries in the heap that do not match are stale
+        # (i.e., rescheduled or removed) and skipped when popped
+        self.due = dict()
+
+    def schedule(self, device_id, due_time):
+        self.due[device_id] = due_time
+        heapq.heappush(self.heap, (due_time, device_id))
+
+    def remove(self, device_id):
+        self.due.pop(device_id, None)
+
+    def reset(self, simulations):
+        """
+        schedule the given simulations at their current clocks, dropping everything scheduled before
+
+        :param simulations: dict of device_id -> DeviceSimulator
+        """
+        self.due = {device_id: simulation.t for device_id, simulation in simulations.items()}
+        self.heap = [(due_time, device_id) for device_id, due_time in self.due.items()]
+        heapq.heapify(self.heap)
+
+    def pop_due(self, now):
+        """
+        :param now: current time
+        :return: ids of all devices whose next step is due at or before now, in order of due time
+        """
+        due = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due_time, device_id = heapq.heappop(self.heap)
+            if self.due.get(device_id) == due_time:
+                del self.due[device_id]
+                due.append(device_id)
+        return due
+
+    def next_due(self):
+        """
+        :return: time at which the next step is due, or None if no device is scheduled
+        """
+        while len(self.heap) > 0 and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)  # drop stale entries
+        return self.heap[0][0] if len(self.heap) > 0 else None
+
+    def __len__(self):
+        return len(self.due)
@@ -0,0 +1,153 @@
+import logging
+import math
+import os
+import shutil
+
+import numpy as np
+
+LOGGER = logging.getLogger(__name__)
+
+# name and type of the recorded columns, each one held in a separate file
+COLUMNS = [("power", np.float32), ("energy", np.float64), ("state", np.uint8)]
+
+# header fields: time of sample 0, number of samples written so far, time step, capacity, whether recording is on
+HEADER_SIZE = 5
+
+
+class TraceBuffer:
+    """
+    This class records the output of a simulation at every step into fixed-size ring buffers that are backed by
+    memory-mapped files, so that the recorded traces neither take up heap memory nor get lost on a restart
+    """
+
+    def __init__(self, directory, capacity=None, dt=1, readonly=False):
+        """
+
+        :param directory: directory holding the files of the buffer
+        :param capacity: number of samples kept per column
+        :param dt: time between two samples in seconds. an existing buffer with a different capacity or dt is reset
+        :param readonly: open an existing buffer for reading only (capacity and dt are taken from the buffer)
+        """
+        self.directory = directory
+        header_file = os.path.join(directory, "header.f64")
+
+        if readonly:
+            self.header = np.memmap(header_file, dtype=np.float64, mode='r', shape=(HEADER_SIZE,))
+            mode = 'r'
+        else:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            is_reusable = os.path.exists(header_file) and os.path.getsize(header_file) == HEADER_SIZE * 8 \
+                and list(np.memmap(header_file, dtype=np.float64, mode='r', shape=(HEADER_SIZE,))[2:4]) \
+                == [dt, capacity]
+            mode = 'r+' if is_reusable else 'w+'
+            self.header = np.memmap(header_file, dtype=np.float64, mode=mode, shape=(HEADER_SIZE,))
+            if not is_reusable:
+                self.header[:] = [0, 0, dt, capacity, 1]
+            self.header[4] = 1
+
+        self.capacity = int(self.header[3])
+        self.dt = float(self.header[2])
+        self.columns = {
+            name: np.memmap(os.path.join(directory, name + "." + np.dtype(dtype).name), dtype=dtype, mode=mode,
+                            shape=(self.capacity,))
+            for name, dtype in COLUMNS
+        }
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, "header.f64"))
+
+    @staticmethod
+    def is_recording(directory):
+        """
+        :return: whether recording into the buffer in the given directory was left on, i.e., is to be resumed
+        """
+        if not TraceBuffer.exists(directory):
+            return False
+        try:
+            return bool(np.memmap(os.path.join(directory, "header.f64"), dtype=np.float64, mode='r',
+                                  shape=(HEADER_SIZE,))[4])
+        except ValueError:  # header of a different layout
+            return False
+
+    @staticmethod
+    def remove(directory):
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def append(self, t, power, energy, state):
+        """
+
+        record the sample at time t. samples that are missing since the last recorded one (e.g., while the
+        simulator was not running) are filled with NaN, a jump back in time starts the buffer over
+
+        :param t: simulation time of the sample
+        :param power:
+        :param energy:
+        :param state:
+        """
+        count = int(self.header[1])
+        if count == 0:
+            self.header[0] = t
+        else:
+            gap = int(round((t - self.header[0]) / self.dt)) - count
+            if gap < 0:
+                self.header[0] = t
+                count = 0
+            elif gap > 0:
+                for k in range(count, count + min(gap, self.capacity)):
+                    self.write(k % self.capacity, np.nan, np.nan, 0)
+                count += gap
+
+        self.write(count % self.capacity, power, energy, state)
+        self.header[1] = count + 1  # written last, so that readers never see a slot before it is filled
+
+    def write(self, slot, power, energy, state):
+        self.columns["power"][slot] = power
+        self.columns["energy"][slot] = energy
+        self.columns["state"][slot] = state
+
+    def read(self, start=None, end=None):
+        """
+
+        :param start: time of the first sample to read (None for the oldest one kept)
+        :param end: time up to which samples are read, exclusive (None for up to the latest one)
+        :return: dict of arrays 'time', 'power', 'energy' and 'state'. these are views of the buffer unless the
+                 range wraps around the end of the ring
+        """
+        t0, count = float(self.header[0]), int(self.header[1])
+        first, last = max(0, count - self.capacity), count
+        if start is not None:
+            first = max(first, int(math.ceil((start - t0) / self.dt)))
+        if end is not None:
+            last = min(last, int(math.ceil((end - t0) / self.dt)))
+        last = max(first, last)
+
+        begin, size = first % self.capacity, last - first
+        if begin + size <= self.capacity:
+            data = {name: column[begin:begin + size] for name, column in self.columns.items()}
+        else:
+            data = {name: np.concatenate((column[begin:], column[:begin + size - self.capacity]))
+                    for name, column in self.columns.items()}
+        data["time"] = t0 + self.dt * np.arange(first, last)
+        return data
+
+    def nbytes(self):
+        return self.header.nbytes + sum(column.nbytes for column in self.columns.values())
+
+    def flush(self):
+        self.header.flush()
+        for column in self.columns.values():
+            column.flush()
+
+    def stop_recording(self):
+        self.header[4] = 0
+
+    def close(self):
+        if self.header.mode != 'r':
+            self.flush()
+        self.header = None
+        self.columns = dict()
+
+    def __repr__(self):
+        return "<%s(directory='%s', capacity='%d')>" % (self.__class__.__name__, self.directory, self.capacity)
@@ -0,0 +1,83 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from app.simulator import checkpoint
+from app.simulator import fmu_cache
+from app.simulator.device_simulator import DeviceSimulator
+from app.test.device_simulator_tests import OnOffModel, VARIABLES
+
+
+class FakeSimulation:
+
+    def __init__(self, state):
+        self.state = state
+
+    def get_checkpoint(self):
+        return self.state
+
+
+class CheckpointTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, "checkpoint.npz")
+        self.load = fmu_cache.load
+        fmu_cache.load = lambda *args, **kwargs: OnOffModel()
+
+    def tearDown(self):
+        fmu_cache.load = self.load
+        shutil.rmtree(self.directory)
+
+    def test_snapshot_round_trip(self):
+        states = [
+            {"device_id": "lamp", "t": 120.0, "energy": 4800.0, "power": 40.0, "power_state": 1, "u": 1.0,
+             "v": float('nan'), "x": np.empty(0)},
+            {"device_id": "boiler", "t": 60.0, "energy": 10.0, "power": 0.0, "power_state": 0, "u": 0.0, "v": 55.0,
+             "x": np.array([1.5, 2.5])}
+        ]
+
+        checkpoint.save(checkpoint.snapshot([FakeSimulation(state) for state in states]), self.file_path)
+        loaded = checkpoint.load(self.file_path)
+
+        self.assertEqual(sorted(loaded), ["boiler", "lamp"])
+        self.assertFalse(os.path.exists(self.file_path + ".tmp"))
+        self.assertEqual(loaded["lamp"]["energy"], 4800.0)
+        self.assertEqual(loaded["lamp"]["power_state"], 1)
+        self.assertTrue(math.isnan(loaded["lamp"]["v"]))
+        self.assertEqual(len(loaded["lamp"]["x"]), 0)
+        self.assertEqual(loaded["boiler"]["v"], 55.0)
+        self.assertEqual(loaded["boiler"]["x"].tolist(), [1.5, 2.5])
+
+    def test_missing_or_corrupt_checkpoint_is_empty(self):
+        self.assertEqual(checkpoint.load(self.file_path), dict())
+
+        with open(self.file_path, 'wb') as f:
+            f.write(b"not a checkpoint")
+
+        self.assertEqual(checkpoint.load(self.file_path), dict())
+
+    def test_simulation_resumes_from_checkpoint(self):
+        simulation = DeviceSimulator("OnOff", "/tmp/", "Lamp", "lamp", {"p_on": 40.0}, "/tmp/", start_time=0,
+                                     register=False, dt=60, variables=VARIABLES)
+        simulation.set_control({'u': 1.0})
+        simulation.run_step()
+        checkpoint.save(checkpoint.snapshot([simulation]), self.file_path)
+
+        resumed = DeviceSimulator("OnOff", "/tmp/", "Lamp", "lamp", {"p_on": 40.0}, "/tmp/", start_time=600,
+                                  register=False, dt=60, variables=VARIABLES)
+        resumed.restore_checkpoint(checkpoint.load(self.file_path)["lamp"])
+
+        self.assertEqual(resumed.t, 600)
+        self.assertTrue(resumed.get_power_state())
+        self.assertEqual(resumed.control_signal, {'u': 1.0})
+        self.assertEqual(resumed.total_power_reading, 40.0 * 60)
+        self.assertEqual(resumed.live_power_reading, 40.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
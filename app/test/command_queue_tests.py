@@ -0,0 +1,67 @@
+import unittest
+
+from app.simulator import command_queue
+from app.simulator.command_queue import CommandQueue
+
+
+class Simulation:
+    def __init__(self, device_id):
+        self.device_id = device_id
+
+
+class CommandQueueTests(unittest.TestCase):
+
+    def test_commands_are_drained_in_order_of_arrival(self):
+        commands = CommandQueue()
+        commands.put(command_queue.CONTROL, "a", {'u': 1})
+        commands.stop("b")
+        commands.put(command_queue.PARAMS, "a", {'p_on': 10})
+
+        self.assertEqual(commands.drain(), [(command_queue.CONTROL, "a", {'u': 1}), (command_queue.STOP, "b", None),
+                                            (command_queue.PARAMS, "a", {'p_on': 10})])
+        self.assertEqual(len(commands), 0)
+        self.assertEqual(commands.drain(), [])
+
+    def test_started_device_is_simulating_before_loop_picks_it_up(self):
+        commands = CommandQueue()
+        commands.start(Simulation("a"))
+
+        self.assertTrue(commands.is_simulating("a", {}))
+
+    def test_stopped_device_is_not_simulating_before_loop_stops_it(self):
+        commands = CommandQueue()
+        commands.stop("a")
+
+        self.assertFalse(commands.is_simulating("a", {"a": Simulation("a")}))
+        self.assertTrue(commands.is_simulating("b", {"b": Simulation("b")}))
+
+    def test_start_after_stop_cancels_stop(self):
+        commands = CommandQueue()
+        commands.stop("a")
+        commands.start(Simulation("a"))
+
+        self.assertTrue(commands.is_simulating("a", {"a": Simulation("a")}))
+
+    def test_picked_up_simulator_is_no_longer_pending(self):
+        commands = CommandQueue()
+        simulation = Simulation("a")
+        commands.start(simulation)
+
+        commands.started(simulation)
+
+        self.assertNotIn("a", commands.pending_starts)
+
+    def test_replacing_simulator_stays_pending(self):
+        commands = CommandQueue()
+        first, second = Simulation("a"), Simulation("a")
+        commands.start(first)
+        commands.start(second)
+
+        commands.started(first)
+
+        self.assertIs(commands.pending_starts["a"], second)
+        self.assertTrue(commands.is_simulating("a", {}))
+
+
+if __name__ == '__main__':
+    unittest.main()
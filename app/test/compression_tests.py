@@ -0,0 +1,139 @@
+import datetime
+import unittest
+
+from app.util import compression
+
+
+def to_rows(samples):
+    return [{"timestamp": datetime.datetime.fromtimestamp(t), "power": power, "energy": energy, "status": state}
+            for t, power, energy, state in samples]
+
+
+def compress(compressor, samples):
+    stored = []
+    for sample in samples:
+        stored.extend(compressor.offer(sample))
+    return stored
+
+
+class DeadbandTests(unittest.TestCase):
+
+    def test_samples_within_deadband_are_left_out(self):
+        compressor = compression.Deadband(deadband=0.5, max_silence=3600)
+        samples = [(60 * i, 40.0 + 0.1 * (i % 2), 0.01 * i, True) for i in range(10)]
+
+        stored = compress(compressor, samples)
+
+        self.assertEqual(stored, [samples[0]])
+        self.assertEqual(compressor.flush(), [samples[-1]])
+
+    def test_change_beyond_deadband_stores_previous_and_current_sample(self):
+        compressor = compression.Deadband(deadband=0.5, max_silence=3600)
+        samples = [(0, 40.0, 0.0, True), (60, 40.0, 0.1, True), (120, 40.0, 0.2, True), (180, 80.0, 0.3, True)]
+
+        stored = compress(compressor, samples)
+
+        self.assertEqual(stored, [samples[0], samples[2], samples[3]])
+
+    def test_sample_is_stored_after_max_silence(self):
+        compressor = compression.Deadband(deadband=0.5, max_silence=120)
+        samples = [(0, 40.0, 0.0, True), (60, 40.0, 0.1, True), (120, 40.0, 0.2, True)]
+
+        stored = compress(compressor, samples)
+
+        self.assertEqual(stored, [samples[0], samples[2]])
+
+    def test_end_closes_series_with_off_sample(self):
+        compressor = compression.Deadband(deadband=0.5, max_silence=3600)
+        compress(compressor, [(0, 40.0, 0.0, True), (60, 40.0, 0.1, True)])
+
+        stored = compressor.end(90)
+
+        self.assertEqual(stored, [(60, 40.0, 0.1, True), (90, 0.0, 0.1, False)])
+        self.assertEqual(compressor.end(120), [])
+
+
+class SwingingDoorTests(unittest.TestCase):
+
+    def test_linear_ramp_is_reduced_to_end_points(self):
+        compressor = compression.SwingingDoor(deviation=0.5, max_silence=3600)
+        samples = [(60 * i, 10.0 + 2.0 * i, 0.01 * i, True) for i in range(10)]
+
+        stored = compress(compressor, samples) + compressor.flush()
+
+        self.assertEqual(stored, [samples[0], samples[-1]])
+
+    def test_change_of_slope_stores_pivot(self):
+        compressor = compression.SwingingDoor(deviation=0.5, max_silence=3600)
+        samples = [(60 * i, 10.0 + 2.0 * i, 0.0, True) for i in range(5)] + \
+                  [(60 * i, 18.0, 0.0, True) for i in range(5, 10)]
+
+        stored = compress(compressor, samples) + compressor.flush()
+
+        self.assertEqual(stored, [samples[0], samples[4], samples[-1]])
+
+    def test_state_change_is_always_stored(self):
+        compressor = compression.SwingingDoor(deviation=0.5, max_silence=3600)
+        samples = [(0, 10.0, 0.0, True), (60, 10.0, 0.0, True), (120, 10.0, 0.0, False)]
+
+        stored = compress(compressor, samples)
+
+        self.assertEqual(stored, samples)
+
+
+class ReconstructTests(unittest.TestCase):
+
+    def test_gaps_within_on_period_are_filled(self):
+        rows = to_rows([(0, 40.0, 0.0, True), (240, 40.0, 0.4, True)])
+
+        series = compression.reconstruct(rows, 60, 3600, compression.DEADBAND)
+
+        self.assertEqual([row["power"] for row in series], [40.0] * 5)
+        for row, energy in zip(series, [0.0, 0.1, 0.2, 0.3, 0.4]):
+            self.assertAlmostEqual(row["energy"], energy)
+
+    def test_swinging_door_interpolates_power(self):
+        rows = to_rows([(0, 10.0, 0.0, True), (120, 30.0, 0.2, True)])
+
+        series = compression.reconstruct(rows, 60, 3600, compression.SWINGING_DOOR)
+
+        self.assertEqual([row["power"] for row in series], [10.0, 20.0, 30.0])
+
+    def test_off_period_is_not_filled(self):
+        # on for 5 minutes, off for 14 minutes, then on again
+        compressor = compression.Deadband(deadband=0.5, max_silence=3600)
+        stored = compress(compressor, [(60 * i, 40.0, 0.001 * i, True) for i in range(6)])
+        stored += compressor.end(360)
+        compressor = compression.Deadband(deadband=0.5, max_silence=3600)
+        stored += compress(compressor, [(60 * i, 40.0, 0.005, True) for i in range(20, 22)]) + compressor.flush()
+
+        series = compression.reconstruct(to_rows(stored), 60, 3600, compression.DEADBAND)
+
+        off = [row for row in series if 360 < (row["timestamp"] - series[0]["timestamp"]).total_seconds() < 1200]
+        self.assertEqual(off, [])
+        self.assertEqual([row["power"] for row in series if not row["status"]], [0.0])
+        self.assertEqual(len([row for row in series if row["status"]]), 8)
+
+    def test_gap_longer_than_max_silence_is_not_filled(self):
+        rows = to_rows([(0, 40.0, 0.0, True), (600, 40.0, 0.1, True)])
+
+        series = compression.reconstruct(rows, 60, 120, compression.DEADBAND)
+
+        self.assertEqual(len(series), 2)
+
+    def test_aggregate_rows_are_kept(self):
+        rows = to_rows([(0, 40.0, 0.0, True), (240, 40.0, 0.4, True)])
+        rows[0]["resolution"] = "hour"
+
+        series = compression.reconstruct(rows, 60, 3600, compression.DEADBAND)
+
+        self.assertEqual(len(series), 2)
+
+    def test_uncompressed_rows_are_returned_as_they_are(self):
+        rows = to_rows([(0, 40.0, 0.0, True), (240, 40.0, 0.4, True)])
+
+        self.assertIs(compression.reconstruct(rows, 60, 3600, compression.NONE), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,238 @@
+import datetime
+import unittest
+
+import numpy as np
+from attrdict import AttrDict
+
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly
+from app.data.model.device_type_enum import DeviceTypeEnum
+from app.data.repository import device_repo, user_repo
+from app.service import consumption_retention
+from app.service.consumption_retention import HOUR, DAY
+from app.test import sqlite_db
+from app.util import compression
+
+DEADBAND = AttrDict({"storage_compression": compression.DEADBAND, "storage_interval": 60, "storage_max_silence": 3600})
+SWINGING_DOOR = AttrDict({"storage_compression": compression.SWINGING_DOOR, "storage_interval": 60,
+                          "storage_max_silence": 3600})
+
+
+class Aggregate:
+    """stand-in for a row of an aggregate table"""
+
+    def __init__(self, samples, on_samples, power_avg, power_max, energy, source_max_id):
+        self.samples = samples
+        self.on_samples = on_samples
+        self.power_avg = power_avg
+        self.power_max = power_max
+        self.energy = energy
+        self.source_max_id = source_max_id
+
+
+def raw_aggregate(ids, device_ids, seconds, power, energy, state, period=HOUR):
+    ids, power = np.array(ids, dtype=np.int64), np.array(power, dtype=np.float64)
+    return consumption_retention.aggregate(ids, np.array(device_ids, dtype=np.int64),
+                                           np.array(seconds, dtype=np.float64), np.ones(len(ids), dtype=np.int64),
+                                           np.nan_to_num(power), power, np.array(energy, dtype=np.float64),
+                                           np.array(state, dtype=np.int64), period)
+
+
+class AggregateTests(unittest.TestCase):
+
+    def test_records_are_grouped_by_device_and_period(self):
+        aggregates = raw_aggregate(ids=[1, 2, 3, 4, 5],
+                                   device_ids=[7, 8, 7, 7, 8],
+                                   seconds=[0, 60, 3540, 3600, 120],
+                                   power=[10.0, 100.0, 30.0, 50.0, 200.0],
+                                   energy=[0.1, 1.0, 0.3, 0.5, 2.0],
+                                   state=[1, 1, 0, 1, 1])
+
+        self.assertEqual(aggregates["device_id"].tolist(), [7, 7, 8])
+        self.assertEqual(aggregates["period_start"].tolist(), [0, 3600, 0])
+        self.assertEqual(aggregates["samples"].tolist(), [2, 1, 2])
+        self.assertEqual(aggregates["on_samples"].tolist(), [1, 1, 2])
+        self.assertEqual(aggregates["power_avg"].tolist(), [20.0, 50.0, 150.0])
+        self.assertEqual(aggregates["power_max"].tolist(), [30.0, 50.0, 200.0])
+        self.assertEqual(aggregates["energy"].tolist(), [0.3, 0.5, 2.0])
+        self.assertEqual(aggregates["source_max_id"].tolist(), [3, 4, 5])
+
+    def test_energy_is_last_reading_of_period(self):
+        aggregates = raw_aggregate(ids=[3, 1, 2], device_ids=[7, 7, 7], seconds=[120, 0, 60],
+                                   power=[1.0, 1.0, 1.0], energy=[0.3, 0.1, 0.2], state=[1, 1, 1])
+
+        self.assertEqual(aggregates["energy"].tolist(), [0.3])
+
+    def test_missing_power_is_ignored_by_maximum(self):
+        aggregates = raw_aggregate(ids=[1, 2], device_ids=[7, 7], seconds=[0, 60], power=[np.nan, 40.0],
+                                   energy=[0.0, 0.1], state=[0, 1])
+
+        self.assertEqual(aggregates["power_max"].tolist(), [40.0])
+        self.assertEqual(aggregates["power_avg"].tolist(), [20.0])
+
+    def test_hourly_aggregates_roll_up_into_days(self):
+        samples = np.array([60, 60, 30], dtype=np.int64)
+        aggregates = consumption_retention.aggregate(np.array([1, 2, 3], dtype=np.int64),
+                                                     np.array([7, 7, 7], dtype=np.int64),
+                                                     np.array([0, HOUR, DAY], dtype=np.float64),
+                                                     samples, np.array([10.0, 20.0, 30.0]) * samples,
+                                                     np.array([15.0, 25.0, 35.0]), np.array([1.0, 2.0, 3.0]),
+                                                     np.array([60, 0, 30], dtype=np.int64), DAY)
+
+        self.assertEqual(aggregates["period_start"].tolist(), [0, DAY])
+        self.assertEqual(aggregates["samples"].tolist(), [120, 30])
+        self.assertEqual(aggregates["power_avg"].tolist(), [15.0, 30.0])
+        self.assertEqual(aggregates["power_max"].tolist(), [25.0, 35.0])
+        self.assertEqual(aggregates["energy"].tolist(), [2.0, 3.0])
+
+
+def weigh(device_ids, seconds, power, state, storage):
+    return consumption_retention.weigh(np.array(device_ids, dtype=np.int64), np.array(seconds, dtype=np.float64),
+                                       np.array(power, dtype=np.float64), np.array(state, dtype=np.int64), HOUR,
+                                       storage)
+
+
+class WeighTests(unittest.TestCase):
+
+    def test_uncompressed_rows_are_single_samples(self):
+        samples, power_sum = weigh([7, 7], [0, 60], [10.0, np.nan], [1, 1], None)
+
+        self.assertEqual(samples.tolist(), [1, 1])
+        self.assertEqual(power_sum.tolist(), [10.0, 0.0])
+
+    def test_compressed_rows_hold_until_next_row(self):
+        # on at 1 kW for 5 minutes, stored as the first and last sample and the row closing the series
+        samples, power_sum = weigh([7, 7, 7], [0, 240, 300], [1000.0, 1000.0, 0.0], [1, 1, 0], DEADBAND)
+
+        self.assertEqual(samples.tolist(), [4, 1, 55])
+        self.assertEqual(power_sum.tolist(), [4000.0, 1000.0, 0.0])
+
+    def test_rows_of_devices_are_weighed_separately(self):
+        samples, _ = weigh([8, 7, 8, 7], [600, 0, 0, 1800], [1.0] * 4, [1] * 4, DEADBAND)
+
+        self.assertEqual(samples.tolist(), [50, 30, 10, 30])
+
+    def test_rows_hold_at_most_max_silence(self):
+        storage = AttrDict(DEADBAND, storage_max_silence=600)
+
+        samples, _ = weigh([7], [60], [1.0], [1], storage)
+
+        self.assertEqual(samples.tolist(), [10])
+
+    def test_swinging_door_power_is_linear_while_on(self):
+        samples, power_sum = weigh([7, 7, 7], [0, 120, 240], [10.0, 30.0, 0.0], [1, 1, 0], SWINGING_DOOR)
+
+        self.assertEqual(samples.tolist(), [2, 2, 56])
+        # samples of 10 and 20 W, then of 30 W until the device is off
+        self.assertEqual(power_sum.tolist(), [30.0, 60.0, 0.0])
+
+    def test_compressed_series_is_averaged_over_time(self):
+        ids, device_ids, seconds = np.array([1, 2, 3]), np.array([7, 7, 7]), np.array([0.0, 240.0, 300.0])
+        power, state = np.array([1000.0, 1000.0, 0.0]), np.array([1, 1, 0])
+        samples, power_sum = consumption_retention.weigh(device_ids, seconds, power, state, HOUR, DEADBAND)
+
+        aggregates = consumption_retention.aggregate(ids, device_ids, seconds, samples, power_sum, power,
+                                                     np.array([0.0, 0.067, 0.083]), samples * state, HOUR)
+
+        self.assertEqual(aggregates["samples"].tolist(), [60])
+        self.assertEqual(aggregates["on_samples"].tolist(), [5])
+        self.assertAlmostEqual(aggregates["power_avg"][0], 1000.0 * 5 / 60)
+        self.assertEqual(aggregates["power_max"].tolist(), [1000.0])
+
+
+class RollupTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+        user_repo.add_user("alice", "1234", "Alice", "A", "alice@example.com", self.session)
+        self.device = device_repo.add_devices("alice", [("Lamp", "OnOff", {})], DeviceTypeEnum.ACTIVE,
+                                              self.session)[0]
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def add_rows(self, samples):
+        for t, power, energy, state in samples:
+            row = DeviceConsumption(power, energy, state, consumption_retention.to_datetime(t))
+            row.device_id = self.device.id
+            self.session.add(row)
+        self.session.commit()
+
+    def test_compressed_rows_are_rolled_up_over_time(self):
+        start = 1546336800  # 2019-01-01 10:00
+        self.add_rows([(start, 1000.0, 0.0, True), (start + 240, 1000.0, 0.067, True),
+                       (start + 300, 0.0, 0.083, False)])
+
+        rolled_up = consumption_retention.rollup_raw(self.session, consumption_retention.to_datetime(start + HOUR),
+                                                     batch_size=100, storage=DEADBAND)
+
+        self.assertEqual(rolled_up, 3)
+        self.assertEqual(self.session.query(DeviceConsumption).count(), 0)
+        row = self.session.query(DeviceConsumptionHourly).one()
+        self.assertEqual(row.period_start, consumption_retention.to_datetime(start))
+        self.assertEqual((row.samples, row.on_samples), (60, 5))
+        self.assertAlmostEqual(row.power_avg, 1000.0 * 5 / 60)
+        self.assertAlmostEqual(row.energy, 0.083)
+
+
+class LateRowTests(unittest.TestCase):
+
+    def test_rows_included_in_existing_aggregate_are_not_new(self):
+        existing = {(7, consumption_retention.to_datetime(0)): Aggregate(2, 2, 20.0, 30.0, 0.3, 3)}
+
+        new = consumption_retention.is_new(existing, np.array([2, 3, 9]), np.array([7, 7, 7]),
+                                           np.array([60.0, 120.0, 180.0]), HOUR)
+
+        self.assertEqual(new.tolist(), [False, False, True])
+
+    def test_rows_of_other_devices_and_periods_are_new(self):
+        existing = {(7, consumption_retention.to_datetime(0)): Aggregate(2, 2, 20.0, 30.0, 0.3, 3)}
+
+        new = consumption_retention.is_new(existing, np.array([1, 2]), np.array([8, 7]),
+                                           np.array([60.0, HOUR + 60.0]), HOUR)
+
+        self.assertEqual(new.tolist(), [True, True])
+
+    def test_late_rows_are_merged_into_existing_aggregate(self):
+        row = Aggregate(samples=2, on_samples=1, power_avg=20.0, power_max=30.0, energy=0.3, source_max_id=3)
+        aggregates = raw_aggregate(ids=[10, 11], device_ids=[7, 7], seconds=[180, 240], power=[40.0, 80.0],
+                                   energy=[0.4, 0.5], state=[1, 1])
+
+        consumption_retention.merge(row, aggregates, 0)
+
+        self.assertEqual(row.samples, 4)
+        self.assertEqual(row.on_samples, 3)
+        self.assertEqual(row.power_avg, 40.0)
+        self.assertEqual(row.power_max, 80.0)
+        self.assertEqual(row.energy, 0.5)
+        self.assertEqual(row.source_max_id, 11)
+
+
+class CutoffTests(unittest.TestCase):
+
+    def test_raw_rows_are_kept_from_start_of_hour(self):
+        retention = AttrDict({"raw_days": 7, "hourly_days": 0})
+
+        raw_cutoff, hourly_cutoff = consumption_retention.cutoffs(datetime.datetime(2019, 1, 8, 10, 30), retention)
+
+        self.assertEqual(raw_cutoff, datetime.datetime(2019, 1, 1, 10, 0))
+        self.assertIsNone(hourly_cutoff)
+
+    def test_hourly_aggregates_are_kept_from_start_of_day(self):
+        retention = AttrDict({"raw_days": 7, "hourly_days": 30})
+
+        _, hourly_cutoff = consumption_retention.cutoffs(datetime.datetime(2019, 2, 1, 10, 30), retention)
+
+        self.assertEqual(hourly_cutoff, datetime.datetime(2019, 1, 2))
+
+    def test_hourly_aggregates_are_kept_at_least_as_long_as_raw_rows(self):
+        retention = AttrDict({"raw_days": 7, "hourly_days": 3})
+
+        _, hourly_cutoff = consumption_retention.cutoffs(datetime.datetime(2019, 1, 8, 10, 30), retention)
+
+        self.assertEqual(hourly_cutoff, datetime.datetime(2019, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
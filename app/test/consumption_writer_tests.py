@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_type_enum import DeviceTypeEnum
+from app.data.repository import device_repo, user_repo
+from app.service import consumption_writer
+from app.service.consumption_writer import ConsumptionWriter
+from app.test import sqlite_db
+
+
+class ConsumptionWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+        user_repo.add_user("alice", "1234", "Alice", "A", "alice@example.com", self.session)
+        self.device_id = device_repo.add_devices("alice", [("Lamp", "OnOff", {"p_on": 40.0})], DeviceTypeEnum.ACTIVE,
+                                                 self.session)[0].device_id
+
+        self.directory = tempfile.mkdtemp()
+        self.session_scope = consumption_writer.session_scope
+        consumption_writer.session_scope = self.session_scope_of_test
+        # number of writes that succeed before the db goes down, None while it is up
+        self.writes_until_outage = None
+        self.writer = ConsumptionWriter(threading.Event(), os.path.join(self.directory, "spill", "consumption.jsonl"),
+                                        queue_size=4, batch_size=2)
+
+    def tearDown(self):
+        consumption_writer.session_scope = self.session_scope
+        shutil.rmtree(self.directory)
+        self.session.close()
+        self.engine.dispose()
+
+    @contextmanager
+    def session_scope_of_test(self):
+        if self.writes_until_outage is not None:
+            if self.writes_until_outage == 0:
+                raise IOError("db is down")
+            self.writes_until_outage -= 1
+        try:
+            yield self.session
+        except Exception:
+            self.session.rollback()
+            raise
+
+    def samples(self, count, device_id=None):
+        return [(device_id or self.device_id, 1546336800 + 60 * i, 40.0, 0.0007 * i, 1) for i in range(count)]
+
+    def stored(self):
+        return sorted(row.energy for row in self.session.query(DeviceConsumption).all())
+
+    def test_samples_of_unknown_devices_are_dropped(self):
+        self.writer.write(self.samples(2) + self.samples(1, "unknown"))
+
+        self.assertEqual(self.stored(), [0.0, 0.0007])
+        self.assertEqual(self.writer.written, 3)
+
+    def test_samples_beyond_queue_size_are_spilled(self):
+        self.writer.put(self.samples(6))
+
+        self.assertEqual(self.writer.queue.qsize(), 4)
+        self.assertEqual(self.writer.spilled, 2)
+        self.assertTrue(self.writer.serialize()["spill_pending"])
+
+    def test_spilled_samples_are_replayed_and_removed(self):
+        self.writer.spill(self.samples(5))
+
+        self.writer.replay()
+
+        self.assertEqual(len(self.stored()), 5)
+        self.assertFalse(os.path.exists(self.writer.spill_file))
+        self.assertFalse(os.path.exists(self.writer.replay_file))
+        self.assertFalse(os.path.exists(self.writer.replay_file + ".offset"))
+
+    def test_interrupted_replay_continues_at_offset(self):
+        self.writer.spill(self.samples(5))
+        self.writes_until_outage = 1
+
+        self.assertRaises(IOError, self.writer.replay)
+        self.assertEqual(len(self.stored()), 2)
+        self.assertTrue(os.path.exists(self.writer.replay_file + ".offset"))
+
+        # samples spilled during the outage wait for the next replay
+        self.writer.spill(self.samples(1))
+        self.writes_until_outage = None
+        self.writer.replay()
+
+        self.assertEqual(self.stored(), sorted(sample[3] for sample in self.samples(5)))
+        self.assertTrue(os.path.exists(self.writer.spill_file))
+        self.writer.replay()
+        self.assertEqual(len(self.stored()), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import numpy as np
+
+from app.simulator.control_schedule import ControlSchedule
+
+
+class FromEntriesTests(unittest.TestCase):
+
+    def test_offsets_are_relative_to_start_and_sorted(self):
+        schedule = ControlSchedule.from_entries([{"time": 600, "u": 0}, {"time": 0, "u": 1}], start=1000)
+
+        self.assertEqual(schedule.times.tolist(), [1000.0, 1600.0])
+        self.assertEqual(schedule.u.tolist(), [1, 0])
+        self.assertFalse(schedule.has_setpoint())
+
+    def test_later_entry_wins_for_equal_times(self):
+        schedule = ControlSchedule.from_entries([{"time": 60, "u": 1}, {"time": 60, "u": 0}])
+
+        self.assertEqual(schedule.pop_due(60), {'u': 0.0})
+
+    def test_malformed_entries_are_rejected(self):
+        for entries in ([], [{"time": 0}], [{"time": -1, "u": 1}], [{"time": 0, "u": 2}]):
+            self.assertRaises(ValueError, ControlSchedule.from_entries, entries)
+
+
+class PopDueTests(unittest.TestCase):
+
+    def test_latest_due_entry_is_returned_once(self):
+        schedule = ControlSchedule([0, 60, 120, 180], [1, 0, 1, 0])
+
+        self.assertEqual(schedule.pop_due(130), {'u': 1.0})
+        self.assertIsNone(schedule.pop_due(130))
+        self.assertEqual(schedule.next_time(), 180.0)
+
+    def test_nothing_is_due_before_first_entry(self):
+        schedule = ControlSchedule([60], [1])
+
+        self.assertIsNone(schedule.pop_due(59))
+        self.assertFalse(schedule.is_finished())
+
+    def test_schedule_is_finished_after_last_entry(self):
+        schedule = ControlSchedule([0, 60], [1, 0])
+
+        self.assertEqual(schedule.pop_due(3600), {'u': 0.0})
+        self.assertTrue(schedule.is_finished())
+        self.assertIsNone(schedule.next_time())
+        self.assertIsNone(schedule.pop_due(7200))
+        self.assertEqual(schedule.serialize(), [])
+
+    def test_set_point_is_carried_forward_to_entries_without_one(self):
+        schedule = ControlSchedule.from_entries([{"time": 0, "u": 1, "v": 21.5}, {"time": 60, "u": 0},
+                                                 {"time": 120, "u": 1}])
+
+        self.assertEqual(schedule.pop_due(0), {'u': 1.0, 'v': 21.5})
+        self.assertEqual(schedule.pop_due(60), {'u': 0.0, 'v': 21.5})
+        self.assertEqual(schedule.pop_due(120), {'u': 1.0, 'v': 21.5})
+
+    def test_set_point_is_carried_forward_across_skipped_entries(self):
+        schedule = ControlSchedule([0, 60, 120], [1, 1, 0], [18.0, 20.0, np.nan])
+
+        self.assertEqual(schedule.pop_due(150), {'u': 0.0, 'v': 20.0})
+
+    def test_pending_entries_are_serialized(self):
+        schedule = ControlSchedule([0, 60], [1, 0], [20.0, np.nan])
+        schedule.pop_due(0)
+
+        self.assertEqual(schedule.serialize(), [{"time": 60.0, "u": 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import datetime
+import unittest
+
+from sqlalchemy import inspect
+
+from app.data.model.device import Device
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly, DeviceConsumptionDaily
+from app.data.model.device_model import DeviceModel
+from app.data.model.device_type_enum import DeviceTypeEnum
+from app.data.repository import device_repo, user_repo
+from app.test import sqlite_db
+
+
+class DeviceRepoTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+        user_repo.add_user("alice", "1234", "Alice", "A", "alice@example.com", self.session)
+        user_repo.add_user("bob", "1234", "Bob", "B", "bob@example.com", self.session)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def add_devices(self, username, count, device_state=DeviceTypeEnum.ACTIVE):
+        return device_repo.add_devices(username, [("Lamp", "OnOff", {"p_on": 40.0})] * count, device_state,
+                                       self.session)
+
+    def test_device_id_lookups_are_indexed(self):
+        indexes = {index['name']: index['column_names'] for index in inspect(self.engine).get_indexes("device")}
+
+        self.assertEqual(indexes["ix_device_device_id"], ["device_id"])
+        self.assertEqual(indexes["ix_device_user_id_device_id"], ["user_id", "device_id"])
+
+    def test_device_is_found_by_id(self):
+        device = self.add_devices("alice", 2)[1]
+
+        self.assertEqual(device_repo.find_device_by_id(device.device_id, self.session).id, device.id)
+        self.assertIsNone(device_repo.find_device_by_id("unknown", self.session))
+
+    def test_device_is_only_found_for_its_owner(self):
+        device = self.add_devices("alice", 1)[0]
+
+        self.assertEqual([d.id for d in device_repo.find_device(self.session, "alice", device.device_id)],
+                         [device.id])
+        self.assertEqual(device_repo.find_device(self.session, "bob", device.device_id), [])
+
+    def test_only_active_devices_are_found_by_ids(self):
+        active = self.add_devices("alice", 2)
+        inactive = self.add_devices("bob", 1, DeviceTypeEnum.INACTIVE)
+
+        devices = device_repo.find_active_by_ids([active[0].device_id, inactive[0].device_id], self.session)
+
+        self.assertEqual([device.id for device in devices], [active[0].id])
+
+    def add_consumption(self, device, rows):
+        start = datetime.datetime(2019, 1, 1)
+        for i in range(rows):
+            row = DeviceConsumption(40.0, 0.001 * i, True, start + datetime.timedelta(minutes=i))
+            row.device_id = device.id
+            self.session.add(row)
+        for rollup in (DeviceConsumptionHourly, DeviceConsumptionDaily):
+            self.session.add(rollup(device_id=device.id, period_start=start, samples=60, on_samples=60))
+        self.session.commit()
+
+    def count_rows(self, model, device_ids):
+        return self.session.query(model).filter(model.device_id.in_(device_ids)).count()
+
+    def test_devices_are_deleted_with_their_rows_in_batches(self):
+        deleted = self.add_devices("alice", 3)
+        kept = self.add_devices("bob", 1)
+        for device in deleted + kept:
+            self.add_consumption(device, 5)
+        ids = [device.id for device in deleted]
+
+        self.assertEqual(device_repo.delete_devices(ids, self.session, batch_size=2), 3)
+
+        for model in (DeviceConsumption, DeviceConsumptionHourly, DeviceConsumptionDaily, DeviceModel):
+            self.assertEqual(self.count_rows(model, ids), 0)
+            self.assertGreater(self.count_rows(model, [kept[0].id]), 0)
+        self.assertEqual([device.id for device in self.session.query(Device).all()], [kept[0].id])
+
+    def test_device_is_only_deleted_by_its_owner(self):
+        device = self.add_devices("alice", 1)[0]
+        self.add_consumption(device, 3)
+        db_id, device_id = device.id, device.device_id
+
+        self.assertFalse(device_repo.delete_device("bob", device_id, self.session))
+        self.assertTrue(device_repo.delete_device("alice", device_id, self.session))
+        self.assertEqual(self.count_rows(DeviceConsumption, [db_id]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from contextlib import contextmanager
+
+from app.data.model.device_type_enum import DeviceTypeEnum
+from app.data.repository import device_repo, user_repo
+from app.service import device_service
+from app.service.device_service import DeviceService
+from app.simulator import checkpoint
+from app.simulator import command_queue
+from app.simulator.command_queue import CommandQueue
+from app.simulator.device_simulator import DeviceSimulator
+from app.test import sqlite_db
+
+
+class FakeSimulation:
+
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.t = 1000
+        self.power_state = False
+        self.checkpoint = None
+
+    def restore_checkpoint(self, device_checkpoint):
+        self.checkpoint = device_checkpoint
+        self.power_state = bool(device_checkpoint["power_state"])
+
+    def get_power_state(self):
+        return self.power_state
+
+
+class RestoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+        user_repo.add_user("alice", "1234", "Alice", "A", "alice@example.com", self.session)
+
+        self.session_scope = device_service.session_scope
+        self.create_simulation = DeviceService.create_simulation
+        self.load = checkpoint.load
+        self.commands = DeviceSimulator.commands
+        device_service.session_scope = self.session_scope_of_test
+        DeviceService.create_simulation = staticmethod(self.fake_create_simulation)
+        DeviceSimulator.commands = CommandQueue()
+        self.checkpoints = dict()
+        checkpoint.load = lambda file_name: self.checkpoints
+        self.created = []
+
+    def tearDown(self):
+        device_service.session_scope = self.session_scope
+        DeviceService.create_simulation = self.create_simulation
+        checkpoint.load = self.load
+        DeviceSimulator.commands = self.commands
+        self.session.close()
+        self.engine.dispose()
+
+    @contextmanager
+    def session_scope_of_test(self):
+        yield self.session
+
+    def fake_create_simulation(self, device_id, device_name, model_name, model_params):
+        if device_name == "Broken":
+            raise IOError("cannot load FMU")
+        self.created.append(device_id)
+        return FakeSimulation(device_id)
+
+    def add_device(self, device_name, device_state):
+        return device_repo.add_devices("alice", [(device_name, "OnOff", {"p_on": 40.0})], device_state,
+                                       self.session)[0].device_id
+
+    def started(self):
+        return sorted(payload.device_id for command, _, payload in DeviceSimulator.commands.drain()
+                      if command == command_queue.START)
+
+    def test_active_devices_are_restored_in_one_pass(self):
+        on, off = self.add_device("Lamp", DeviceTypeEnum.ON), self.add_device("Fan", DeviceTypeEnum.OFF)
+        self.add_device("Heater", DeviceTypeEnum.INACTIVE)
+
+        DeviceService().restore_device_simulations()
+
+        commands = list(DeviceSimulator.commands.commands)
+        self.assertEqual(sorted(self.created), sorted([on, off]))
+        self.assertIn((command_queue.CONTROL, on, {'u': 1.0}), commands)
+        self.assertEqual(self.started(), sorted([on, off]))
+
+    def test_device_that_cannot_be_restored_does_not_stop_the_others(self):
+        lamp = self.add_device("Lamp", DeviceTypeEnum.OFF)
+        self.add_device("Broken", DeviceTypeEnum.OFF)
+
+        DeviceService().restore_device_simulations()
+
+        self.assertEqual(self.started(), [lamp])
+
+    def test_simulating_devices_are_not_restored_again(self):
+        lamp = self.add_device("Lamp", DeviceTypeEnum.OFF)
+        DeviceSimulator.commands.start(FakeSimulation(lamp))
+        DeviceSimulator.commands.drain()
+
+        DeviceService().restore_device_simulations([lamp])
+
+        self.assertEqual(self.created, [])
+
+    def test_db_state_takes_precedence_over_checkpoint(self):
+        lamp = self.add_device("Lamp", DeviceTypeEnum.OFF)
+        self.checkpoints[lamp] = {"t": 900, "power_state": 1}
+
+        DeviceService().restore_device_simulations()
+
+        self.assertIn((command_queue.CONTROL, lamp, {'u': 0.0}), list(DeviceSimulator.commands.commands))
+
+
+if __name__ == '__main__':
+    unittest.main()
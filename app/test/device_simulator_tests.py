@@ -0,0 +1,323 @@
+import logging
+import unittest
+
+import numpy as np
+
+from app.simulator import device_simulator
+from app.simulator import equivalence
+from app.simulator import fmu_cache
+from app.simulator.device_simulator import DeviceSimulator
+
+VARIABLES = {"all": ["u", "y"], "inputs": ["u"], "outputs": ["y"], "states": [], "tunable": ["p_on"],
+             "value_references": {"u": 0, "y": 1}, "types": {"u": 0, "y": 0}}
+
+
+class OnOffModel:
+    """model with the output y = p_on * u, integrated exactly"""
+
+    def __init__(self):
+        self.values = {"p_on": 40.0, "u": 0.0}
+        self.time = 0
+        self.continuous_states = np.empty(0)
+        self.simulated = []
+        self.released = []
+
+    def simulate_options(self):
+        return dict()
+
+    def get_capability_flags(self):
+        return {'canGetAndSetFMUstate': False}
+
+    def reset(self):
+        self.values["u"] = 0.0
+
+    def initialize(self):
+        pass
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def set_real(self, refs, values):
+        self.values["u"] = float(values[0])
+
+    set_integer = set_real
+
+    def get_real(self, refs):
+        return np.array([self.values["p_on"] * self.values["u"]])
+
+    def simulate(self, start, end, options=None):
+        self.time = end
+        self.simulated.append((start, end, options.get('ncp')))
+        return None
+
+    def get_log(self):
+        return []
+
+    def terminate(self):
+        self.released.append("terminate")
+
+    def free_instance(self):
+        self.released.append("free_instance")
+
+
+class RewindableOnOffModel(OnOffModel):
+    """model that can get and set its state, and returns the output over a horizon"""
+
+    def get_capability_flags(self):
+        return {'canGetAndSetFMUstate': True}
+
+    def get_fmu_state(self):
+        return self.time, dict(self.values)
+
+    def set_fmu_state(self, state):
+        self.time, self.values = state[0], dict(state[1])
+
+    def free_fmu_state(self, state):
+        pass
+
+    def simulate(self, start, end, options=None):
+        OnOffModel.simulate(self, start, end, options)
+        grid = np.linspace(start, end, options.get('ncp') + 1)
+        return {'time': grid, 'y': np.full(len(grid), self.values["p_on"] * self.values["u"])}
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+class DeviceSimulatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.load = fmu_cache.load
+        self.model_class = OnOffModel
+        fmu_cache.load = lambda *args, **kwargs: self.model_class()
+        self.handler = RecordingHandler()
+        self.level = device_simulator.LOGGER.level
+        device_simulator.LOGGER.addHandler(self.handler)
+        device_simulator.LOGGER.setLevel(logging.INFO)
+
+    def tearDown(self):
+        fmu_cache.load = self.load
+        device_simulator.LOGGER.removeHandler(self.handler)
+        device_simulator.LOGGER.setLevel(self.level)
+        DeviceSimulator.models_without_horizon.clear()
+
+    def create(self, device_id="lamp", dt=60, horizon=1):
+        return DeviceSimulator("OnOff", "/tmp/", "Lamp", device_id, {"p_on": 40.0}, "/tmp/", start_time=0,
+                               register=False, horizon=horizon, dormant_when_off=True, dt=dt, variables=VARIABLES)
+
+    def messages(self, level):
+        return [message for message_level, message in self.handler.messages if message_level == level]
+
+    def warnings(self):
+        return self.messages(logging.WARNING)
+
+    def test_steps_integrate_power_over_tick_interval(self):
+        simulation = self.create()
+        simulation.apply_control({'u': 1.0})
+
+        simulation.run_step()
+        simulation.run_step()
+
+        self.assertEqual(simulation.t, 120)
+        self.assertEqual(simulation.live_power_reading, 40.0)
+        self.assertEqual(simulation.total_power_reading, 40.0 * 120)
+
+    def test_no_op_control_leaves_energy_and_clock_unchanged(self):
+        simulation = self.create()
+        simulation.apply_control({'u': 1.0})
+        simulation.run_step()
+        energy, t = simulation.total_power_reading, simulation.t
+
+        simulation.apply_control({'u': 1.0})
+
+        self.assertEqual(simulation.total_power_reading, energy)
+        self.assertEqual(simulation.t, t)
+        self.assertEqual(simulation.live_power_reading, 40.0)
+
+    def test_switching_off_drops_live_power_without_a_step(self):
+        simulation = self.create()
+        simulation.apply_control({'u': 1.0})
+        simulation.run_step()
+        energy, t = simulation.total_power_reading, simulation.t
+
+        simulation.apply_control({'u': 0.0})
+
+        self.assertEqual(simulation.live_power_reading, 0.0)
+        self.assertEqual(simulation.total_power_reading, energy)
+        self.assertEqual(simulation.t, t)
+
+    def test_dormant_device_is_not_integrated(self):
+        simulation = self.create()
+
+        simulation.idle_step()
+
+        self.assertEqual(simulation.t, 60)
+        self.assertEqual(simulation.model.simulated, [])
+        self.assertEqual(simulation.total_power_reading, 0)
+
+    def test_dormant_device_is_integrated_from_the_clock_once_turned_on(self):
+        simulation = self.create()
+        simulation.idle_step()
+        simulation.idle_step()
+
+        simulation.apply_control({'u': 1.0})
+        simulation.run_step()
+
+        self.assertEqual(simulation.model.simulated, [(120, 180, 1)])
+        self.assertEqual(simulation.live_power_reading, 40.0)
+        self.assertEqual(simulation.total_power_reading, 40.0 * 60)
+
+    def test_switching_off_discards_the_horizon(self):
+        self.model_class = RewindableOnOffModel
+        simulation = self.create(horizon=600)
+        simulation.apply_control({'u': 1.0})
+        simulation.run_step()
+
+        simulation.apply_control({'u': 0.0})
+        simulation.run_step()
+
+        self.assertIsNone(simulation.trajectory)
+        self.assertEqual(simulation.model.simulated, [(0, 600, 10)])
+        self.assertEqual(simulation.total_power_reading, 40.0 * 60)
+
+    def test_devices_controlled_alike_are_identical(self):
+        first, second = self.create("lamp1"), self.create("lamp2")
+        for simulation in (first, second):
+            simulation.apply_control({'u': 1.0})
+            simulation.run_step()
+
+        self.assertEqual(equivalence.key(first), equivalence.key(second))
+
+        second.apply_control({'u': 1.0})
+        self.assertNotEqual(equivalence.key(first), equivalence.key(second))
+
+    def test_follower_catches_up_in_a_single_call_once_it_diverges(self):
+        leader, follower = self.create("lamp1"), self.create("lamp2")
+        for simulation in (leader, follower):
+            simulation.apply_control({'u': 1.0})
+            simulation.run_step()
+
+        for _ in range(1000):
+            leader.run_step()
+            follower.follow(leader)
+        self.assertEqual(follower.total_power_reading, leader.total_power_reading)
+        self.assertEqual(len(follower.model.simulated), 1)
+
+        follower.apply_control({'u': 0.5})
+        follower.run_step()
+
+        self.assertIsNone(follower.leader)
+        self.assertEqual(follower.model.simulated[1], (60, 60 * 1001, 1))
+        self.assertEqual(follower.t, leader.t + 60)
+
+    def test_horizon_is_integrated_in_a_single_call(self):
+        self.model_class = RewindableOnOffModel
+        simulation = self.create(horizon=600)
+        simulation.apply_control({'u': 1.0})
+
+        for _ in range(10):
+            simulation.run_step()
+
+        self.assertEqual(simulation.model.simulated, [(0, 600, 10)])
+        self.assertEqual(simulation.live_power_reading, 40.0)
+        self.assertEqual(simulation.total_power_reading, 40.0 * 600)
+
+    def test_control_within_horizon_rewinds_the_model(self):
+        self.model_class = RewindableOnOffModel
+        simulation = self.create(horizon=600)
+        simulation.apply_control({'u': 1.0})
+        for _ in range(3):
+            simulation.run_step()
+
+        simulation.apply_control({'u': 0.5})
+        simulation.run_step()
+
+        self.assertEqual(simulation.model.simulated, [(0, 600, 10), (0, 180, 3), (180, 780, 10)])
+        self.assertEqual(simulation.live_power_reading, 20.0)
+        self.assertEqual(simulation.total_power_reading, 40.0 * 180 + 20.0 * 60)
+
+    def test_model_without_state_is_stepped_once_and_warned_about_once(self):
+        first, second = self.create("lamp1", horizon=600), self.create("lamp2", horizon=600)
+
+        self.assertEqual((first.horizon, second.horizon), (1, 1))
+        self.assertEqual(len(self.warnings()), 1)
+        self.assertIn("'OnOff'", self.warnings()[0])
+
+    def test_model_without_state_is_not_warned_about_without_horizon(self):
+        self.create(horizon=60)
+
+        self.assertEqual(self.warnings(), [])
+
+    def test_tunable_params_are_set_on_the_rewound_model(self):
+        self.model_class = RewindableOnOffModel
+        simulation = self.create(horizon=600)
+        simulation.apply_control({'u': 1.0})
+        for _ in range(3):
+            simulation.run_step()
+
+        simulation.set_params({"p_on": 60.0})
+        simulation.run_step()
+
+        self.assertEqual(simulation.model.simulated, [(0, 600, 10), (0, 180, 3), (180, 780, 10)])
+        self.assertEqual(simulation.live_power_reading, 60.0)
+        self.assertEqual(simulation.total_power_reading, 40.0 * 180 + 60.0 * 60)
+        self.assertEqual(self.messages(logging.INFO), [])
+
+    def test_params_that_are_not_tunable_set_up_the_model_again(self):
+        self.model_class = RewindableOnOffModel
+        simulation = self.create(horizon=600)
+        simulation.apply_control({'u': 1.0})
+        for _ in range(3):
+            simulation.run_step()
+
+        simulation.set_params({"p_on": 60.0, "p_standby": 1.0})
+        simulation.run_step()
+
+        self.assertEqual(simulation.model.values["p_standby"], 1.0)
+        self.assertEqual(simulation.model.simulated[-1], (180, 780, 10))
+        self.assertEqual(simulation.total_power_reading, 40.0 * 180 + 60.0 * 60)
+        self.assertEqual(len(self.messages(logging.INFO)), 1)
+        self.assertIn("not tunable: ['p_standby']", self.messages(logging.INFO)[0])
+
+    def test_retired_simulation_is_released_by_the_loop(self):
+        simulation = self.create()
+        model = simulation.model
+        DeviceSimulator.running_simulations["lamp"] = simulation
+
+        self.assertTrue(DeviceSimulator.retire("lamp"))
+        self.assertFalse(DeviceSimulator.retire("lamp"))
+        self.assertEqual(model.released, [])
+
+        DeviceSimulator.release_retired()
+
+        self.assertNotIn("lamp", DeviceSimulator.running_simulations)
+        self.assertEqual(len(DeviceSimulator.retired_simulations), 0)
+        self.assertEqual(model.released, ["terminate", "free_instance"])
+        self.assertIsNone(simulation.model)
+
+    def test_terminate_releases_buffers_once(self):
+        self.model_class = RewindableOnOffModel
+        simulation = self.create(horizon=600)
+        simulation.apply_control({'u': 1.0})
+        simulation.run_step()
+        model = simulation.model
+        self.assertEqual(simulation.memory_usage()["trajectory"], 10 * 8)
+        self.assertTrue(simulation.memory_usage()["horizon_state"])
+
+        simulation.terminate()
+        simulation.terminate()
+
+        self.assertEqual(model.released, ["terminate", "free_instance"])
+        self.assertEqual(simulation.memory_usage()["trajectory"], 0)
+        self.assertFalse(simulation.memory_usage()["horizon_state"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+
+from app.simulator import equivalence
+
+
+class Simulation:
+    """stand-in for a DeviceSimulator, with what equivalence classes are built from"""
+
+    def __init__(self, name, t=60, history="h", leader=None, schedule=None, dormant=False):
+        self.name = name
+        self.fmu_name = "Appliances_OnOff"
+        self.dt = 60
+        self.horizon = 3600
+        self.t = t
+        self.history = history
+        self.model = object()
+        self.schedule = schedule
+        self.just_turned_on = False
+        self.dormant = dormant
+        self.leader = leader
+
+    def is_dormant(self):
+        return self.dormant
+
+
+def names(groups):
+    return [(representative.name, [member.name for member in members]) for representative, members in groups]
+
+
+class GroupTests(unittest.TestCase):
+
+    def test_identical_simulators_share_a_representative(self):
+        groups = equivalence.group([Simulation("a"), Simulation("b"), Simulation("c", history="other")])
+
+        self.assertEqual(names(groups), [("a", ["b"]), ("c", [])])
+
+    def test_simulators_at_other_times_are_not_grouped(self):
+        groups = equivalence.group([Simulation("a"), Simulation("b", t=120)])
+
+        self.assertEqual(names(groups), [("a", []), ("b", [])])
+
+    def test_simulators_without_key_are_stepped_on_their_own(self):
+        simulations = [Simulation("a", history=None), Simulation("b", history=None), Simulation("c", schedule=[]),
+                       Simulation("d", dormant=True)]
+
+        groups = equivalence.group(simulations)
+
+        self.assertEqual(names(groups), [("a", []), ("b", []), ("c", []), ("d", [])])
+
+    def test_up_to_date_member_is_preferred_as_representative(self):
+        leader = Simulation("leader")
+        follower = Simulation("follower", leader=leader)
+
+        groups = equivalence.group([follower, leader])
+
+        self.assertEqual(names(groups), [("leader", ["follower"])])
+
+
+if __name__ == '__main__':
+    unittest.main()
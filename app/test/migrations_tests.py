@@ -0,0 +1,75 @@
+import unittest
+
+from sqlalchemy import inspect
+
+from app.data import migrations
+from app.test import sqlite_db
+
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+
+    def tables(self):
+        return inspect(self.engine).get_table_names()
+
+    def indexes(self, table):
+        return [index['name'] for index in inspect(self.engine).get_indexes(table)]
+
+    def test_all_migrations_are_pending_on_new_db(self):
+        self.assertIsNone(migrations.current_revision(self.session))
+        self.assertEqual(migrations.pending_migrations(self.session), migrations.MIGRATIONS)
+
+    def test_upgrade_of_db_created_from_models_only_sets_revision(self):
+        applied = migrations.upgrade(self.session)
+
+        self.assertEqual(applied, migrations.MIGRATIONS)
+        self.assertEqual(migrations.current_revision(self.session), migrations.MIGRATIONS[-1].revision)
+        self.assertEqual(migrations.pending_migrations(self.session), [])
+        self.assertEqual(migrations.upgrade(self.session), [])
+
+    def test_downgrade_to_base_reverts_schema(self):
+        migrations.upgrade(self.session)
+
+        reverted = migrations.downgrade(self.session, "base")
+
+        self.assertEqual(reverted, list(reversed(migrations.MIGRATIONS)))
+        self.assertIsNone(migrations.current_revision(self.session))
+        self.assertNotIn("device_consumption_hourly", self.tables())
+        self.assertNotIn("device_consumption_daily", self.tables())
+        self.assertNotIn("ix_device_device_id", self.indexes("device"))
+        self.assertNotIn("ix_device_consumption_device_id_timestamp", self.indexes("device_consumption"))
+
+    def test_upgrade_restores_reverted_schema(self):
+        migrations.downgrade(self.session, "base")
+
+        migrations.upgrade(self.session)
+
+        self.assertIn("device_consumption_hourly", self.tables())
+        self.assertIn("source_max_id", [column['name'] for column in
+                                        inspect(self.engine).get_columns("device_consumption_daily")])
+        self.assertIn("ix_device_user_id_device_id", self.indexes("device"))
+        self.assertIn("ix_device_consumption_timestamp", self.indexes("device_consumption"))
+
+    def test_upgrade_and_downgrade_stop_at_given_revision(self):
+        migrations.downgrade(self.session, "base")
+
+        self.assertEqual([m.revision for m in migrations.upgrade(self.session, "0002")], ["0001", "0002"])
+        self.assertEqual(migrations.current_revision(self.session), "0002")
+        self.assertEqual([m.revision for m in migrations.downgrade(self.session, "0001")], ["0002"])
+        self.assertEqual(migrations.current_revision(self.session), "0001")
+        self.assertIn("ix_device_device_id", self.indexes("device"))
+
+    def test_unknown_revision_is_rejected(self):
+        self.assertRaises(ValueError, migrations.upgrade, self.session, "9999")
+        self.assertFalse(migrations.run_command(self.session, "upgrade", "9999"))
+        self.assertFalse(migrations.run_command(self.session, "downgrade"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import os
+import shutil
+import tempfile
+import unittest
+import zipfile
+
+from app.simulator import model_registry
+from app.simulator.model_io import ModelIO, read_variables, REAL, INTEGER
+
+MODEL_DESCRIPTION = """<?xml version="1.0" encoding="UTF-8"?>
+<fmiModelDescription fmiVersion="2.0" modelName="OnOff">
+  <ModelVariables>
+    <ScalarVariable name="p_on" valueReference="0" causality="parameter" variability="tunable"><Real start="40"/>
+    </ScalarVariable>
+    <ScalarVariable name="u" valueReference="1" causality="input"><Integer start="0"/></ScalarVariable>
+    <ScalarVariable name="v" valueReference="2" causality="input"><Real start="20"/></ScalarVariable>
+    <ScalarVariable name="y" valueReference="3" causality="output"><Real/></ScalarVariable>
+    <ScalarVariable name="x" valueReference="4"><Real/></ScalarVariable>
+  </ModelVariables>
+</fmiModelDescription>
+"""
+
+
+class RecordingModel:
+    """model that records the values set by value reference"""
+
+    def __init__(self):
+        self.calls = []
+
+    def set_real(self, refs, values):
+        self.calls.append(("real", refs.tolist(), values.tolist()))
+
+    def set_integer(self, refs, values):
+        self.calls.append(("integer", refs.tolist(), values.tolist()))
+
+    def get_real(self, refs):
+        self.calls.append(("get", refs.tolist()))
+        return [42.5]
+
+
+class Variable:
+
+    def __init__(self, value_reference, causality, variability, type):
+        self.value_reference = value_reference
+        self.causality = causality
+        self.variability = variability
+        self.type = type
+
+
+class PyfmiModel:
+
+    def get_model_variables(self):
+        return {"p_on": Variable(0, 0, 2, REAL), "u": Variable(1, 2, 4, INTEGER), "v": Variable(2, 2, 4, REAL),
+                "y": Variable(3, 3, 4, REAL), "x": Variable(4, 4, 4, REAL)}
+
+
+class ModelIOTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read_model_description(self):
+        fmu_path = os.path.join(self.directory, "OnOff.fmu")
+        archive = zipfile.ZipFile(fmu_path, 'w')
+        archive.writestr("modelDescription.xml", MODEL_DESCRIPTION)
+        archive.close()
+        return model_registry.read_model_description(fmu_path)
+
+    def test_model_description_and_pyfmi_variables_agree(self):
+        variables = self.read_model_description()
+
+        self.assertEqual(variables["value_references"], {"p_on": 0, "u": 1, "v": 2, "y": 3, "x": 4})
+        self.assertEqual(variables["types"], {"p_on": REAL, "u": INTEGER, "v": REAL, "y": REAL, "x": REAL})
+        self.assertEqual((variables["tunable"], sorted(variables["inputs"]), variables["outputs"],
+                          variables["states"]), (["p_on"], ["u", "v"], ["y"], ["x"]))
+
+        from_pyfmi = read_variables(PyfmiModel())
+        for key in ("value_references", "types"):
+            self.assertEqual(from_pyfmi[key], variables[key])
+        for key in ("tunable", "inputs", "outputs", "states"):
+            self.assertEqual(sorted(from_pyfmi[key]), sorted(variables[key]))
+
+    def test_inputs_are_set_by_value_reference_and_type(self):
+        io, model = ModelIO(self.read_model_description()), RecordingModel()
+
+        io.set_inputs(model, {'u': 1.0, 'v': 55})
+        io.set_inputs(model, {'u': 0})
+
+        self.assertEqual(model.calls, [("integer", [1], [1]), ("real", [2], [55.0]), ("integer", [1], [0])])
+
+    def test_output_is_read_by_value_reference(self):
+        io, model = ModelIO(self.read_model_description()), RecordingModel()
+
+        self.assertEqual(io.get_output(model), 42.5)
+        self.assertEqual(model.calls, [("get", [3])])
+
+    def test_model_without_set_point_ignores_it(self):
+        variables = {"value_references": {"u": 0, "y": 1}, "types": {"u": REAL, "y": REAL}}
+        io, model = ModelIO(variables), RecordingModel()
+
+        io.set_inputs(model, {'u': 1, 'v': 55})
+
+        self.assertEqual(model.calls, [("real", [0], [1.0])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import unittest
+
+from app.simulator import model_registry
+from app.simulator.model_registry import ModelSpec
+
+PARAMS = {"p_on": {"min": 1.0, "max": 100.0, "default": 40.0}, "p_standby": {"min": 0.0, "max": 5.0, "default": 0.5}}
+
+
+class ValidateBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.models = dict(model_registry.models)
+        model_registry.models.clear()
+        model_registry.models["OnOff"] = ModelSpec("OnOff", "Appliances_OnOff", "/tmp/Appliances_OnOff.fmu", PARAMS)
+        model_registry.models["Heater"] = ModelSpec("Heater", "Appliances_Heater", "/tmp/Appliances_Heater.fmu",
+                                                    {"p_on": {"min": 500.0, "max": 3000.0, "default": 2000.0}})
+
+    def tearDown(self):
+        model_registry.models.clear()
+        model_registry.models.update(self.models)
+
+    def test_valid_devices_have_no_errors(self):
+        devices = [{"model_name": "OnOff", "params": {"p_on": 60}}, {"model_name": "Heater", "params": {}},
+                   {"model_name": "OnOff", "params": None}]
+
+        self.assertEqual(model_registry.validate_batch(devices), [])
+
+    def test_errors_are_reported_by_position_across_models(self):
+        devices = [{"model_name": "Heater", "params": {"p_on": 100}},
+                   {"model_name": "OnOff", "params": {"p_on": 60}},
+                   {"model_name": "Fridge", "params": {}},
+                   {"model_name": "OnOff", "params": {"p_standby": 6}}]
+
+        errors = model_registry.validate_batch(devices)
+
+        self.assertEqual([i for i, _ in errors], [0, 2, 3])
+        self.assertIn("parameter: p_on", errors[0][1])
+        self.assertIn("invalid model_type", errors[1][1])
+        self.assertIn("parameter: p_standby", errors[2][1])
+
+    def test_unknown_and_non_numeric_parameters_are_rejected(self):
+        devices = [{"model_name": "OnOff", "params": {"color": 1}}, {"model_name": "OnOff", "params": {"p_on": "x"}}]
+
+        errors = model_registry.validate_batch(devices)
+
+        self.assertIn("invalid model parameters", errors[0][1])
+        self.assertIn("not a number", errors[1][1])
+
+    def test_numeric_strings_and_booleans_are_rejected(self):
+        devices = [{"model_name": "OnOff", "params": {"p_on": "5"}}, {"model_name": "OnOff", "params": {"p_on": True}},
+                   {"model_name": "OnOff", "params": {"p_on": 5}}]
+
+        errors = model_registry.validate_batch(devices)
+
+        self.assertEqual([i for i, _ in errors], [0, 1])
+        self.assertTrue(all("not a number" in error for _, error in errors))
+
+    def test_missing_parameters_take_defaults(self):
+        spec = model_registry.get("OnOff")
+
+        self.assertIsNone(spec.validate({"p_standby": 1.0}))
+        self.assertIsNotNone(spec.validate({"p_on": 0.5}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+from app.data import replica
+
+
+class ReplicaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.session_scope = replica.session_scope
+        replica.session_scope = self.primary_session_scope
+
+    def tearDown(self):
+        replica.session_scope = self.session_scope
+        for configured in replica.replicas:
+            configured.engine.dispose()
+        replica.configure([])
+        shutil.rmtree(self.directory)
+
+    @contextmanager
+    def primary_session_scope(self):
+        yield "primary"
+
+    def url(self, name):
+        return "sqlite:///" + os.path.join(self.directory, name + ".db")
+
+    def test_reads_go_to_the_primary_without_replicas(self):
+        replica.configure([])
+
+        with replica.read_session_scope() as session:
+            self.assertEqual(session, "primary")
+
+    def test_reads_are_spread_over_fresh_replicas(self):
+        replica.configure([self.url("first"), self.url("second")])
+
+        picked = [replica.pick_replica() for _ in range(4)]
+
+        self.assertEqual([r.url for r in picked], [self.url("first"), self.url("second")] * 2)
+        with replica.read_session_scope() as session:
+            self.assertEqual(str(session.bind.url), self.url("first"))
+
+    def test_lagging_or_unreachable_replicas_fall_back_to_the_primary(self):
+        replica.configure([self.url("lagging"), "sqlite:///" + os.path.join(self.directory, "missing", "db")])
+        replica.replicas[0].query_lag = lambda: 3600
+
+        self.assertIsNone(replica.pick_replica())
+        self.assertIsNone(replica.replicas[1].lag)
+        with replica.read_session_scope() as session:
+            self.assertEqual(session, "primary")
+
+    def test_lag_is_not_queried_again_within_check_interval(self):
+        replica.configure([self.url("first")])
+        lags = [0, 3600]
+        replica.replicas[0].query_lag = lambda: lags.pop(0)
+
+        self.assertTrue(replica.replicas[0].is_fresh(max_lag=30, check_interval=10))
+        self.assertTrue(replica.replicas[0].is_fresh(max_lag=30, check_interval=10))
+        self.assertFalse(replica.replicas[0].is_fresh(max_lag=30, check_interval=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import threading
+import unittest
+from contextlib import contextmanager
+
+from app.data.model.device_type_enum import DeviceTypeEnum
+from app.data.repository import device_repo, user_repo
+from app.service import simulation_reconciler
+from app.service.simulation_reconciler import SimulationReconciler
+from app.simulator import command_queue
+from app.simulator.command_queue import CommandQueue
+from app.simulator.device_simulator import DeviceSimulator
+from app.test import sqlite_db
+
+
+class SimulationReconcilerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+        user_repo.add_user("alice", "1234", "Alice", "A", "alice@example.com", self.session)
+        self.lamp, self.fan = [device.device_id for device in device_repo.add_devices(
+            "alice", [("Lamp", "OnOff", {"p_on": 40.0}), ("Fan", "OnOff", {"p_on": 60.0})], DeviceTypeEnum.ACTIVE,
+            self.session)]
+
+        self.session_scope = simulation_reconciler.session_scope
+        self.commands = DeviceSimulator.commands
+        self.running_simulations = DeviceSimulator.running_simulations
+        simulation_reconciler.session_scope = self.session_scope_of_test
+        DeviceSimulator.commands = CommandQueue()
+        DeviceSimulator.running_simulations = dict()
+
+        self.restored = []
+        self.reconciler = SimulationReconciler(self.restored.append, threading.Event(), interval=0,
+                                               full_check_interval=60, max_attempts=2)
+
+    def tearDown(self):
+        simulation_reconciler.session_scope = self.session_scope
+        DeviceSimulator.commands = self.commands
+        DeviceSimulator.running_simulations = self.running_simulations
+        self.session.close()
+        self.engine.dispose()
+
+    @contextmanager
+    def session_scope_of_test(self):
+        yield self.session
+
+    def test_missing_simulations_are_started_and_unwanted_ones_stopped(self):
+        self.reconciler.full_check(force=True)
+        DeviceSimulator.running_simulations[self.lamp] = object()
+        DeviceSimulator.running_simulations["deleted"] = object()
+
+        self.reconciler.reconcile()
+
+        self.assertEqual(self.restored, [[self.fan]])
+        self.assertEqual(DeviceSimulator.commands.drain(), [(command_queue.STOP, "deleted", None)])
+
+    def test_held_devices_are_not_started_again(self):
+        self.reconciler.full_check(force=True)
+        self.reconciler.hold(self.fan)
+        DeviceSimulator.running_simulations[self.lamp] = object()
+
+        self.reconciler.full_check()
+        self.reconciler.reconcile()
+
+        self.assertEqual(self.restored, [])
+        self.assertEqual(self.reconciler.resyncs, 0)
+
+    def test_full_check_compares_ids_rather_than_counts(self):
+        self.reconciler.want(self.lamp)
+        self.reconciler.want("deleted")
+
+        self.reconciler.full_check()
+
+        self.assertEqual(self.reconciler.desired, {self.lamp, self.fan})
+        self.assertEqual(self.reconciler.resyncs, 1)
+
+    def test_device_is_given_up_on_after_max_attempts(self):
+        self.reconciler.full_check(force=True)
+        DeviceSimulator.running_simulations[self.lamp] = object()
+        for _ in range(3):
+            self.reconciler.reconcile()
+
+        self.assertEqual(self.restored, [[self.fan], [self.fan]])
+        self.assertEqual(self.reconciler.failed, {self.fan})
+
+        self.reconciler.want(self.fan)
+        self.reconciler.reconcile()
+
+        self.assertEqual(self.restored[-1], [self.fan])
+
+
+if __name__ == '__main__':
+    unittest.main()
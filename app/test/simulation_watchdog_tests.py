@@ -0,0 +1,56 @@
+import threading
+import time
+import unittest
+
+from app.service.simulation_watchdog import SimulationWatchdog
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class SimulationWatchdogTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stop_event = threading.Event()
+        self.runs = 0
+
+    def tearDown(self):
+        self.stop_event.set()
+
+    def loop(self):
+        """simulation loop that dies on its first run and ticks until stopped on the next ones"""
+        self.runs += 1
+        if self.runs == 1:
+            raise RuntimeError("solver failed")
+        while not self.stop_event.wait(0.01):
+            self.watchdog.beat(0.001)
+
+    def test_dead_simulation_thread_is_restarted(self):
+        self.watchdog = SimulationWatchdog(self.loop, self.stop_event, check_interval=0.01)
+        self.watchdog.start()
+
+        self.assertTrue(wait_for(lambda: self.watchdog.ticks > 0))
+        self.assertEqual(self.watchdog.restarts, 1)
+        self.assertEqual(self.watchdog.last_error, "RuntimeError: solver failed")
+        self.assertTrue(self.watchdog.is_healthy())
+
+        self.stop_event.set()
+        self.assertTrue(self.watchdog.join_engine(5.0))
+        self.assertFalse(self.watchdog.serialize()["engine_alive"])
+
+    def test_simulation_without_heartbeat_is_unhealthy(self):
+        self.watchdog = SimulationWatchdog(lambda: self.stop_event.wait(), self.stop_event, check_interval=0.01,
+                                           stall_timeout=0.05)
+        self.watchdog.start()
+
+        self.assertTrue(wait_for(lambda: self.watchdog.heartbeat_age() > 0.05))
+        self.assertFalse(self.watchdog.is_healthy())
+        self.assertEqual(self.watchdog.restarts, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
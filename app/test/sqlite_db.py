@@ -0,0 +1,34 @@
+import json
+
+from sqlalchemy import create_engine, JSON
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+
+from app.data.database import Base
+# all models, so that their tables and relationships are known before the tables are created
+from app.data.model.device import Device
+from app.data.model.device_consumption import DeviceConsumption
+from app.data.model.device_consumption_rollup import DeviceConsumptionHourly, DeviceConsumptionDaily
+from app.data.model.device_model import DeviceModel
+from app.data.model.user import User
+from app.data.model.user_role import Role
+
+
+@compiles(JSON, "sqlite")
+def compile_json(type_, compiler, **kw):
+    # SQLite has no JSON type (nor does SQLAlchemy 1.2 render one for it), the values are stored as text
+    return "TEXT"
+
+
+def create_session():
+    """
+
+    create an in-memory SQLite db from the models, for tests of the repositories and services
+
+    :return: (engine, session)
+    """
+    engine = create_engine("sqlite://")
+    engine.dialect._json_serializer = json.dumps
+    engine.dialect._json_deserializer = json.loads
+    Base.metadata.create_all(engine)
+    return engine, sessionmaker(bind=engine)()
@@ -0,0 +1,79 @@
+import unittest
+
+from app.simulator.tick_scheduler import TickScheduler
+
+
+class Simulation:
+    def __init__(self, t):
+        self.t = t
+
+
+class TickSchedulerTests(unittest.TestCase):
+
+    def test_due_devices_are_popped_in_order_of_due_time(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("c", 30)
+        scheduler.schedule("a", 10)
+        scheduler.schedule("b", 20)
+        scheduler.schedule("d", 40)
+
+        self.assertEqual(scheduler.pop_due(30), ["a", "b", "c"])
+        self.assertEqual(scheduler.next_due(), 40)
+        self.assertEqual(len(scheduler), 1)
+
+    def test_nothing_is_popped_before_it_is_due(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("a", 10)
+
+        self.assertEqual(scheduler.pop_due(9), [])
+        self.assertEqual(scheduler.next_due(), 10)
+
+    def test_rescheduled_device_is_only_due_at_its_new_time(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("a", 10)
+        scheduler.schedule("b", 15)
+        scheduler.schedule("a", 20)
+
+        self.assertEqual(scheduler.pop_due(10), [])
+        self.assertEqual(scheduler.next_due(), 15)
+        self.assertEqual(scheduler.pop_due(20), ["b", "a"])
+        self.assertIsNone(scheduler.next_due())
+
+    def test_device_rescheduled_earlier_is_popped_once(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("a", 20)
+        scheduler.schedule("a", 10)
+
+        self.assertEqual(scheduler.pop_due(30), ["a"])
+
+    def test_removed_device_is_not_due(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("a", 10)
+        scheduler.schedule("b", 20)
+        scheduler.remove("a")
+
+        self.assertEqual(scheduler.next_due(), 20)
+        self.assertEqual(scheduler.pop_due(30), ["b"])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_popped_device_is_due_again_once_rescheduled(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("a", 10)
+        scheduler.pop_due(10)
+        scheduler.schedule("a", 70)
+
+        self.assertEqual(scheduler.pop_due(69), [])
+        self.assertEqual(scheduler.pop_due(70), ["a"])
+
+    def test_reset_schedules_simulations_at_their_clocks(self):
+        scheduler = TickScheduler()
+        scheduler.schedule("old", 0)
+
+        scheduler.reset({"a": Simulation(120), "b": Simulation(60)})
+
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.pop_due(1000), ["b", "a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from app.simulator.trace_buffer import TraceBuffer
+
+
+class TraceBufferTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def fill(self, buf, times):
+        for t in times:
+            buf.append(t, float(t), t / 10.0, 1)
+
+    def test_samples_are_read_back_in_order(self):
+        buf = TraceBuffer(self.directory, capacity=5, dt=60)
+        self.fill(buf, [0, 60, 120])
+
+        data = buf.read()
+
+        self.assertEqual(data["time"].tolist(), [0, 60, 120])
+        self.assertEqual(data["power"].tolist(), [0.0, 60.0, 120.0])
+        self.assertEqual(data["state"].tolist(), [1, 1, 1])
+
+    def test_oldest_samples_are_overwritten_once_full(self):
+        buf = TraceBuffer(self.directory, capacity=4, dt=60)
+        self.fill(buf, [60 * i for i in range(7)])
+
+        data = buf.read()
+
+        self.assertEqual(data["time"].tolist(), [180, 240, 300, 360])
+        self.assertEqual(data["power"].tolist(), [180.0, 240.0, 300.0, 360.0])
+
+    def test_range_across_end_of_ring_is_joined(self):
+        buf = TraceBuffer(self.directory, capacity=4, dt=60)
+        self.fill(buf, [60 * i for i in range(7)])
+
+        data = buf.read(start=200, end=330)
+
+        self.assertEqual(data["time"].tolist(), [240, 300])
+        self.assertEqual(data["energy"].tolist(), [24.0, 30.0])
+
+    def test_missing_samples_are_filled_with_nan(self):
+        buf = TraceBuffer(self.directory, capacity=5, dt=60)
+        self.fill(buf, [0, 180])
+
+        data = buf.read()
+
+        self.assertEqual(data["time"].tolist(), [0, 60, 120, 180])
+        self.assertTrue(np.isnan(data["power"][1:3]).all())
+        self.assertEqual(data["state"].tolist(), [1, 0, 0, 1])
+
+    def test_jump_back_in_time_starts_over(self):
+        buf = TraceBuffer(self.directory, capacity=5, dt=60)
+        self.fill(buf, [600, 660, 120])
+
+        self.assertEqual(buf.read()["time"].tolist(), [120])
+
+    def test_buffer_is_reopened_with_its_samples(self):
+        buf = TraceBuffer(self.directory, capacity=4, dt=60)
+        self.fill(buf, [60 * i for i in range(6)])
+        buf.close()
+
+        buf = TraceBuffer(self.directory, readonly=True)
+
+        self.assertEqual(buf.capacity, 4)
+        self.assertEqual(buf.read()["time"].tolist(), [120, 180, 240, 300])
+
+    def test_buffer_with_other_capacity_is_reset(self):
+        buf = TraceBuffer(self.directory, capacity=4, dt=60)
+        self.fill(buf, [0, 60])
+        buf.close()
+
+        buf = TraceBuffer(self.directory, capacity=8, dt=60)
+
+        self.assertEqual(buf.read()["time"].tolist(), [])
+
+    def test_recording_state_is_kept_in_header(self):
+        buf = TraceBuffer(self.directory, capacity=4, dt=60)
+        self.assertTrue(TraceBuffer.is_recording(self.directory))
+
+        buf.stop_recording()
+        buf.close()
+
+        self.assertFalse(TraceBuffer.is_recording(self.directory))
+
+
+if __name__ == '__main__':
+    unittest.main()
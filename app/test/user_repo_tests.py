@@ -0,0 +1,76 @@
+import unittest
+
+from sqlalchemy import event
+
+from app.data.model.device_type_enum import DeviceTypeEnum
+from app.data.repository import device_repo, user_repo
+from app.test import sqlite_db
+
+
+class UserRepoTests(unittest.TestCase):
+
+    def setUp(self):
+        self.engine, self.session = sqlite_db.create_session()
+        self.statements = []
+        event.listen(self.engine, "before_cursor_execute", self.count_statement)
+
+    def tearDown(self):
+        event.remove(self.engine, "before_cursor_execute", self.count_statement)
+        self.session.close()
+        self.engine.dispose()
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def add_user(self, username, device_count):
+        user_repo.add_user(username, "1234", username.title(), "X", username + "@example.com", self.session)
+        device_repo.add_devices(username, [("Lamp", "OnOff", {"p_on": 40.0})] * device_count,
+                                DeviceTypeEnum.ACTIVE, self.session)
+
+    def serialize_all(self):
+        self.session.expire_all()
+        users = user_repo.find_user(self.session)
+        del self.statements[:]
+        return user_repo.serialize_users(users, self.session)
+
+    def test_devices_are_counted_per_user(self):
+        self.add_user("alice", 2)
+        self.add_user("bob", 0)
+        self.add_user("carol", 7)
+        users = {user.username: user.id for user in user_repo.find_user(self.session)}
+
+        counts = user_repo.count_devices(self.session)
+
+        self.assertEqual(counts, {users["alice"]: 2, users["carol"]: 7})
+        self.assertEqual(user_repo.count_devices(self.session, [users["alice"]]), {users["alice"]: 2})
+
+    def test_users_are_serialized_with_a_fixed_number_of_queries(self):
+        self.add_user("alice", 2)
+        self.add_user("bob", 0)
+        self.add_user("carol", 7)
+        serialized = {user["username"]: user for user in self.serialize_all()}
+        queries = len(self.statements)
+
+        self.assertEqual(serialized["alice"]["no_of_devices"], 2)
+        self.assertTrue(all(device["device_model"] is not None for device in serialized["alice"]["devices"]))
+        self.assertEqual(serialized["bob"]["devices"], ["total 0 devices"])
+        self.assertEqual(serialized["carol"]["devices"], ["total 7 devices"])
+
+        for username in ("dave", "erin", "frank"):
+            self.add_user(username, 3)
+        self.assertEqual(len(self.serialize_all()), 6)
+        self.assertEqual(len(self.statements), queries)
+
+    def test_devices_of_user_are_listed_with_their_models_in_one_query(self):
+        self.add_user("alice", 3)
+        self.session.expire_all()
+        del self.statements[:]
+
+        devices = user_repo.get_user_devices(self.session, "alice", serialize=True)
+
+        self.assertEqual(len(devices), 3)
+        self.assertEqual(len(self.statements), 2)  # the user and the devices with their models
+
+
+if __name__ == '__main__':
+    unittest.main()
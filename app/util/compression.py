@@ -0,0 +1,198 @@
+import datetime
+
+NONE = "none"
+DEADBAND = "deadband"
+SWINGING_DOOR = "swinging_door"
+METHODS = [NONE, DEADBAND, SWINGING_DOOR]
+
+
+class Compressor:
+    """
+    This class decides which samples of a series of consumption data need to be stored. a sample is a tuple of
+    (time in seconds, power, energy, state). samples are always stored when the state changes, and at least every
+    'max_silence' seconds. a series covers a single period in which the device is on, and is closed by end()
+    """
+
+    def __init__(self, max_silence):
+        self.max_silence = max_silence
+        self.last_stored = None
+        # latest sample that was not stored, which is stored when the series ends
+        self.pending = None
+
+    def offer(self, sample):
+        """
+        :param sample: next sample of the series
+        :return: list of samples to store
+        """
+        if self.last_stored is None or sample[3] != self.last_stored[3]:
+            return self.store(([self.pending] if self.pending is not None else []) + [sample])
+
+        if self.is_within(sample):
+            if sample[0] - self.last_stored[0] >= self.max_silence:
+                return self.store([sample])
+            self.pending = sample
+            return []
+        return self.on_exceeded(sample)
+
+    def flush(self):
+        """
+        :return: list of samples to store when the series ends (e.g., the device is switched off)
+        """
+        return self.store([self.pending]) if self.pending is not None else []
+
+    def end(self, t, energy=None):
+        """
+        close the series with an explicit sample of the device being off, so that the period in which it was off is
+        not taken for samples that were left out
+
+        :param t: time at which the device was found off
+        :param energy: energy total of the device, or None to keep the last one of the series
+        :return: list of samples to store
+        """
+        last = self.pending if self.pending is not None else self.last_stored
+        if last is None:
+            return []
+        samples = self.flush()
+        samples.append((t, 0.0, energy if energy is not None else last[2], False))
+        self.last_stored = None
+        return samples
+
+    def store(self, samples):
+        if len(samples) > 0:
+            self.last_stored = samples[-1]
+            self.pending = None
+            self.restart()
+        return samples
+
+    def restart(self):
+        pass
+
+    def is_within(self, sample):
+        """
+        :return: whether the sample can be reconstructed from the stored ones, i.e., does not need to be stored
+        """
+        raise NotImplementedError
+
+    def on_exceeded(self, sample):
+        """
+        :return: list of samples to store when the given sample cannot be reconstructed
+        """
+        raise NotImplementedError
+
+
+class Deadband(Compressor):
+    """
+    stores a sample if its power differs from the last stored one by more than the deadband. the series is
+    reconstructed as a step function of power
+    """
+
+    def __init__(self, deadband, max_silence):
+        Compressor.__init__(self, max_silence)
+        self.deadband = deadband
+
+    def is_within(self, sample):
+        return abs(sample[1] - self.last_stored[1]) <= self.deadband
+
+    def on_exceeded(self, sample):
+        # the value held until now ends with the previous sample
+        return self.store(([self.pending] if self.pending is not None else []) + [sample])
+
+
+class SwingingDoor(Compressor):
+    """
+    stores the samples needed to reconstruct power by linear interpolation within the given deviation, using the
+    swinging door trending algorithm
+    """
+
+    def __init__(self, deviation, max_silence):
+        Compressor.__init__(self, max_silence)
+        self.deviation = deviation
+        self.slope_upper = None
+        self.slope_lower = None
+
+    def restart(self):
+        self.slope_upper = float('inf')
+        self.slope_lower = float('-inf')
+
+    def is_within(self, sample):
+        t0, p0 = self.last_stored[0], self.last_stored[1]
+        dt = sample[0] - t0
+        if dt <= 0:
+            return True
+        slope_upper = min(self.slope_upper, (sample[1] + self.deviation - p0) / dt)
+        slope_lower = max(self.slope_lower, (sample[1] - self.deviation - p0) / dt)
+        if slope_lower > slope_upper:
+            return False
+        self.slope_upper, self.slope_lower = slope_upper, slope_lower
+        return True
+
+    def on_exceeded(self, sample):
+        # the door closed: the previous sample is stored and becomes the new pivot, from which the door is opened
+        # again towards the current sample
+        if self.pending is None:
+            return self.store([sample])
+        pivot = self.pending
+        self.store([pivot])
+        self.is_within(sample)
+        self.pending = sample
+        return [pivot]
+
+
+def create_compressor(method, deadband, max_silence):
+    """
+    :param method: one of METHODS
+    :param deadband: power deviation in watts that is not stored
+    :param max_silence: seconds after which a sample is stored regardless of its value
+    :return: a new compressor, or None if no compression is to be applied
+    """
+    if method == DEADBAND:
+        return Deadband(deadband, max_silence)
+    if method == SWINGING_DOOR:
+        return SwingingDoor(deadband, max_silence)
+    return None
+
+
+def reconstruct(rows, interval, max_silence, method):
+    """
+
+    fill in the rows that were not stored by a compressor, at the given interval. power is reconstructed as a step
+    function (deadband) or linearly (swinging door), energy linearly and the state as a step function. only gaps
+    between two rows of the same period in which the device was on are filled: each such period is closed by a row
+    of the device being off, and gaps longer than max_silence are periods in which the device was not simulated
+
+    :param rows: serialized consumption rows ordered by time. rows of aggregates (with 'resolution') are kept as
+                 they are
+    :param interval: seconds between two samples of the series
+    :param max_silence: seconds after which a compressor stores a sample regardless of its value
+    :param method: the compression method the rows were stored with
+    :return: list of serialized consumption rows
+    """
+    if method not in (DEADBAND, SWINGING_DOOR) or len(rows) < 2:
+        return rows
+
+    series = []
+    for i, row in enumerate(rows):
+        series.append(row)
+        if i + 1 == len(rows) or "resolution" in row or "resolution" in rows[i + 1]:
+            continue
+
+        following = rows[i + 1]
+        gap = (following["timestamp"] - row["timestamp"]).total_seconds()
+        if gap > max_silence + interval or not row["status"] or not following["status"]:
+            continue
+
+        for k in range(1, int(round(gap / interval))):
+            fraction = k * interval / gap
+            power = row["power"]
+            if method == SWINGING_DOOR and row["power"] is not None and following["power"] is not None:
+                power = row["power"] + fraction * (following["power"] - row["power"])
+            energy = row["energy"]
+            if row["energy"] is not None and following["energy"] is not None:
+                energy = row["energy"] + fraction * (following["energy"] - row["energy"])
+            series.append({
+                "power": power,
+                "energy": energy,
+                "status": True,
+                "timestamp": row["timestamp"] + datetime.timedelta(seconds=k * interval)
+            })
+    return series
@@ -43,9 +43,75 @@ def parse_args(args):
                         default=False,
                         help='whether to create FMUs on disk or not')
 
+    parser.add_argument('--batch',
+                        action='store',
+                        default=None,
+                        metavar='SPEC_FILE',
+                        help='run a batch simulation described by the given JSON file and exit')
+
+    parser.add_argument('--batch-output',
+                        action='store',
+                        default='batch_traces.npz',
+                        help='file to store the traces of the batch simulation in')
+
+    # sub commands, the server is run if none is given
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help='run the simulator server (default)')
+
+    db_parser = subparsers.add_parser('db', help='manage the schema of the database')
+    db_parser.add_argument('action',
+                           choices=['upgrade', 'downgrade', 'current', 'history'],
+                           help='upgrade or downgrade the schema, or show its revision or the migration history')
+    db_parser.add_argument('revision',
+                           nargs='?',
+                           default=None,
+                           help="target revision of upgrade (defaults to the latest) or downgrade ('base' for none)")
+
+    export_parser = subparsers.add_parser('export', help='export consumption data to a columnar file')
+    export_parser.add_argument('--device-ids',
+                               nargs='+',
+                               default=None,
+                               help='ids of the devices to export (defaults to all devices)')
+    export_parser.add_argument('--start',
+                               type=float,
+                               default=None,
+                               help='unix time in seconds of the first row to export')
+    export_parser.add_argument('--end',
+                               type=float,
+                               default=None,
+                               help='unix time in seconds up to which rows are exported (exclusive)')
+    export_parser.add_argument('--format',
+                               choices=['npz', 'parquet'],
+                               default='npz',
+                               help='file format (parquet requires pyarrow)')
+    export_parser.add_argument('--output',
+                               required=True,
+                               help='file to export to')
+
+    if find_command(parser, args) is None and '-h' not in args and '--help' not in args:
+        args = list(args) + ['serve']
+
     return parser.parse_args(args)
 
 
+def find_command(parser, args):
+    """
+    :return: the first positional argument, i.e., the sub command, or None if there is none. values of options are
+             skipped, so that e.g. '--profile db' is not taken for the 'db' command
+    """
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '--':
+            return args[i + 1] if i + 1 < len(args) else None
+        if not arg.startswith('-'):
+            return arg
+        action = parser._option_string_actions.get(arg.split('=', 1)[0])
+        takes_value = action is not None and action.nargs != 0 and '=' not in arg
+        i += 2 if takes_value else 1
+    return None
+
+
 def parse_modelica_file(file_path):
     package_name = None
     models = []
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import signal
@@ -5,6 +6,7 @@ import sys
 
 # os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
+from attrdict import AttrDict
 from flask import Flask
 from flask import jsonify, make_response
 from flask_api import status
@@ -12,6 +14,8 @@ from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 from werkzeug.exceptions import HTTPException
 
+from app.data import migrations
+from app.data import replica
 from app.data.database import session_scope
 
 from app.simulator import create_fmu
@@ -123,6 +127,20 @@ def showargs():
         app_profile, log_level, host, port, debug, params(app_profile).db_url, create_fmus)
 
 
+@app.route('/health')
+def health():
+    """
+    liveness of the simulation thread, e.g., for load balancer health checks
+    """
+    data = DeviceService.get_health()
+    resp = {
+        "status": "success" if data["healthy"] else "error",
+        "msg": "simulation running" if data["healthy"] else "simulation stalled or stopped",
+        "data": data
+    }
+    return make_response(jsonify(resp), status.HTTP_200_OK if data["healthy"] else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
 @app.route('/')
 @app.route('/apidocs')
 def root():
@@ -214,10 +232,50 @@ fmu_dir = params.model.fmu_dir
 if not os.path.exists(fmu_dir):
     os.makedirs(fmu_dir)
 
+# manage the schema of the db instead of running the server, e.g., python main.py --profile prod db upgrade
+if args.command == 'db':
+    with session_scope() as session:
+        is_done = migrations.run_command(session, args.action, args.revision)
+    sys.exit(0 if is_done else 1)
+
+# export consumption data instead of running the server, e.g., python main.py export --output consumption.npz
+if args.command == 'export':
+    export_params = AttrDict({"device_ids": args.device_ids, "start": args.start, "end": args.end,
+                              "format": args.format})
+    with session_scope() as session:
+        is_done, result = DeviceService.export_consumption(export_params, args.output, session)
+    if not is_done:
+        LOGGER.error(result["msg"])
+    sys.exit(0 if is_done else 1)
+
 if create_fmus:
     LOGGER.info("Creating FMUs")
     create_fmu.create_fmu(params)
 
+# run a batch simulation instead of the server, e.g., python main.py --batch spec.json --batch-output traces.npz
+if args.batch:
+    LOGGER.info("Running batch simulation described in '%s'" % args.batch)
+    with open(args.batch, 'r') as spec:
+        batch_params = AttrDict(json.load(spec))
+    is_done, result = DeviceService.run_batch_simulation(batch_params, args.batch_output)
+    if not is_done:
+        LOGGER.error(result["msg"])
+    sys.exit(0 if is_done else 1)
+
+# bring the schema of an existing db up to date with the models (columns, indexes and tables added since it was
+# created). the server does not start on an outdated schema, as the models would not match it
+with session_scope() as session:
+    if params.migrate_on_start:
+        migrations.upgrade(session)
+    pending = migrations.pending_migrations(session)
+    if len(pending) > 0:
+        LOGGER.error("The database schema is at revision '%s' with %d pending migrations, run 'python main.py db "
+                     "upgrade' before starting the server" % (migrations.current_revision(session), len(pending)))
+        sys.exit(1)
+
+# read-only queries go to the replicas, if any are configured
+replica.configure(params(app_profile).get("replica_urls") or [])
+
 # register signal handlers
 signal.signal(signal.SIGINT, clean_exit)  # keyboard interrupt
 signal.signal(signal.SIGHUP, clean_exit)  # controlling terminal closed